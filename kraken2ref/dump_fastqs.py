@@ -1,53 +1,1117 @@
-import io, os, sys
+import io, os, re, sys
+import errno
 import json
+import glob
+import gzip
+import stat
+import shutil
+import zlib
+import mmap
 import logging
-from Bio import SeqIO
+
+## read single-end records at most this many bytes at a time
+DEFAULT_PIECE_SIZE = 64 * 1024
+
+## runs of consecutive reads for one output at least this long are copied by the kernel
+MIN_RUN_BYTES = 64 * 1024
+
+## partial outputs are named <sample>_<stem>.shard<i>-of-<N><ext>
+SHARD_PATTERN = r"^{sample_id}_(?P<stem>.+)\.shard(?P<idx>\d+)-of-(?P<num>\d+)(?P<ext>\.fq(?:\.gz)?|\.json)$"
+
+def parse_shard(shard: str):
+    """Parse a shard specification of the form 'i/N' (1-based).
+
+    Args:
+        shard (str): Shard specification, eg. "2/8"
+
+    Returns:
+        (tuple): (i, N) as integers
+
+    Examples:
+        >>> parse_shard("2/8")
+        (2, 8)
+    """
+    try:
+        shard_idx, num_shards = (int(i) for i in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard specification '{shard}': expected 'i/N', eg. '1/4'.")
+    if num_shards < 1 or not 1 <= shard_idx <= num_shards:
+        raise ValueError(f"Invalid shard specification '{shard}': need 1 <= i <= N.")
+    return shard_idx, num_shards
+
+def read_in_shard(read_id: bytes, shard: tuple):
+    """Whether a read belongs to the given shard.
+        Uses crc32 rather than hash() so that partitions are stable across processes and nodes.
+
+    Args:
+        read_id (bytes): Read ID (without /1 or /2 suffix)
+        shard (tuple): (i, N) as returned by `parse_shard`
+
+    Returns:
+        (bool): True if read_id falls in partition i of N
+    """
+    shard_idx, num_shards = shard
+    return zlib.crc32(read_id) % num_shards == shard_idx - 1
+
+def read_fastq(handle):
+    """Yield raw records from a 4-line FASTQ file, without parsing them into SeqRecords
+
+    Args:
+        handle (file object): FASTQ file opened in binary mode
+
+    Yields:
+        record (bytes): One record, including the trailing newline
+    """
+    readline = handle.readline
+    while True:
+        header = readline()
+        if not header:
+            return
+        seq = readline()
+        plus = readline()
+        qual = readline()
+        if header[:1] != b"@" or plus[:1] != b"+" or not qual:
+            raise ValueError(f"Malformed FASTQ record {header.strip()[:50]!r} in {handle.name}: expected 4-line records.")
+        if qual[-1:] != b"\n":
+            qual += b"\n"
+        yield header + seq + plus + qual
+
+def fastq_read_id(record: bytes):
+    """Read ID of a raw FASTQ record (the first word of the header, as Bio.SeqIO would report it)
+
+    Args:
+        record (bytes): Raw FASTQ record
+
+    Returns:
+        (bytes): Read ID
+    """
+    return record[1:record.index(b"\n")].split(None, 1)[0]
+
+def read_records(*handles):
+    """Read records from one or more FASTQ files in step (eg. R1 and R2)
+
+    Args:
+        handles (file object): FASTQ files opened in binary mode
+
+    Yields:
+        rid (bytes): Read ID of the first mate
+        records (tuple): Raw record of each mate
+    """
+    for records in zip(*[read_fastq(handle) for handle in handles]):
+        yield fastq_read_id(records[0]), records
+
+def read_interleaved(handle):
+    """Read pairs from an interleaved FASTQ file, where R2 of each pair follows its R1
+
+    Args:
+        handle (file object): Interleaved FASTQ opened in binary mode
+
+    Yields:
+        rid (bytes): Read ID of R1
+        records (tuple): Raw records of R1 and R2
+    """
+    records = read_fastq(handle)
+    for rec1 in records:
+        rec2 = next(records, None)
+        if rec2 is None:
+            raise ValueError(f"Odd number of records in interleaved FASTQ {handle.name}: last read has no mate.")
+        yield fastq_read_id(rec1), (rec1, rec2)
+
+class MappedFastq:
+    """Memory-mapped, uncompressed 4-line FASTQ file.
+        Record boundaries are found with `find` over the mapping, and records are handed out
+        as memoryview slices of it, so the only object created per read is its ID.
+        Has `seek`/`tell`/`close` like the file handles it stands in for.
+    """
+    def __init__(self, path: str):
+        """Initialiser
+
+        Args:
+            path (str): Path to the FASTQ file
+        """
+        self.name = path
+        self.offset = 0
+        self.handle = open(path, "rb")
+        ## empty files cannot be mapped
+        self.size = os.fstat(self.handle.fileno()).st_size
+        self.map = mmap.mmap(self.handle.fileno(), 0, access = mmap.ACCESS_READ) if self.size > 0 else None
+        self.view = memoryview(self.map) if self.map is not None else None
+        if self.map is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def seek(self, offset: int):
+        self.offset = offset
+
+    def tell(self):
+        """Offset of the end of the last record handed out
+        """
+        return self.offset
+
+    def scan(self, with_ids: bool = True):
+        """Yield records from the current offset onwards
+
+        Args:
+            with_ids (bool, optional): Also yield the read ID of each record. Defaults to True.
+
+        Yields:
+            rid (bytes): Read ID (only if `with_ids`)
+            record (memoryview): Raw record, including the trailing newline
+        """
+        if self.map is None:
+            return
+        mapped, view, find, size = self.map, self.view, self.map.find, self.size
+        pos = self.offset
+        while pos < size:
+            header_end = find(b"\n", pos)
+            seq_end = find(b"\n", header_end + 1) if header_end != -1 else -1
+            plus_end = find(b"\n", seq_end + 1) if seq_end != -1 else -1
+            if plus_end == -1 or plus_end + 1 == size or mapped[pos] != 64 or mapped[seq_end + 1] != 43:
+                raise ValueError(f"Malformed FASTQ record {bytes(view[pos:pos + 50]).strip()!r} in {self.name}: expected 4-line records.")
+            qual_end = find(b"\n", plus_end + 1)
+            if qual_end != -1:
+                end = qual_end + 1
+                record = view[pos:end]
+            else:
+                ## last record has no trailing newline
+                end = size
+                record = view[pos:end].tobytes() + b"\n"
+            self.offset = end
+
+            if with_ids:
+                ## first word of the header, split at any whitespace (including the \r of CRLF files), as in `fastq_read_id`
+                yield mapped[pos + 1:header_end].split(None, 1)[0], record
+            else:
+                yield record
+            pos = end
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.view.release()
+                self.map.close()
+            except BufferError:
+                ## a record is still referenced (eg. by a traceback): leave the mapping to be freed with it
+                pass
+        self.handle.close()
+
+def scan_mapped(first, *mates):
+    """Scan records from one or more memory-mapped FASTQ files in step (eg. R1 and R2)
+
+    Args:
+        first (MappedFastq): FASTQ the read IDs are taken from
+        mates (MappedFastq): Other mates' FASTQs
+
+    Yields:
+        rid (bytes): Read ID of the first mate
+        records (tuple): Raw record (memoryview) of each mate
+    """
+    mate_scans = [mate.scan(with_ids = False) for mate in mates]
+    for rid, record in first.scan():
+        mate_records = [next(mate_scan, None) for mate_scan in mate_scans]
+        if None in mate_records:
+            return
+        yield rid, (record, *mate_records)
+
+def scan_interleaved(mapped):
+    """Scan pairs from a memory-mapped interleaved FASTQ file, where R2 of each pair follows its R1
+
+    Args:
+        mapped (MappedFastq): Interleaved FASTQ
+
+    Yields:
+        rid (bytes): Read ID of R1
+        records (tuple): Raw records (memoryview) of R1 and R2
+    """
+    records = mapped.scan()
+    for rid, rec1 in records:
+        _, rec2 = next(records, (None, None))
+        if rec2 is None:
+            raise ValueError(f"Odd number of records in interleaved FASTQ {mapped.name}: last read has no mate.")
+        yield rid, (rec1, rec2)
+
+def output_path(outdir, sample_id, stem, shard = None, ext = ".fq"):
+    """Build path of an output file, eg. <outdir>/<sample>_<taxid>_R1.fq
+
+    Args:
+        outdir (str/path): Output directory
+        sample_id (str): Sample ID
+        stem (str): Output-specific part of the file name, eg. "<taxid>_R1"
+        shard (tuple, optional): (i, N) if writing partial outputs. Defaults to None.
+        ext (str, optional): File extension. Defaults to ".fq".
+
+    Returns:
+        (str): Path to output file
+    """
+    if shard is not None:
+        ext = f".shard{shard[0]}-of-{shard[1]}{ext}"
+    return os.path.join(outdir, f"{sample_id}_{stem}{ext}")
+
+def open_output(path, buffer_size = io.DEFAULT_BUFFER_SIZE, compress = False, append = False):
+    """Open an output file for writing (in binary mode).
+        If `path` is a pre-created named pipe (FIFO), opening blocks until a consumer opens the
+        read end, and writes block whenever the consumer falls behind (i.e. backpressure is handled by the OS).
+
+    Args:
+        path (str/path): Path to output file or FIFO
+        buffer_size (int, optional): Write buffer size in bytes. Defaults to io.DEFAULT_BUFFER_SIZE.
+        compress (bool, optional): Whether to gzip the output (at level 1, favouring speed). Defaults to False.
+        append (bool, optional): Whether to append to an existing file. Defaults to False.
+
+    Returns:
+        (file object): Handle open for writing
+    """
+    if os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode):
+        logging.info(f"Writing to named pipe {path}; waiting for a reader.")
+    handle = open(path, "ab" if append else "wb", buffering=buffer_size)
+    if compress:
+        return gzip.GzipFile(fileobj=handle, mode="wb", compresslevel=1)
+    return handle
+
+def commit_output(handle):
+    """Flush an output to disk so that its current size can be recorded in a checkpoint.
+        gzip outputs finish the current gzip member, so the file is valid at that size, and carry on in a new member.
+
+    Args:
+        handle (file object): Handle returned by `open_output`
+
+    Returns:
+        handle (file object): Handle to keep writing to
+        size (int): Number of bytes committed to disk
+    """
+    raw = handle.fileobj if isinstance(handle, gzip.GzipFile) else handle
+    if raw is not handle:
+        handle.close()
+    raw.flush()
+    os.fsync(raw.fileno())
+    size = raw.tell()
+    ## the next member's header is written on creation, so only after measuring
+    if raw is not handle:
+        handle = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1)
+    return handle, size
+
+def copy_range(source, handle, start: int, end: int):
+    """Copy bytes [start, end) of a memory-mapped input to an output file without passing them through
+        Python, using copy_file_range. Falls back to writing them from the mapping where copy_file_range is unavailable,
+        or if the kernel cannot copy between these files (eg. outputs that are pipes or opened for appending).
+
+    Args:
+        source (MappedFastq): Input to copy from
+        handle (file object): Uncompressed output, flushed, positioned where the bytes go
+        start (int): Offset of the first byte to copy
+        end (int): Offset after the last byte to copy
+    """
+    src_fd, dst_fd = source.handle.fileno(), handle.fileno()
+    try:
+        ## without copy_file_range (eg. macOS), bytes are written from the mapping
+        ## (sendfile is no substitute: on some platforms it only writes to sockets)
+        while start < end and hasattr(os, "copy_file_range"):
+            copied = os.copy_file_range(src_fd, dst_fd, end - start, start)
+            if copied == 0:
+                break
+            start += copied
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.EOPNOTSUPP, errno.ESPIPE):
+            raise
+    if start < end:
+        handle.write(source.view[start:end])
+
+def close_output(handle):
+    """Close a handle returned by `open_output`, including the underlying file of gzip outputs
+
+    Args:
+        handle (file object): Handle returned by `open_output`
+    """
+    raw = handle.fileobj if isinstance(handle, gzip.GzipFile) else None
+    handle.close()
+    if raw is not None:
+        raw.close()
+
+class ReadStats:
+    """Running statistics for the reads written to one output.
+        Collected from the raw bytes of each record as it is written, using only
+        byte counting, so the outputs never need to be read back to get them.
+    """
+    ## Phred+33 encoding
+    QUAL_OFFSET = 33
+
+    def __init__(self):
+        """Initialiser
+        """
+        self.num_reads = 0
+        self.total_bases = 0
+        self.gc_bases = 0
+        self.quality_sum = 0
+        self.length_counts = {}
+
+    @staticmethod
+    def count_gc(seq: bytes):
+        """Number of G/C bases in (a piece of) a sequence line
+        """
+        return seq.count(b"G") + seq.count(b"C") + seq.count(b"g") + seq.count(b"c")
+
+    @classmethod
+    def sum_quality(cls, qual: bytes):
+        """Sum of Phred scores in (a piece of) a quality line
+        """
+        return sum(qual) - cls.QUAL_OFFSET * len(qual)
+
+    def add(self, record: bytes):
+        """Add one read
+
+        Args:
+            record (bytes): Raw FASTQ record (b"@id\nSEQ\n+\nQUAL\n")
+        """
+        if isinstance(record, memoryview):
+            record = record.tobytes()
+        _, seq, _, qual = record.split(b"\n", 4)[:4]
+        self.add_read(len(seq), self.count_gc(seq), self.sum_quality(qual))
+
+    def add_read(self, length: int, gc_bases: int, quality_sum: int):
+        """Add one read from counts already taken, eg. while copying it piece by piece
+
+        Args:
+            length (int): Read length
+            gc_bases (int): Number of G/C bases in the read
+            quality_sum (int): Sum of Phred scores of the read
+        """
+        self.num_reads += 1
+        self.total_bases += length
+        self.gc_bases += gc_bases
+        self.quality_sum += quality_sum
+        self.length_counts[length] = self.length_counts.get(length, 0) + 1
+
+    def update(self, other):
+        """Add the reads counted in another ReadStats, eg. from another shard
+
+        Args:
+            other (ReadStats): Statistics to add
+        """
+        self.num_reads += other.num_reads
+        self.total_bases += other.total_bases
+        self.gc_bases += other.gc_bases
+        self.quality_sum += other.quality_sum
+        for length, count in other.length_counts.items():
+            self.length_counts[length] = self.length_counts.get(length, 0) + count
+
+    def to_dict(self):
+        """Summarise as a JSON-serialisable dict. Raw sums are kept so that summaries can be combined with `from_dict`.
+
+        Returns:
+            (dict): Summary statistics
+        """
+        return {
+            "num_reads": self.num_reads,
+            "total_bases": self.total_bases,
+            "min_length": min(self.length_counts) if self.length_counts else 0,
+            "max_length": max(self.length_counts) if self.length_counts else 0,
+            "mean_length": round(self.total_bases / self.num_reads, 2) if self.num_reads else 0,
+            "mean_quality": round(self.quality_sum / self.total_bases, 2) if self.total_bases else 0,
+            "gc_content": round(self.gc_bases / self.total_bases, 4) if self.total_bases else 0,
+            "gc_bases": self.gc_bases,
+            "quality_sum": self.quality_sum,
+            "length_distribution": {str(length): self.length_counts[length] for length in sorted(self.length_counts)},
+        }
+
+    @classmethod
+    def from_dict(cls, summary: dict):
+        """Rebuild from the output of `to_dict`
+
+        Args:
+            summary (dict): Summary statistics
+
+        Returns:
+            (ReadStats): Statistics object
+        """
+        stats = cls()
+        stats.num_reads = summary["num_reads"]
+        stats.total_bases = summary["total_bases"]
+        stats.gc_bases = summary["gc_bases"]
+        stats.quality_sum = summary["quality_sum"]
+        stats.length_counts = {int(length): count for length, count in summary["length_distribution"].items()}
+        return stats
+
+class TaxonWriter:
+    """Writes reads for one taxon to one file per mate: an R1/R2 file pair for paired-end data,
+        or a single file for single-end data (mates = ("SE",)).
+        If `interleaved`, both mates go to one file (file key "IL"), one record after the other.
+        If `max_reads` is given, output is split into numbered file sets
+        (eg. <sample_id>_<taxid>_part<n>_R1.fq/_R2.fq) of at most `max_reads` reads (pairs) each; mates always roll over together.
+    """
+    ## file name suffix for each mate
+    MATE_SUFFIXES = {"R1": "_R1", "R2": "_R2", "SE": "", "IL": ""}
+
+    def __init__(self, outdir, sample_id, taxid, buffer_size = io.DEFAULT_BUFFER_SIZE, shard = None, max_reads = None, stream = None, compress = False, collect_stats = False, state = None, mates = ("R1", "R2"), interleaved = False):
+        """Initialiser
+
+        Args:
+            outdir (str/path): Output directory
+            sample_id (str): Sample ID
+            taxid (str): Taxon ID the reads belong to
+            buffer_size (int, optional): Write buffer size in bytes. Defaults to io.DEFAULT_BUFFER_SIZE.
+            shard (tuple, optional): (i, N) if writing partial outputs. Defaults to None.
+            max_reads (int, optional): Maximum number of reads (pairs) per file set. Defaults to None (no limit).
+            stream (file object, optional): Write all mates interleaved to this handle instead of to files. Defaults to None.
+            compress (bool, optional): Whether to write gzipped (.fq.gz) files. Defaults to False.
+            collect_stats (bool, optional): Whether to collect ReadStats for each mate. Defaults to False.
+            state (dict, optional): State returned by `commit` to resume from. Defaults to None.
+            mates (tuple, optional): Mates to write, ("R1", "R2") or ("SE",). Defaults to ("R1", "R2").
+            interleaved (bool, optional): Whether to write all mates to one file. Defaults to False (always True if streaming).
+        """
+        self.outdir = outdir
+        self.sample_id = sample_id
+        self.taxid = taxid
+        self.buffer_size = buffer_size
+        self.shard = shard
+        self.max_reads = max_reads
+        self.stream = stream
+        self.compress = compress
+        self.mates = mates
+        ## files written per file set: one per mate, or one shared by all mates
+        self.files = ("IL",) if interleaved or stream is not None else mates
+        ## outputs are byte-for-byte copies of input records, so runs of them can be copied directly
+        self.plain = stream is None and not compress and not collect_stats
+        self.stats = {mate: ReadStats() for mate in mates} if collect_stats else None
+
+        ## one entry per file set: {"R1": path, "R2": path, "num_reads": int} (or {"IL": path, ...}, etc.)
+        self.parts = []
+        self.num_reads = 0
+        if state is None:
+            self._open_next()
+        else:
+            self._restore(state)
+
+    def _open_next(self):
+        """Close the current file set (if any) and open the next one
+        """
+        if self.stream is not None:
+            self._set_handles([self.stream])
+            self.parts.append({"IL": "-", "num_reads": 0})
+            return
+
+        if self.parts:
+            for handle in self.handles:
+                close_output(handle)
+
+        stem = self.taxid if self.max_reads is None else f"{self.taxid}_part{len(self.parts) + 1}"
+        ext = ".fq.gz" if self.compress else ".fq"
+        paths = {file: output_path(self.outdir, self.sample_id, f"{stem}{self.MATE_SUFFIXES[file]}", self.shard, ext) for file in self.files}
+        self._set_handles([open_output(paths[file], self.buffer_size, self.compress) for file in self.files])
+        self.parts.append({**paths, "num_reads": 0})
+
+    def _set_handles(self, handles: list):
+        """Set the handles of the current file set, and which of them each mate is written to
+
+        Args:
+            handles (list): One handle per file
+        """
+        self.handles = handles
+        self.mate_handles = handles if len(handles) == len(self.mates) else handles * len(self.mates)
+
+    def _restore(self, state: dict):
+        """Restore from a checkpointed state: truncate the current file set to its committed size and reopen it for appending
+
+        Args:
+            state (dict): State returned by `commit`
+        """
+        self.parts = [dict(part) for part in state["parts"]]
+        self.num_reads = sum(part["num_reads"] for part in self.parts)
+        if self.stats is not None:
+            self.stats = {mate: ReadStats.from_dict(summary) for mate, summary in state["stats"].items()}
+
+        current = self.parts[-1]
+        for file, size in zip(self.files, state["committed_sizes"]):
+            if os.path.getsize(current[file]) < size:
+                raise RuntimeError(f"Cannot resume: {current[file]} is smaller than its checkpointed size ({size} bytes).")
+            os.truncate(current[file], size)
+        self._set_handles([open_output(current[file], self.buffer_size, self.compress, append = True) for file in self.files])
+
+    def commit(self):
+        """Flush the current file set to disk and return the state needed to resume from this point
+
+        Returns:
+            state (dict): File sets written so far, committed sizes of the current set, and stats
+        """
+        handles, committed_sizes = [], []
+        for handle in self.handles:
+            handle, size = commit_output(handle)
+            handles.append(handle)
+            committed_sizes.append(size)
+        self._set_handles(handles)
+        return {
+            "parts": [dict(part) for part in self.parts],
+            "committed_sizes": committed_sizes,
+            "stats": {mate: stats.to_dict() for mate, stats in self.stats.items()} if self.stats is not None else None
+        }
+
+    def start_read(self):
+        """Count one more read (pair) about to be written, rolling over to the next file set if the current one is full.
+            Only rolls over once there is a read to write, so there are no trailing empty parts.
+
+        Returns:
+            handles (list): One handle per mate to write the read to
+        """
+        if self.max_reads is not None and self.parts[-1]["num_reads"] == self.max_reads:
+            self._open_next()
+        self.parts[-1]["num_reads"] += 1
+        self.num_reads += 1
+        return self.mate_handles
+
+    def write(self, *records: bytes):
+        """Write one read (pair)
+
+        Args:
+            records (bytes): Raw FASTQ record for each mate
+        """
+        for mate, handle, record in zip(self.mates, self.start_read(), records):
+            handle.write(record)
+            if self.stats is not None:
+                self.stats[mate].add(record)
+
+    def copy_run(self, sources: list, starts: list, ends: list, num_reads: int, min_run_bytes: int = MIN_RUN_BYTES):
+        """Write a run of consecutive reads (pairs) straight from the inputs: one byte range per file.
+            Only for `plain` writers with one file per input, and runs that fit in the current file set.
+
+        Args:
+            sources (list): MappedFastq input for each file
+            starts (list): Offset of the run's first record in each input
+            ends (list): Offset after the run's last record in each input
+            num_reads (int): Number of reads (pairs) in the run
+            min_run_bytes (int, optional): Shorter ranges are written from the mapping instead of copied by the kernel. Defaults to MIN_RUN_BYTES.
+        """
+        self.parts[-1]["num_reads"] += num_reads
+        self.num_reads += num_reads
+        for handle, source, start, end in zip(self.handles, sources, starts, ends):
+            if end - start < min_run_bytes:
+                handle.write(source.view[start:end])
+            else:
+                handle.flush()
+                copy_range(source, handle, start, end)
+
+    def close(self):
+        """Close (or, if streaming, flush) the current file set
+        """
+        if self.stream is not None:
+            self.stream.flush()
+            return
+        for handle in self.handles:
+            close_output(handle)
+
+def write_manifest(outdir, sample_id, writers, max_reads = None, unassigned = None):
+    """Write a JSON manifest listing the file pairs written for each taxon
+
+    Args:
+        outdir (str/path): Output directory
+        sample_id (str): Sample ID
+        writers (dict): {taxid: TaxonWriter}
+        max_reads (int, optional): Maximum number of read pairs per file pair, recorded in the manifest. Defaults to None.
+        unassigned (TaxonWriter, optional): Writer for reads not assigned to any taxon. Defaults to None.
+
+    Returns:
+        manifest_path (str): Path to the manifest
+    """
+    ## paths relative to the manifest, so the output directory can be moved
+    def list_parts(writer):
+        return [
+            {**{file: os.path.basename(part[file]) for file in writer.files}, "num_reads": part["num_reads"]}
+            for part in writer.parts
+        ]
+
+    manifest = {
+        "sample": sample_id,
+        "max_reads_per_file": max_reads,
+        "taxa": {taxid: list_parts(writer) for taxid, writer in writers.items()}
+    }
+    if unassigned is not None:
+        manifest["unassigned"] = list_parts(unassigned)
+    manifest_path = os.path.join(outdir, f"{sample_id}_dump_manifest.json")
+    with open(manifest_path, "w") as manifest_out:
+        json.dump(manifest, manifest_out, indent=4)
+    logging.info(f"Manifest written to {manifest_path}")
+    return manifest_path
+
+def write_stats(outdir, sample_id, writers, shard = None, unassigned = None):
+    """Write a JSON file of per-taxon read statistics collected while dumping
+
+    Args:
+        outdir (str/path): Output directory
+        sample_id (str): Sample ID
+        writers (dict): {taxid: TaxonWriter}, with stats collected
+        shard (tuple, optional): (i, N) if writing partial outputs. Defaults to None.
+        unassigned (TaxonWriter, optional): Writer for reads not assigned to any taxon. Defaults to None.
+
+    Returns:
+        stats_path (str): Path to the statistics JSON
+    """
+    all_stats = {taxid: {read: stats.to_dict() for read, stats in writer.stats.items()} for taxid, writer in writers.items()}
+    if unassigned is not None:
+        all_stats["unassigned"] = {read: stats.to_dict() for read, stats in unassigned.stats.items()}
+
+    stats_path = output_path(outdir, sample_id, "dump_stats", shard, ".json")
+    with open(stats_path, "w") as stats_out:
+        json.dump(all_stats, stats_out, indent=4)
+    logging.info(f"Read statistics written to {stats_path}")
+    return stats_path
+
+def merge_stats(stats_paths: list, merged_path: str):
+    """Combine per-shard statistics JSONs written by `write_stats`
+
+    Args:
+        stats_paths (list): Paths to per-shard statistics JSONs
+        merged_path (str/path): Path to write combined statistics to
+    """
+    merged = {}
+    for stats_path in stats_paths:
+        with open(stats_path, "r") as stats_in:
+            for output_name, per_read in json.load(stats_in).items():
+                for read, summary in per_read.items():
+                    merged.setdefault(output_name, {}).setdefault(read, ReadStats()).update(ReadStats.from_dict(summary))
+
+    with open(merged_path, "w") as stats_out:
+        json.dump({output_name: {read: stats.to_dict() for read, stats in per_read.items()} for output_name, per_read in merged.items()}, stats_out, indent=4)
+
+def save_checkpoint(checkpoint_path, settings, offsets, pairs_processed, outputs, unassigned = None):
+    """Commit all outputs to disk, then atomically write a checkpoint recording how far the dump has got
+
+    Args:
+        checkpoint_path (str/path): Path to checkpoint file
+        settings (dict): Dump settings; resuming with different settings is refused
+        offsets (list): Byte offsets in [fq1, fq2] of the first read pair not yet processed
+        pairs_processed (int): Number of read pairs processed so far
+        outputs (dict): {taxid: TaxonWriter}
+        unassigned (TaxonWriter, optional): Writer for reads not assigned to any taxon. Defaults to None.
+    """
+    checkpoint = {
+        "settings": settings,
+        "offsets": offsets,
+        "pairs_processed": pairs_processed,
+        "writers": {taxid: writer.commit() for taxid, writer in outputs.items()},
+        "unassigned": unassigned.commit() if unassigned is not None else None
+    }
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as checkpoint_out:
+        json.dump(checkpoint, checkpoint_out)
+        checkpoint_out.flush()
+        os.fsync(checkpoint_out.fileno())
+    os.replace(tmp_path, checkpoint_path)
+    logging.debug(f"Checkpoint written after {pairs_processed} read pairs.")
+
+def load_checkpoint(checkpoint_path, settings):
+    """Load a checkpoint written by `save_checkpoint`
+
+    Args:
+        checkpoint_path (str/path): Path to checkpoint file
+        settings (dict): Settings of the current run, which must match those of the checkpointed run
+
+    Returns:
+        checkpoint (dict): Checkpoint contents, or None if no checkpoint exists
+    """
+    if not os.path.exists(checkpoint_path):
+        logging.info(f"No checkpoint found at {checkpoint_path}; starting from the beginning.")
+        return None
+    with open(checkpoint_path, "r") as checkpoint_in:
+        checkpoint = json.load(checkpoint_in)
+    if checkpoint["settings"] != settings:
+        raise ValueError(f"Cannot resume from {checkpoint_path}: it was written by a run with different inputs or options.")
+    logging.info(f"Resuming from checkpoint at {checkpoint_path}, after {checkpoint['pairs_processed']} read pairs.")
+    return checkpoint
+
+def copy_line(handle, targets, piece_size = DEFAULT_PIECE_SIZE, measure = None, expect = None):
+    """Copy one line from `handle` to each of `targets` in pieces of at most `piece_size` bytes,
+        so that very long lines (eg. 100 kb+ long reads) are never held in memory whole.
+
+    Args:
+        handle (file object): Input opened in binary mode, positioned at the start of a line
+        targets (list): Handles to copy the line to (may be empty, to skip the line)
+        piece_size (int, optional): Maximum number of bytes read at once. Defaults to DEFAULT_PIECE_SIZE.
+        measure (function, optional): Function applied to each piece (without newline), results are summed. Defaults to None.
+        expect (bytes, optional): Byte the line must start with. Defaults to None.
+
+    Returns:
+        length (int): Length of the line, excluding the newline
+        measured (int): Sum of `measure` over the line (0 if no `measure`)
+    """
+    length, measured = 0, 0
+    while True:
+        piece = handle.readline(piece_size)
+        if not piece:
+            if length == 0:
+                raise ValueError(f"Truncated FASTQ record in {handle.name}: expected 4-line records.")
+            ## last line of the file has no newline
+            piece = b"\n"
+        if length == 0 and expect is not None and piece[:1] != expect:
+            raise ValueError(f"Malformed FASTQ record in {handle.name}: expected a line starting with {expect!r}, got {piece[:50]!r}.")
+        for target in targets:
+            target.write(piece)
+        end_of_line = piece[-1:] == b"\n"
+        if end_of_line:
+            piece = piece[:-1]
+        length += len(piece)
+        if measure is not None:
+            measured += measure(piece)
+        if end_of_line:
+            return length, measured
+
+def route_records(records, readids_to_taxids, outputs, unassigned = None, shard = None,
+        reads_processed = 0, checkpoint_every = None, checkpoint = None):
+    """Funnel reads (pairs) to the writer(s) of their taxa
+
+    Args:
+        records (iterable): (read ID, records of each mate), from `read_records` or `scan_mapped`
+        readids_to_taxids (dict): {read ID (bytes): set(taxids)}
+        outputs (dict): {taxid: TaxonWriter}
+        unassigned (TaxonWriter, optional): Writer for reads not assigned to any taxon. Defaults to None.
+        shard (tuple, optional): (i, N) if only routing one partition of the reads. Defaults to None.
+        reads_processed (int, optional): Number of reads (pairs) already processed (when resuming). Defaults to 0.
+        checkpoint_every (int, optional): Call `checkpoint` every this many reads (pairs). Defaults to None.
+        checkpoint (function, optional): Called with the number of reads (pairs) processed. Defaults to None.
+
+    Returns:
+        reads_processed (int): Number of reads (pairs) processed
+    """
+    for rid, mate_records in records:
+        if rid.endswith(b"/1"):
+            rid = rid[:-2]
+
+        taxids = readids_to_taxids.get(rid)
+
+        if taxids is None:
+            if unassigned is not None and (shard is None or read_in_shard(rid, shard)):
+                unassigned.write(*mate_records)
+        else:
+            for taxid in taxids:
+                outputs[taxid].write(*mate_records)
+
+        reads_processed += 1
+        if checkpoint_every is not None and reads_processed % checkpoint_every == 0:
+            checkpoint(reads_processed)
+
+    return reads_processed
+
+def route_runs(sources, records, readids_to_taxids, outputs, unassigned = None, shard = None,
+        reads_processed = 0, checkpoint_every = None, checkpoint = None, min_run_bytes = MIN_RUN_BYTES):
+    """Funnel reads (pairs) from memory-mapped inputs to the writer(s) of their taxa, as `route_records` does,
+        but collect consecutive reads going to the same single writer into runs, and write each run as one
+        byte range per input (see `TaxonWriter.copy_run`). Reads going to several writers, or to writers
+        that need to see every record (compressed, streamed, or collecting stats), are written one at a time.
+
+    Args:
+        sources (list): MappedFastq inputs that `records` are scanned from
+        records (iterable): (read ID, records of each mate), from `scan_mapped` or `scan_interleaved`
+        readids_to_taxids (dict): {read ID (bytes): set(taxids)}
+        outputs (dict): {taxid: TaxonWriter}
+        unassigned (TaxonWriter, optional): Writer for reads not assigned to any taxon. Defaults to None.
+        shard (tuple, optional): (i, N) if only routing one partition of the reads. Defaults to None.
+        reads_processed (int, optional): Number of reads (pairs) already processed (when resuming). Defaults to 0.
+        checkpoint_every (int, optional): Call `checkpoint` every this many reads (pairs). Defaults to None.
+        checkpoint (function, optional): Called with the number of reads (pairs) processed. Defaults to None.
+        min_run_bytes (int, optional): Runs at least this long (per input) are copied by the kernel. Defaults to MIN_RUN_BYTES.
+
+    Returns:
+        reads_processed (int): Number of reads (pairs) processed
+    """
+    ## end of the last read processed, in each input
+    positions = [source.tell() for source in sources]
+    run_writer, run_starts, run_reads = None, positions, 0
+
+    def flush_run():
+        nonlocal run_writer, run_reads
+        if run_reads > 0:
+            run_writer.copy_run(sources, run_starts, positions, run_reads, min_run_bytes)
+        run_writer, run_reads = None, 0
+
+    for rid, mate_records in records:
+        if rid.endswith(b"/1"):
+            rid = rid[:-2]
+
+        taxids = readids_to_taxids.get(rid)
+
+        if taxids is None:
+            writers = [unassigned] if unassigned is not None and (shard is None or read_in_shard(rid, shard)) else []
+        else:
+            writers = [outputs[taxid] for taxid in taxids]
+
+        writer = writers[0] if len(writers) == 1 else None
+        ## the last record of a file missing its newline is not a plain slice of the input
+        if (writer is not None and writer.plain and len(writer.files) == len(sources)
+                and all(type(record) is memoryview for record in mate_records)):
+            if writer is not run_writer:
+                flush_run()
+                run_writer, run_starts = writer, positions
+            ## runs never cross into the next file set
+            if writer.max_reads is not None and writer.parts[-1]["num_reads"] + run_reads == writer.max_reads:
+                flush_run()
+                writer.write(*mate_records)
+            else:
+                run_reads += 1
+        else:
+            flush_run()
+            for writer in writers:
+                writer.write(*mate_records)
+
+        positions = [source.tell() for source in sources]
+        reads_processed += 1
+        if checkpoint_every is not None and reads_processed % checkpoint_every == 0:
+            flush_run()
+            checkpoint(reads_processed)
+
+    flush_run()
+    return reads_processed
+
+def route_single_end(fq_handle, readids_to_taxids, outputs, unassigned = None, shard = None,
+        reads_processed = 0, checkpoint_every = None, checkpoint = None, piece_size = DEFAULT_PIECE_SIZE):
+    """Pass through a single-end input FASTQ, funnelling reads to the writer(s) of their taxa.
+        Only the header line of each record is held whole; the rest is copied in pieces of at most
+        `piece_size` bytes, and stats (if collected) are counted on the same pieces.
+
+    Args:
+        fq_handle (file object): FASTQ opened in binary mode
+        readids_to_taxids (dict): {read ID (bytes): set(taxids)}
+        outputs (dict): {taxid: TaxonWriter}, with mates = ("SE",)
+        unassigned (TaxonWriter, optional): Writer for reads not assigned to any taxon. Defaults to None.
+        shard (tuple, optional): (i, N) if only routing one partition of the reads. Defaults to None.
+        reads_processed (int, optional): Number of reads already processed (when resuming). Defaults to 0.
+        checkpoint_every (int, optional): Call `checkpoint` every this many reads. Defaults to None.
+        checkpoint (function, optional): Called with the number of reads processed. Defaults to None.
+        piece_size (int, optional): Maximum number of bytes read at once. Defaults to DEFAULT_PIECE_SIZE.
+
+    Returns:
+        reads_processed (int): Number of reads processed
+    """
+    readline = fq_handle.readline
+    while True:
+        header = readline()
+        if not header:
+            return reads_processed
+        if header[:1] != b"@":
+            raise ValueError(f"Malformed FASTQ record {header.strip()[:50]!r} in {fq_handle.name}: expected 4-line records.")
+
+        rid = header[1:].split(None, 1)[0]
+        if rid.endswith(b"/1"):
+            rid = rid[:-2]
+
+        taxids = readids_to_taxids.get(rid)
+
+        if taxids is None:
+            writers = [unassigned] if unassigned is not None and (shard is None or read_in_shard(rid, shard)) else []
+        else:
+            writers = [outputs[taxid] for taxid in taxids]
+
+        targets = [writer.start_read()[0] for writer in writers]
+        for target in targets:
+            target.write(header)
+
+        collect_stats = len(writers) > 0 and writers[0].stats is not None
+        length, gc_bases = copy_line(fq_handle, targets, piece_size, ReadStats.count_gc if collect_stats else None)
+        copy_line(fq_handle, targets, piece_size, expect = b"+")
+        _, quality_sum = copy_line(fq_handle, targets, piece_size, ReadStats.sum_quality if collect_stats else None)
+        if collect_stats:
+            for writer in writers:
+                writer.stats["SE"].add_read(length, gc_bases, quality_sum)
+
+        reads_processed += 1
+        if checkpoint_every is not None and reads_processed % checkpoint_every == 0:
+            checkpoint(reads_processed)
 
 def dump_to_files(sample_id, tax_to_readids_dict, fq1, fq2, outdir,
-        buffer_size=io.DEFAULT_BUFFER_SIZE):
+        buffer_size=io.DEFAULT_BUFFER_SIZE, shard=None, stream_taxid=None, max_reads_per_file=None,
+        write_unassigned=False, compress_unassigned=False, collect_stats=False,
+        checkpoint_every=None, resume=False, piece_size=DEFAULT_PIECE_SIZE, use_mmap=False,
+        interleaved=False):
+
+    if max_reads_per_file is not None and (shard is not None or stream_taxid is not None):
+        raise ValueError("max_reads_per_file cannot be combined with shard or stream_taxid.")
+    if write_unassigned and stream_taxid is not None:
+        raise ValueError("write_unassigned cannot be combined with stream_taxid.")
+    if max_reads_per_file is not None and max_reads_per_file < 1:
+        raise ValueError(f"max_reads_per_file must be at least 1, got {max_reads_per_file}.")
+    if (checkpoint_every is not None or resume) and stream_taxid is not None:
+        raise ValueError("Checkpointing cannot be combined with stream_taxid.")
+    if checkpoint_every is not None or resume:
+        ## pipes cannot be flushed to disk, measured or truncated, so there is nothing to commit or resume from
+        fifos = [path for path in glob.glob(os.path.join(glob.escape(str(outdir)), f"{glob.escape(sample_id)}_*")) if stat.S_ISFIFO(os.stat(path).st_mode)]
+        if fifos:
+            raise ValueError(f"Checkpointing cannot be combined with named pipe outputs: {', '.join(sorted(fifos))}.")
+    if piece_size < 1:
+        raise ValueError(f"piece_size must be at least 1, got {piece_size}.")
+    if interleaved and fq2 is not None:
+        raise ValueError("Interleaved input is read from fq1 alone: fq2 cannot be given.")
+
+    # When streaming, route only the selected taxon, interleaved to stdout
+    if stream_taxid is not None:
+        tax_to_readids_dict = {stream_taxid: tax_to_readids_dict[stream_taxid]}
 
     # Build readid -> taxid map (fast lookup)
-    readids_to_taxids: Dict[str, Set[str]] = {}
-    for taxid, read_list in tax_to_readids_dict.items():        
+    # when sharding, only reads in this instance's partition are routed
+    readids_to_taxids: Dict[bytes, Set[str]] = {}
+    for taxid, read_list in tax_to_readids_dict.items():
         for rid in read_list:
+            rid = rid.encode()
             taxdict = readids_to_taxids.get(rid)
             if taxdict is None:
+                if shard is not None and not read_in_shard(rid, shard):
+                    continue
                 readids_to_taxids[rid] = {taxid}
             else:
                 readids_to_taxids[rid].add(taxid)
 
+    # Without fq2, reads are single-end (eg. ONT) and go to one <sample_id>_<taxid>.fq per taxon,
+    # unless fq1 is interleaved, in which case pairs also go to one <sample_id>_<taxid>.fq per taxon
+    mates = ("R1", "R2") if fq2 is not None or interleaved else ("SE",)
+    if interleaved:
+        logging.info("Dumping interleaved read pairs.")
+    elif fq2 is None:
+        logging.info("No fq2 given: dumping single-end reads.")
+
+    # Resume from the last checkpoint, if asked to and one exists
+    checkpoint_path = output_path(outdir, sample_id, "dump_checkpoint", shard, ".json")
+    settings = {
+        "fq1": os.path.abspath(fq1), "fq2": os.path.abspath(fq2) if fq2 is not None else None,
+        "shard": list(shard) if shard is not None else None,
+        "max_reads_per_file": max_reads_per_file,
+        "write_unassigned": write_unassigned, "compress_unassigned": compress_unassigned,
+        "collect_stats": collect_stats, "interleaved": interleaved,
+        "taxa": sorted(tax_to_readids_dict)
+    }
+    checkpoint = load_checkpoint(checkpoint_path, settings) if resume else None
+    writer_states = checkpoint["writers"] if checkpoint is not None else {}
+
     # Open all output file handles once
+    stream = sys.stdout.buffer if stream_taxid is not None else None
     outputs = {
-        taxid: (
-            open(os.path.join(outdir, f"{sample_id}_{taxid}_R1.fq"), "w", buffering=buffer_size),
-            open(os.path.join(outdir, f"{sample_id}_{taxid}_R2.fq"), "w", buffering=buffer_size)
-        )
+        taxid: TaxonWriter(outdir, sample_id, taxid, buffer_size = buffer_size, shard = shard, max_reads = max_reads_per_file, stream = stream, collect_stats = collect_stats, state = writer_states.get(taxid), mates = mates, interleaved = interleaved)
         for taxid in tax_to_readids_dict
     }
 
-    it1 = SeqIO.parse(fq1, "fastq")
-    it2 = SeqIO.parse(fq2, "fastq")
+    # Read pairs not routed to any taxon (unclassified, or not selected) go to <sample_id>_unassigned_R1/R2
+    unassigned = None
+    if write_unassigned:
+        unassigned_state = checkpoint["unassigned"] if checkpoint is not None else None
+        unassigned = TaxonWriter(outdir, sample_id, "unassigned", buffer_size = buffer_size, shard = shard, max_reads = max_reads_per_file, compress = compress_unassigned, collect_stats = collect_stats, state = unassigned_state, mates = mates, interleaved = interleaved)
 
-    # Pass through input fastq, funnelling read pairs to appropriate output file(s)
-    for r1, r2 in zip(it1, it2):
-        rid = r1.id
-        if rid.endswith("/1"):
-            rid = rid[:-2]
+    # Memory-mapped inputs are scanned in place, without reading records into new objects
+    open_input = MappedFastq if use_mmap else (lambda fq: open(fq, "rb"))
+    input_handles = [open_input(fq) for fq in [fq1, fq2] if fq is not None]
+    reads_processed = 0
+    if checkpoint is not None:
+        reads_processed = checkpoint["pairs_processed"]
+        for handle, offset in zip(input_handles, checkpoint["offsets"]):
+            handle.seek(offset)
 
-        taxids = readids_to_taxids.get(rid)
+    def save(reads_processed):
+        save_checkpoint(checkpoint_path, settings, [handle.tell() for handle in input_handles], reads_processed, outputs, unassigned)
 
-        if taxids is None:
+    # Pass through input fastq, funnelling reads to appropriate output file(s)
+    try:
+        if interleaved or fq2 is not None or use_mmap:
+            if interleaved:
+                records = scan_interleaved(*input_handles) if use_mmap else read_interleaved(*input_handles)
+            else:
+                records = scan_mapped(*input_handles) if use_mmap else read_records(*input_handles)
+            if use_mmap:
+                route_runs(input_handles, records, readids_to_taxids, outputs, unassigned, shard,
+                    reads_processed = reads_processed, checkpoint_every = checkpoint_every, checkpoint = save)
+            else:
+                route_records(records, readids_to_taxids, outputs, unassigned, shard,
+                    reads_processed = reads_processed, checkpoint_every = checkpoint_every, checkpoint = save)
+        else:
+            route_single_end(*input_handles, readids_to_taxids, outputs, unassigned, shard,
+                reads_processed = reads_processed, checkpoint_every = checkpoint_every, checkpoint = save, piece_size = piece_size)
+
+        # Close everything (flushing the last buffered reads, which may also find the pipe closed)
+        for handle in input_handles:
+            handle.close()
+        for writer in outputs.values():
+            writer.close()
+        if unassigned is not None:
+            unassigned.close()
+            logging.info(f"Wrote {unassigned.num_reads} unassigned reads (pairs).")
+
+    except BrokenPipeError:
+        ## consumer went away before all reads were written
+        logging.critical(f"Output pipe closed by reader before all reads for sample {sample_id} were written.")
+        sys.stderr.write(f"Output pipe closed by reader before all reads for sample {sample_id} were written.\n")
+        if stream is not None:
+            ## stop python failing again when flushing stdout at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        ## close outputs still open, without failing again on the closed pipe
+        for writer in [*outputs.values(), unassigned]:
+            if writer is None or writer.stream is not None:
+                continue
+            for handle in writer.handles:
+                try:
+                    close_output(handle)
+                except BrokenPipeError:
+                    pass
+        raise
+
+    if max_reads_per_file is not None:
+        write_manifest(outdir, sample_id, outputs, max_reads = max_reads_per_file, unassigned = unassigned)
+
+    if collect_stats:
+        write_stats(outdir, sample_id, outputs, shard = shard, unassigned = unassigned)
+
+    ## outputs are complete, so the checkpoint is no longer needed
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return outputs
+
+def merge_shards(sample_id, indir, outdir, keep_shards=False):
+    """Concatenate partial outputs written by `dump_to_files(..., shard=(i, N))`.
+        Parts are concatenated in shard order (1..N), so the merged output is deterministic.
+
+    Args:
+        sample_id (str): Sample ID
+        indir (str/path): Directory containing the partial outputs
+        outdir (str/path): Directory to write merged outputs to
+        keep_shards (bool, optional): Whether to keep partial outputs after merging. Defaults to False.
+
+    Returns:
+        merged (list): Paths of merged output files
+    """
+    shard_regex = re.compile(SHARD_PATTERN.format(sample_id = re.escape(sample_id)))
+
+    ## collect {(stem, ext): {shard_idx: path}} and the shard count
+    parts = {}
+    shard_counts = set()
+    for path in glob.glob(os.path.join(glob.escape(indir), f"{glob.escape(sample_id)}_*.shard*")):
+        match = shard_regex.match(os.path.basename(path))
+        ## of the JSON sidecars, only stats are merged
+        if match is None or (match["ext"] == ".json" and match["stem"] != "dump_stats"):
             continue
+        shard_counts.add(int(match["num"]))
+        parts.setdefault((match["stem"], match["ext"]), {})[int(match["idx"])] = path
+
+    if len(parts) == 0:
+        raise FileNotFoundError(f"No shard outputs found for sample {sample_id} in {indir}.")
+    if len(shard_counts) > 1:
+        raise ValueError(f"Shard outputs for sample {sample_id} in {indir} come from runs with different shard counts: {sorted(shard_counts)}.")
+    num_shards = shard_counts.pop()
+
+    ## refuse to write partial merges
+    for (stem, ext), shard_paths in parts.items():
+        missing = sorted(set(range(1, num_shards + 1)) - set(shard_paths))
+        if missing:
+            raise FileNotFoundError(f"Missing shard(s) {missing} of {num_shards} for {sample_id}_{stem}{ext}.")
+
+    merged = []
+    for (stem, ext), shard_paths in sorted(parts.items()):
+        merged_path = output_path(outdir, sample_id, stem, ext = ext)
+        if ext == ".json":
+            merge_stats([shard_paths[shard_idx] for shard_idx in range(1, num_shards + 1)], merged_path)
+        else:
+            with open(merged_path, "wb") as merged_out:
+                for shard_idx in range(1, num_shards + 1):
+                    with open(shard_paths[shard_idx], "rb") as part:
+                        shutil.copyfileobj(part, merged_out)
+        merged.append(merged_path)
 
-        for taxid in taxids:
-            R1, R2 = outputs[taxid]
-            R1.write(r1.format("fastq"))
-            R2.write(r2.format("fastq"))
+        if not keep_shards:
+            for part_path in shard_paths.values():
+                os.remove(part_path)
 
-    # Close everything
-    for R1, R2 in outputs.values():
-        R1.close()
-        R2.close()
+    logging.info(f"Merged {num_shards} shards into {len(merged)} files at path {outdir}.")
+    return merged
 
 def dump_fastqs(args):
     sample_id = args.sample_id
@@ -56,20 +1120,54 @@ def dump_fastqs(args):
     fq2 = args.fastq2
     outdir = args.outdir
     buffer_size = args.buffer_size
+    shard = parse_shard(args.shard) if args.shard else None
+    stream_taxid = args.stdout_taxid
+    max_reads_per_file = args.max_reads_per_file
+    write_unassigned = args.write_unassigned or args.compress_unassigned
 
     # load tax to reads id dictionary
     tax_to_readids_dict = json.load(open(json_tax_to_readsid_path, "r"))
 
+    if stream_taxid is not None and stream_taxid not in tax_to_readids_dict:
+        logging.critical(f"Taxid {stream_taxid} not found in {json_tax_to_readsid_path}. Quitting...")
+        sys.stderr.write(f"Taxid {stream_taxid} not found in {json_tax_to_readsid_path}. Quitting...\n")
+        sys.exit(1)
+
     ## Check if output directory exists and create if not
     absolute_outdir = os.path.abspath(outdir)
 
     if not os.path.exists(absolute_outdir):
         os.makedirs(absolute_outdir)
 
-    dump_to_files(
-        sample_id,
-        tax_to_readids_dict,
-        fq1,fq2,absolute_outdir,
-        buffer_size=buffer_size
-    )
+    try:
+        dump_to_files(
+            sample_id,
+            tax_to_readids_dict,
+            fq1,fq2,absolute_outdir,
+            buffer_size=buffer_size,
+            shard=shard,
+            stream_taxid=stream_taxid,
+            max_reads_per_file=max_reads_per_file,
+            write_unassigned=write_unassigned,
+            compress_unassigned=args.compress_unassigned,
+            collect_stats=args.stats,
+            checkpoint_every=args.checkpoint_every,
+            resume=args.resume,
+            piece_size=args.piece_size,
+            use_mmap=args.mmap,
+            interleaved=args.interleaved
+        )
+    except BrokenPipeError:
+        ## already reported by dump_to_files
+        sys.exit(1)
 
+def merge_fastqs(args):
+    absolute_outdir = os.path.abspath(args.outdir)
+    indir = os.path.abspath(args.indir) if args.indir else absolute_outdir
+
+    merge_shards(
+        args.sample_id,
+        indir,
+        absolute_outdir,
+        keep_shards=args.keep_shards
+    )
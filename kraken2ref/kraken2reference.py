@@ -1,14 +1,19 @@
 ## python imports
+import io
 import os
 import sys
 import json
 import logging
 import datetime
-import pandas as pd
+import contextlib
+import collections
+import concurrent.futures
 
 ## import package modules
 from kraken2ref.taxonomytree import TaxonomyTree
-from kraken2ref.poll import Poll
+from kraken2ref.poll import BatchPoll
+from kraken2ref.reportstore import ReportStore, gather
+from kraken2ref.topologycache import BlockTopology, TopologyCache
 
 ## retrieve version
 try:
@@ -16,19 +21,81 @@ try:
 except ImportError as ie:
     __version__ = "dev/test"
 
+## number of simple trees (from consecutive species blocks) polled together
+POLL_BATCH_SIZE = 4096
+
+## polling methods, as accepted by `Poll.poll_leaves`
+POLL_METHODS = ("max", "skew", "kmeans", "tiles")
+
+## number of report rows (from consecutive species blocks) analysed by one task of a worker process
+PARALLEL_TASK_ROWS = 16_384
+
+def parse_thresholds(thresholds: str):
+    """Parse a list of thresholds: comma-separated values and/or ranges of the form 'start:stop:step' (stop excluded, as in `range`).
+
+    Args:
+        thresholds (str): Threshold specification, eg. "10,50,100" or "0:1000:100,5000"
+
+    Returns:
+        (list(int)): Sorted, distinct thresholds
+
+    Examples:
+        >>> parse_thresholds("0:300:100,1000")
+        [0, 100, 200, 1000]
+    """
+    parsed = set()
+    try:
+        for part in thresholds.split(","):
+            if ":" in part:
+                parsed.update(range(*(int(i) for i in part.split(":"))))
+            else:
+                parsed.add(int(part))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid thresholds '{thresholds}': expected comma-separated integers and/or 'start:stop:step' ranges, eg. '10,50,0:1000:100'.")
+    if len(parsed) == 0:
+        raise ValueError(f"Invalid thresholds '{thresholds}': no thresholds given.")
+    return sorted(parsed)
+
+def parse_methods(methods: str):
+    """Parse a list of polling methods: comma-separated method names, or "all".
+
+    Args:
+        methods (str): Method specification, eg. "max,kmeans" or "all"
+
+    Returns:
+        (list(str)): Methods, in the order given
+
+    Examples:
+        >>> parse_methods("max,kmeans")
+        ['max', 'kmeans']
+    """
+    if methods.lower() == "all":
+        return list(POLL_METHODS)
+    parsed = []
+    for method in methods.lower().split(","):
+        if method not in POLL_METHODS:
+            raise ValueError(f"Invalid polling method '{method}' in '{methods}': expected 'all' or comma-separated methods from {list(POLL_METHODS)}.")
+        if method not in parsed:
+            parsed.append(method)
+    return parsed
+
 class KrakenProcessor:
     """User-facing driver class to analyse kraken2 taxonomic report
     """
-    def __init__(self, sample_id: str):
+    def __init__(self, sample_id: str, topology_cache: TopologyCache = None):
         """Initialiser
 
         Args:
             sample_id (str): Sample ID
+            topology_cache (TopologyCache, optional): Cache of species block structures to reuse trees from (see `find_simple_trees`). Defaults to None.
         """
 
         ## collect and setup metadata info
         NOW = f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}"
         self.sample_id = sample_id
+        self.topology_cache = topology_cache
+        self.keyed_outputs = False
+        self.poll_summaries = None
 
         self.metadata = {
                             "k2r_version": __version__,
@@ -38,53 +105,113 @@ class KrakenProcessor:
 
         logging.info(f"\nkraken2ref version = {__version__}\nSTARTED = {NOW}\nSample: {sample_id}\n")
 
-    def read_report(self, kraken_report_file: str):
-        """Function to ingest kraken2 taxonomic report
+    def iter_species_blocks(self, kraken_report_file: str, min_reads: int = None):
+        """Generator to ingest kraken2 taxonomic report in a single pass, yielding one species block (tree) at a time.
+            A block is yielded as soon as the next one starts (or the report ends), so that it can be analysed and released
+            before the rest of the report is read: memory is bounded by the largest species block, not the size of the report.
+            The report format (with or without minimizer data) is detected from the number of columns in the first line,
+            and stored in `self.has_minimizer_info` before the first block is yielded.
+            With `min_reads`, blocks whose species node has no more than `min_reads` cumulative reads are skipped without being stored:
+            no node below it can have more reads, so polling could select nothing from them. They are counted in `self.num_skipped_blocks`.
 
         Args:
             kraken_report_file (str/path): Path to kraken2 taxonomic report
+            min_reads (int, optional): Cumulative read count a species must exceed for its block to be yielded. Defaults to None (yield all blocks).
 
-        Returns:
-            kraken_report (pd.DataFrame): Dataframe of kraken2 taxonomic report
-            has_minimizer_info (bool): Whether the input report contains minimizer data
+        Yields:
+            node_list (list(tuple)): Nodes of one species block, e.g. [(10, "S"), (11, "S1"), (12, "S2")...]
+                Each node is represented as a tuple, where:
+                    node[0] = index of that node in the kraken report
+                    node[1] = taxon level of that node ("S"/"S1"/etc)
+            data_dict (ReportStore): Data for the nodes in this block (see `read_report`), stored column-wise
         """
 
         logging.info("Reading report...")
 
-        ## read in kraken report and collect lists of data needed
         self.report_file = kraken_report_file
-        try:
-            kraken_report = pd.read_csv(kraken_report_file, sep = "\t", header = None)
-        except pd.errors.EmptyDataError as empty_file_err:
+        self.has_minimizer_info = None
+        node_list = None
+        columns = []
+        skip_block = False
+        num_blocks = 0
+        self.num_skipped_blocks = 0
+
+        ## index of each node in the report, counting non-blank lines only
+        idx = -1
+        with open(kraken_report_file, "r") as report:
+            for line_num, line in enumerate(report, start = 1):
+                ## skip blank lines (eg. trailing newlines)
+                if line.isspace():
+                    continue
+                idx += 1
+                fields = line.rstrip("\n").split("\t")
+
+                ## detect report format from the first line:
+                ## pct_comp, cumulative_num_reads, unique_num_reads, [cumulative_minimizers, unique_minimizers,] taxon_level, taxon_id, desc_name
+                ## every other line must have the same number of columns
+                if len(fields) not in (6, 8) or (self.has_minimizer_info is not None and len(fields) != num_fields):
+                    logging.critical(f"Provided kraken report at {kraken_report_file} has {len(fields)} columns on line {line_num}, expected 6 or 8. Quitting...\n")
+                    sys.stderr.write(f"Provided kraken report at {kraken_report_file} has {len(fields)} columns on line {line_num}, expected 6 or 8. Quitting...\n")
+                    sys.exit(1)
+                if self.has_minimizer_info is None:
+                    num_fields = len(fields)
+                    self.has_minimizer_info = len(fields) == 8
+                    level_col = 5 if self.has_minimizer_info else 3
+                    ## report columns holding, in order, each value of a data_dict entry
+                    value_cols = (1, 2, 6, 3, 4) if self.has_minimizer_info else (1, 2, 4)
+
+                ## a new block starts at every species-level node, closing the previous one;
+                ## only nodes within blocks are kept
+                taxon_level = fields[level_col]
+                if taxon_level == "S":
+                    if node_list is not None and not skip_block:
+                        yield node_list, ReportStore(node_list, columns)
+                    num_blocks += 1
+                    node_list = []
+                    columns = [[] for col in value_cols]
+                    ## species cumulative reads bound those of every node in its block
+                    skip_block = min_reads is not None and int(fields[1]) <= min_reads
+                    if skip_block:
+                        self.num_skipped_blocks += 1
+                if node_list is None or skip_block or "S" not in taxon_level:
+                    continue
+
+                node_list.append((idx, taxon_level))
+                for column, col in zip(columns, value_cols):
+                    column.append(int(fields[col]))
+
+        ## handle empty file exception
+        if self.has_minimizer_info is None:
             logging.critical(f"Provided kraken report at {kraken_report_file} appears to be empty. Quitting...\n")
             sys.stderr.write(f"Provided kraken report at {kraken_report_file} appears to be empty. Quitting...\n")
             sys.exit(0)
 
-        try:
-            kraken_report.columns = ["pct_comp", "cumulative_num_reads", "unique_num_reads", "cumulative_minimizers", "unique_minimizers", "taxon_level", "taxon_id", "desc_name"]
-            has_minimizer_info = True
-        except Exception as e:
-            kraken_report.columns = ["pct_comp", "cumulative_num_reads", "unique_num_reads", "taxon_level", "taxon_id", "desc_name"]
-            has_minimizer_info = False
+        ## handle no data exception
+        if node_list is None:
+            logging.critical(msg = f"NoDataFoundError: No Data in Report: File {self.report_file} does not contain any usable data.\n")
+            sys.stderr.write(f"NoDataFoundError: No Data in Report: File {self.report_file} does not contain any usable data.\n")
+            sys.exit(0)
 
-        return kraken_report, has_minimizer_info
+        logging.debug(f"Read {num_blocks} species blocks, skipped {self.num_skipped_blocks}.")
+        if not skip_block:
+            yield node_list, ReportStore(node_list, columns)
 
-    def find_node_lists(self, kraken_report: pd.DataFrame, has_minimizer_info: bool):
-        """Collect node-lists from kraken report and populate data dictionary. 
-            Node-lists look like: [[(10, "S"), (11, "S1"), (12, "S2")...], [(167, "S"), (168, "S1")...]]. 
+    def read_report(self, kraken_report_file: str):
+        """Function to ingest the whole kraken2 taxonomic report, collecting node-lists and populating the data dictionary.
+            See `iter_species_blocks` to analyse very large reports one species block at a time.
+            Node-lists look like: [[(10, "S"), (11, "S1"), (12, "S2")...], [(167, "S"), (168, "S1")...]].
             For more, see description of `all_nodes_list` below
 
         Args:
-            kraken_report (pd.DataFrame): Dataframe of kraken2 taxonomic report
-            has_minimizer_info (bool): Whether the input report contains minimizer data
+            kraken_report_file (str/path): Path to kraken2 taxonomic report
 
         Returns:
             all_nodes_list (list(list(tuple))): List of nodes (from species level - "S" - onward only)
                 Each node is represented as a tuple, where:
                     node[0] = index of that node in the kraken report
                     node[1] = taxon level of that node ("S"/"S1"/etc)
-            data_dict (dict): Dictionary representation of kraken report (from species level - "S" - onward only)
-                                The contents of the data_dict are:
+            data_dict (ReportStore): Dictionary-like representation of kraken report (from species level - "S" - onward only),
+                                backed by one NumPy array per column (see `ReportStore`). The contents of the data_dict are:
                                     key = node (node is a tuple as described above)
                                     value = tuple, where
                                         value[0] = cumulative number of reads assigned to that node and its children nodes
@@ -93,40 +220,18 @@ class KrakenProcessor:
                                         if has_minimizer_info:
                                             value[3] = cumulative number of minimizers assigned to that node
                                             value[4] = number of unique minimizers assigned to that node
+            has_minimizer_info (bool): Whether the input report contains minimizer data
         """
 
-        logging.info("Collecting node lists and data...")
-
-        ## collect all nodes in kraken report
-        nodes = list(zip(kraken_report.index, kraken_report["taxon_level"]))
-
-        ## populate data
-        if has_minimizer_info:
-            data = list(zip(kraken_report["cumulative_num_reads"], kraken_report[ "unique_num_reads"], kraken_report["taxon_id"], kraken_report["cumulative_minimizers"], kraken_report["unique_minimizers"]))
-        else:
-            data = list(zip(kraken_report["cumulative_num_reads"], kraken_report[ "unique_num_reads"], kraken_report["taxon_id"]))
-
-        ## construct data_dict
-        data_dict = dict(zip(nodes, data))
-
-        ## populate node_lists, identifying trees in the report
         all_node_lists = []
-        for k in data_dict.keys():
-            if k[1] == "S":
-                all_node_lists.append([])
-            if all_node_lists:
-                if "S" in k[1]:
-                    all_node_lists[-1].append(k)
-
-        ## handle no data exception
-        if len(all_node_lists) == 0:
-            logging.critical(msg = f"NoDataFoundError: No Data in Report: File {self.report_file} does not contain any usable data.\n")
-            sys.stderr.write(f"NoDataFoundError: No Data in Report: File {self.report_file} does not contain any usable data.\n")
-            sys.exit(0)
+        block_stores = []
+        for node_list, block_store in self.iter_species_blocks(kraken_report_file):
+            all_node_lists.append(node_list)
+            block_stores.append(block_store)
 
-        return all_node_lists, data_dict
+        return all_node_lists, ReportStore.concat(block_stores), self.has_minimizer_info
 
-    def analyse_report(self, input_kraken_report_file: str, input_threshold: int, input_method: str, quiet: bool = False):
+    def analyse_report(self, input_kraken_report_file: str, input_threshold: int, input_method: str, quiet: bool = False, threads: int = 1):
         """Driver function to read kraken report, collect data from it, and analyse it to pick references
 
         Args:
@@ -134,6 +239,7 @@ class KrakenProcessor:
             input_threshold (int): Minimum number of reads required to pass a leaf node as valid
             input_method (str): Polling method to apply ["kmeans", "tiles", "skew"]
             quiet (bool, optional): _description_. Defaults to False.
+            threads (int, optional): Number of worker processes to analyse species blocks with (see `analyse_blocks_in_parallel`). Defaults to 1.
 
         Returns:
             tree_meta_out: Dictionary containing output info. This is written to the output JSON file.
@@ -144,147 +250,448 @@ class KrakenProcessor:
         ## add threshold value to metadata
         self.metadata["threshold"] = input_threshold
 
-        ## get kraken report
-        kraken_report, has_minimizer_info = self.read_report(kraken_report_file = input_kraken_report_file)
-        self._log_to_stderr(f"{has_minimizer_info = }\n", quiet)
+        ## initialise output dict
+        self.tree_meta_out = {}
 
-        ## generate node_lists and data_dict
-        all_node_lists, data_dict = self.find_node_lists(kraken_report = kraken_report, has_minimizer_info = has_minimizer_info)
+        ## poll simple trees from the report, batch by batch, or spread blocks across worker processes
+        if threads > 1:
+            self.analyse_blocks_in_parallel(kraken_report_file = input_kraken_report_file, input_threshold = input_threshold, input_method = input_method, quiet = quiet, threads = threads)
+        else:
+            for simple_trees, data_dict, species_reads in self.iter_simple_tree_batches(kraken_report_file = input_kraken_report_file, min_reads = input_threshold, quiet = quiet):
+                self.tree_meta_out.update(self.poll_simple_trees(simple_trees = simple_trees, data_dict = data_dict, input_threshold = input_threshold, input_method = input_method, quiet = quiet))
 
-        ## iterate over node_lists
-        ### create trees from each node list
-        ### if tree complexity == 0: add to list of simple trees
-        ### if not, then add subtrees to the list of simple trees
+        ## record how many species blocks were skipped
+        self.metadata["skipped_blocks"] = self.num_skipped_blocks
+        logging.info(f"Skipped {self.num_skipped_blocks} species blocks with no more than {input_threshold} reads.")
+        if self.topology_cache is not None:
+            logging.info(f"Topology cache: {self.topology_cache.hits} species blocks found, {self.topology_cache.misses} built.")
+
+        logging.info("---")
+
+        return self.tree_meta_out
+
+    def analyse_blocks_in_parallel(self, kraken_report_file: str, input_threshold: int, input_method: str, quiet: bool = False, threads: int = 2):
+        """Analyse the species blocks of a report in a pool of worker processes, adding results to `self.tree_meta_out` in report order.
+            Consecutive blocks are grouped into tasks of about PARALLEL_TASK_ROWS report rows, so that tasks are of similar size,
+            and each task only carries the data for its own blocks. At most 2 tasks per worker are pending at any time, so memory stays bounded.
+            Progress messages of each task are written to stderr when its results are merged, so they stay in report order.
+
+        Args:
+            kraken_report_file (str/path): Path to kraken2 taxonomic report
+            input_threshold (int): Minimum number of reads required to pass a leaf node as valid
+            input_method (str): Polling method to apply ["kmeans", "tiles", "skew"]
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+            threads (int, optional): Number of worker processes. Defaults to 2.
+        """
+
+        def merge(task):
+            tree_meta_chunk, messages, new_topologies, cache_hits, cache_misses = task.result()
+            self.tree_meta_out.update(tree_meta_chunk)
+            self._log_to_stderr(messages, quiet)
+            ## block structures found by workers are added to this process's cache, to be saved
+            if self.topology_cache is not None:
+                self.topology_cache.update(new_topologies)
+                self.topology_cache.hits += cache_hits
+                self.topology_cache.misses += cache_misses
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers = threads, initializer = _init_worker, initargs = (self.sample_id, self.topology_cache)) as executor:
+            pending = collections.deque()
+            node_lists = []
+            block_stores = []
+            num_rows = 0
+            for block_idx, (node_list, data_dict) in enumerate(self.iter_species_blocks(kraken_report_file = kraken_report_file, min_reads = input_threshold)):
+                if block_idx == 0:
+                    self._log_to_stderr(f"has_minimizer_info = {self.has_minimizer_info}\n", quiet)
+                node_lists.append(node_list)
+                block_stores.append(data_dict)
+                num_rows += len(node_list)
+                if num_rows >= PARALLEL_TASK_ROWS:
+                    pending.append(executor.submit(_analyse_blocks, node_lists, ReportStore.concat(block_stores), input_threshold, input_method, quiet))
+                    node_lists = []
+                    block_stores = []
+                    num_rows = 0
+                    ## merge finished results in submission (report) order
+                    while len(pending) >= 2 * threads or (len(pending) > 0 and pending[0].done()):
+                        merge(pending.popleft())
+            if len(node_lists) > 0:
+                pending.append(executor.submit(_analyse_blocks, node_lists, ReportStore.concat(block_stores), input_threshold, input_method, quiet))
+            while len(pending) > 0:
+                merge(pending.popleft())
+
+    def sweep_thresholds(self, input_kraken_report_file: str, input_thresholds: list, input_method: str, quiet: bool = False):
+        """Driver function to analyse a kraken report with several thresholds at once, e.g. to calibrate the threshold.
+            The report is read and its trees are built and decomposed once; only polling is repeated for each threshold.
+
+        Args:
+            input_kraken_report_file (str): Path to kraken2 taxonomic report
+            input_thresholds (list(int)): Minimum numbers of reads required to pass a leaf node as valid
+            input_method (str): Polling method to apply ["kmeans", "tiles", "skew"]
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+
+        Returns:
+            tree_meta_out: Dictionary of output info (as returned by `analyse_report`) for each threshold. This is written to the output JSON file.
+        """
+
+        logging.info("Analysing report with threshold sweep...")
+
+        ## add thresholds to metadata
+        thresholds = sorted(set(input_thresholds))
+        self.keyed_outputs = True
+        self.metadata["thresholds"] = thresholds
+
+        ## initialise output dict
+        self.tree_meta_out = {threshold: {} for threshold in thresholds}
+        skipped_blocks = {threshold: 0 for threshold in thresholds}
+
+        ## blocks skipped at the lowest threshold are skipped at all of them;
+        ## the leaf data of each batch of simple trees is gathered once, and shared by all thresholds
+        for simple_trees, data_dict, species_reads in self.iter_simple_tree_batches(kraken_report_file = input_kraken_report_file, min_reads = thresholds[0], quiet = quiet):
+            ## so are output entries, for references selected at more than one threshold
+            batch = BatchPoll(taxonomy_trees = simple_trees, data_dict = data_dict, threshold = thresholds[0])
+            meta_cache = {}
+            for threshold in thresholds:
+                threshold_batch = batch.at_threshold(threshold)
+                threshold_batch.poll_leaves(method = input_method)
+                self.tree_meta_out[threshold].update(self.collect_tree_meta(batch = threshold_batch, data_dict = data_dict, quiet = quiet, meta_cache = meta_cache))
+                skipped_blocks[threshold] += sum(reads <= threshold for reads in species_reads)
+
+        ## record how many species blocks would have been skipped for each threshold
+        self.metadata["skipped_blocks"] = {threshold: self.num_skipped_blocks + skipped for threshold, skipped in skipped_blocks.items()}
+
+        logging.info("---")
+
+        return self.tree_meta_out
+
+    def compare_methods(self, input_kraken_report_file: str, input_threshold: int, input_methods: list, quiet: bool = False):
+        """Driver function to analyse a kraken report with several polling methods at once, to compare them.
+            The report is read, its trees are built and decomposed, and their polling inputs are set up once; only polling is repeated for each method.
+
+        Args:
+            input_kraken_report_file (str): Path to kraken2 taxonomic report
+            input_threshold (int): Minimum number of reads required to pass a leaf node as valid
+            input_methods (list(str)): Polling methods to apply, from ["max", "skew", "kmeans", "tiles"]
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+
+        Returns:
+            tree_meta_out: Dictionary of output info (as returned by `analyse_report`) for each method. This is written to the output JSON file.
+        """
 
-        ## polling functions expect simple trees
+        logging.info("Analysing report with each polling method...")
+
+        ## add threshold and methods to metadata
+        self.keyed_outputs = True
+        self.metadata["threshold"] = input_threshold
+        self.metadata["methods"] = input_methods
+
+        ## initialise output dicts: selections for each method, and results of each method side by side for each polled tree
+        self.tree_meta_out = {method: {} for method in input_methods}
+        self.poll_summaries = []
+
+        for simple_trees, data_dict, species_reads in self.iter_simple_tree_batches(kraken_report_file = input_kraken_report_file, min_reads = input_threshold, quiet = quiet):
+            batch = BatchPoll(taxonomy_trees = simple_trees, data_dict = data_dict, threshold = input_threshold)
+            meta_cache = {}
+            method_batches = {}
+            for method in input_methods:
+                method_batches[method] = batch.copy()
+                method_batches[method].poll_leaves(method = method)
+                self.tree_meta_out[method].update(self.collect_tree_meta(batch = method_batches[method], data_dict = data_dict, quiet = quiet, meta_cache = meta_cache))
+            self.poll_summaries.extend(self._summarise_polls(method_batches = method_batches, data_dict = data_dict))
+
+        ## record how many species blocks were skipped
+        self.metadata["skipped_blocks"] = self.num_skipped_blocks
+
+        logging.info("---")
+
+        return self.tree_meta_out
+
+    def _summarise_polls(self, method_batches: dict, data_dict: dict):
+        """Summarise the results of each method for each polled tree of a batch (trees with more than one valid leaf node; for others, results do not depend on the method)
+
+        Args:
+            method_batches (dict): BatchPoll of the same trees, polled with each method
+            data_dict (dict/ReportStore): Data for (at least) the nodes in these trees
+
+        Returns:
+            poll_summaries (list(dict)): Summary for each polled tree, with selected taxIDs, `class_method` and entropies for each method
+        """
+        poll_summaries = []
+        batch = next(iter(method_batches.values()))
+        for idx in batch.polled.tolist():
+            simple_tree_root = batch.trees[idx].root
+            poll_summaries.append({
+                                    "graph_idx": simple_tree_root[0],
+                                    "source": simple_tree_root,
+                                    "source_taxid": data_dict[simple_tree_root][2],
+                                    "methods": {
+                                        method: {
+                                            "selected": gather(data_dict, 2, method_batch.filt_leaves[idx]),
+                                            "class_method": method_batch.class_method[idx],
+                                            "surprise_prefilter": float(method_batch.surprise_prefilter[idx]),
+                                            "postfilter_surprise": float(method_batch.postfilter_surprise[idx]),
+                                        } for method, method_batch in method_batches.items()
+                                    }
+                                })
+        return poll_summaries
+
+    def iter_simple_tree_batches(self, kraken_report_file: str, min_reads: int = None, quiet: bool = False):
+        """Generator to read a kraken report and decompose its species blocks into simple trees, yielding them in batches.
+            Blocks whose species does not pass `min_reads` cannot yield any reference, and are skipped before building trees (see `iter_species_blocks`).
+            A batch holds (at least) POLL_BATCH_SIZE simple trees from consecutive blocks, and is released before reading on.
+
+        Args:
+            kraken_report_file (str/path): Path to kraken2 taxonomic report
+            min_reads (int, optional): Cumulative read count a species must exceed for its block to be analysed. Defaults to None (analyse all blocks).
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+
+        Yields:
+            simple_trees (list(TaxonomyTree)): Simple trees of a batch of consecutive species blocks
+            data_dict (ReportStore): Data for the nodes of these blocks
+            species_reads (list(int)): Cumulative reads of the species of these blocks
+        """
         simple_trees = []
-        for node_list in all_node_lists:
-            ## make tree from node list
+        block_stores = []
+        species_reads = []
+        for block_idx, (node_list, data_dict) in enumerate(self.iter_species_blocks(kraken_report_file = kraken_report_file, min_reads = min_reads)):
+            if block_idx == 0:
+                self._log_to_stderr(f"has_minimizer_info = {self.has_minimizer_info}\n", quiet)
+            simple_trees.extend(self.find_simple_trees(node_list = node_list, quiet = quiet, data_dict = data_dict))
+            block_stores.append(data_dict)
+            species_reads.append(data_dict[node_list[0]][0])
+            if len(simple_trees) >= POLL_BATCH_SIZE:
+                yield simple_trees, ReportStore.concat(block_stores), species_reads
+                simple_trees = []
+                block_stores = []
+                species_reads = []
+        if len(simple_trees) > 0:
+            yield simple_trees, ReportStore.concat(block_stores), species_reads
+
+    def analyse_species_block(self, node_list: list, data_dict: dict, input_threshold: int, input_method: str, quiet: bool = False):
+        """Analyse one species block to pick references: build its tree, decompose it into simple trees and poll them
+
+        Args:
+            node_list (list(tuple)): Nodes of one species block, as yielded by `iter_species_blocks`
+            data_dict (dict/ReportStore): Data for (at least) the nodes in this block
+            input_threshold (int): Minimum number of reads required to pass a leaf node as valid
+            input_method (str): Polling method to apply ["kmeans", "tiles", "skew"]
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+
+        Returns:
+            tree_meta_chunk: The chunk of the output dict for references selected from this block
+        """
+        simple_trees = self.find_simple_trees(node_list = node_list, quiet = quiet, data_dict = data_dict)
+        return self.poll_simple_trees(simple_trees = simple_trees, data_dict = data_dict, input_threshold = input_threshold, input_method = input_method, quiet = quiet)
+
+    def find_simple_trees(self, node_list: list, quiet: bool = False, data_dict: dict = None):
+        """Build the tree of one species block and decompose it into simple trees, which is what polling expects.
+            With a topology cache (and `data_dict`), a block with the same taxIDs and levels as one seen before
+            is set up from its cached structure instead, and the structure of a new block is added to the cache.
+
+        Args:
+            node_list (list(tuple)): Nodes of one species block, as yielded by `iter_species_blocks`
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+            data_dict (dict/ReportStore, optional): Data for (at least) the nodes in this block, to look it up in the topology cache. Defaults to None.
+
+        Returns:
+            simple_trees (list(TaxonomyTree)): The tree itself if its complexity is 0, otherwise all of its simple subtrees
+        """
+
+        ## look up the block's structure
+        topology = None
+        if self.topology_cache is not None and data_dict is not None:
+            block_key, taxids = self.topology_cache.block_key(node_list, data_dict)
+            topology = self.topology_cache.get(block_key, len(node_list))
+
+        ## make tree from node list
+        ### if tree complexity == 0: add to list of simple trees
+        ### if not, then add subtrees to the list of simple trees
+        if topology is not None:
+            complexity = topology.complexity
+            simple_trees = topology.simple_trees(node_list, taxids)
+        else:
             tree = TaxonomyTree(nodes = node_list)
+            complexity = tree.complexity
+            simple_trees = [tree] if complexity == 0 else [TaxonomyTree(tree = subtree) for subtree in tree.subgraphs]
+            if self.topology_cache is not None and data_dict is not None:
+                topology = BlockTopology.from_trees(node_list, tree, simple_trees)
+                if topology is not None:
+                    self.topology_cache.add(block_key, topology)
+        root = node_list[0]
+
+        ## tree complexity is 0, it is ready to be analysed
+        if complexity == 0:
+            self._log_to_stderr(f"Adding tree rooted at {root} to simple_trees.\n", quiet)
+            logging.debug(f"Adding tree rooted at {root} to simple_trees.\n")
+
+        ## if not, all subtrees in this tree are considered instead
+        else:
+            num_simple_trees_in_tree = len(simple_trees)
+            logging.debug(f"Tree rooted at {root} contains {num_simple_trees_in_tree} simple sub-trees.")
+            self._log_to_stderr(f"Tree rooted at {root} contains {num_simple_trees_in_tree} simple sub-trees.\n", quiet)
 
-            ## tree complexity is 0, it is ready to be analysed
-            if tree.complexity == 0:
-                self._log_to_stderr(f"Adding tree rooted at {tree.root} to simple_trees.\n", quiet)
-                logging.debug(f"Adding tree rooted at {tree.root} to simple_trees.\n")
-                simple_trees.append(tree)
+        return simple_trees
 
-            ## if not, all subtrees in this tree are considered instead
-            else:
-                num_simple_trees_in_tree = len(tree.subgraphs)
-                logging.debug(f"Tree rooted at {tree.root} contains {num_simple_trees_in_tree} simple sub-trees.")
-                self._log_to_stderr(f"Tree rooted at {tree.root} contains {num_simple_trees_in_tree} simple sub-trees.\n", quiet)
-                simple_trees.extend([TaxonomyTree(tree = subtree) for subtree in tree.subgraphs])
+    def poll_simple_trees(self, simple_trees: list, data_dict: dict, input_threshold: int, input_method: str, quiet: bool = False):
+        """Poll a batch of simple trees at once (see `BatchPoll`) and collect the selected references
 
-        logging.info("---")
+        Args:
+            simple_trees (list(TaxonomyTree)): Simple trees to poll, e.g. from `find_simple_trees`
+            data_dict (dict/ReportStore): Data for (at least) the nodes in these trees
+            input_threshold (int): Minimum number of reads required to pass a leaf node as valid
+            input_method (str): Polling method to apply ["kmeans", "tiles", "skew"]
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
 
-        ## initialise output dict
-        self.tree_meta_out = {}
+        Returns:
+            tree_meta_chunk: The chunk of the output dict for references selected from these trees
+        """
 
-        ## iterate over trees in list simple_trees
-        ### poll each tree and collect outputs
-        for simple_tree in simple_trees:
-            simple_tree_root = simple_tree.root
+        ## poll all trees together
+        batch = BatchPoll(taxonomy_trees = simple_trees, data_dict = data_dict, threshold = input_threshold)
+        logging.debug(f"Now selecting reference(s) using method = {input_method}\n")
+        batch.poll_leaves(method = input_method)
 
-            ## loging
-            logging.debug(f"Now polling simple tree rooted at {simple_tree_root}")
-            logging.debug(f"Subterminals are: {simple_tree.subterminal_nodes}")
-            self._log_to_stderr(f"Now polling simple tree rooted at {simple_tree_root}\n", quiet)
-            self._log_to_stderr(f"Subterminals are: {simple_tree.subterminal_nodes}\n", quiet)
+        return self.collect_tree_meta(batch = batch, data_dict = data_dict, quiet = quiet)
 
-            ## create a poll object
-            poll = Poll(taxonomy_tree = simple_tree, data_dict = data_dict, threshold = input_threshold)
+    def collect_tree_meta(self, batch: BatchPoll, data_dict: dict, quiet: bool = False, meta_cache: dict = None):
+        """Collect the references selected from a polled batch of simple trees
+
+        Args:
+            batch (BatchPoll): Batch of simple trees, after `poll_leaves`
+            data_dict (dict/ReportStore): Data for (at least) the nodes in these trees
+            quiet (bool, optional): Whether to suppress progress messages on stderr. Defaults to False.
+            meta_cache (dict, optional): Cache of output entries for these trees (see `_update_tree_meta`). Defaults to None.
+
+        Returns:
+            tree_meta_chunk: The chunk of the output dict for references selected from these trees
+        """
+        simple_trees = batch.trees
+        input_threshold = batch.threshold
+
+        ## per-tree messages are only formatted if they are shown, and written to stderr once for the whole batch
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        messages = []
+
+        ## initialise output chunk
+        tree_meta_chunk = {}
+
+        ## iterate over trees in list simple_trees
+        ### collect outputs of each tree
+        for idx, simple_tree in enumerate(simple_trees):
+            simple_tree_root = simple_tree.root
+            singleton = bool(batch.singleton[idx])
+            parent_selected = bool(batch.parent_selected[idx])
 
             ## logging
-            logging.debug(f"{poll.singleton = }")
-            logging.debug(f"Number of leaves = {len(poll.leaves)}")
-            self._log_to_stderr(f"{poll.singleton = }\n", quiet)
-            self._log_to_stderr(f"Number of leaves = {len(poll.leaves)}\n", quiet)
+            if debug:
+                logging.debug(f"Now polling simple tree rooted at {simple_tree_root}")
+                logging.debug(f"Subterminals are: {simple_tree.subterminal_nodes}")
+                logging.debug(f"poll.singleton = {singleton}")
+                logging.debug(f"Number of leaves = {len(simple_tree.leaf_nodes)}")
+            if not quiet:
+                messages.append(f"Now polling simple tree rooted at {simple_tree_root}\n")
+                messages.append(f"Subterminals are: {simple_tree.subterminal_nodes}\n")
+                messages.append(f"poll.singleton = {singleton}\n")
+                messages.append(f"Number of leaves = {len(simple_tree.leaf_nodes)}\n")
 
             ## if only one valid leaf node in tree, update output dict with it
-            if poll.singleton:
-                self.tree_meta_out.update(self._update_tree_meta(filt_leaves = poll.valid_leaves, simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = poll.parent_selected))
+            if singleton:
+                tree_meta_chunk.update(self._update_tree_meta(filt_leaves = batch.valid_leaves[idx], simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = parent_selected, meta_cache = meta_cache))
 
                 ## logging
-                logging.debug(f"Only one valid node found. Not polling.\n")
-                self._log_to_stderr(f"Only one valid node found. Not polling.\n\n", quiet)
+                if debug:
+                    logging.debug(f"Only one valid node found. Not polling.\n")
+                if not quiet:
+                    messages.append(f"Only one valid node found. Not polling.\n\n")
 
                 continue
 
             ## if no valid leaf nodes found, check if parent is valid
-            if poll.parent_selected:
+            if parent_selected:
                 ## logging
-                logging.debug(f"No leaf nodes passed the minimum read threshold: {input_threshold}.")
-                self._log_to_stderr(f"No leaf nodes passed the minimum read threshold: {input_threshold}.\n", quiet)
+                if debug:
+                    logging.debug(f"No leaf nodes passed the minimum read threshold: {input_threshold}.")
+                if not quiet:
+                    messages.append(f"No leaf nodes passed the minimum read threshold: {input_threshold}.\n")
 
                 ## if parent is valid, add info to output dict
-                if poll.valid_parent:
-                    selected_nodes = poll.max_leaves
-                    if len(selected_nodes) == 1:
-                        self.tree_meta_out.update(self._update_tree_meta(filt_leaves = selected_nodes, simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = poll.parent_selected))
-                    else:
-                        self.tree_meta_out.update(self._update_tree_meta(filt_leaves = [selected_nodes[0]], simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = poll.parent_selected))
-
+                if batch.valid_parent[idx]:
+                    selected_nodes = batch.max_leaves[idx]
+                    tree_meta_chunk.update(self._update_tree_meta(filt_leaves = selected_nodes[:1], simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = parent_selected, meta_cache = meta_cache))
 
                     ## logging
-                    logging.debug(f"Jumped up 1 level, selected parent node: {poll.valid_subterminals}.\n")
-                    self._log_to_stderr(f"Jumped up 1 level, selected parent node: {poll.valid_subterminals}.\n\n", quiet)
-
-                    continue
+                    if debug:
+                        logging.debug(f"Jumped up 1 level, selected parent node: {batch.valid_subterminals[idx]}.\n")
+                    if not quiet:
+                        messages.append(f"Jumped up 1 level, selected parent node: {batch.valid_subterminals[idx]}.\n\n")
 
                 ## if no valid leaves and parent not valid, skip
                 else:
                     ## logging
-                    logging.debug(f"Jumped up 1 level, parent node did not pass threshold. No data passed on from this graph, rooted at {simple_tree_root}.\n")
-                    self._log_to_stderr(f"Jumped up 1 level, parent node did not pass threshold. No data passed on from this graph, rooted at {simple_tree_root}.\n\n", quiet)
+                    if debug:
+                        logging.debug(f"Jumped up 1 level, parent node did not pass threshold. No data passed on from this graph, rooted at {simple_tree_root}.\n")
+                    if not quiet:
+                        messages.append(f"Jumped up 1 level, parent node did not pass threshold. No data passed on from this graph, rooted at {simple_tree_root}.\n\n")
 
-                    continue
-
-            ## if >1 valid leaf nodes found, run polling
-            else:
-                logging.debug(f"Now selecting reference(s) using method = {input_method}\n")
-                poll.poll_leaves(method = input_method)
+                continue
 
-                ## logging
-                logging.debug(f"Valid leaves = {poll.valid_leaves}\n")
-                self._log_to_stderr(f"Valid leaves = {poll.valid_leaves}\n", quiet)
+            ## if >1 valid leaf nodes found, polling results are ready
+            filt_leaves = batch.filt_leaves[idx]
 
-                ## if polling returned no leaf nodes, handle and skip
-                if len(poll.filt_leaves) == 0:
+            ## logging
+            if debug:
+                logging.debug(f"Valid leaves = {batch.valid_leaves[idx]}\n")
+            if not quiet:
+                messages.append(f"Valid leaves = {batch.valid_leaves[idx]}\n")
+
+            ## if polling returned no leaf nodes, handle and skip
+            if len(filt_leaves) == 0:
+                if debug:
                     logging.debug(f"No leaf nodes passed polling")
-                    self._log_to_stderr(f"No leaf nodes passed polling.\n\n", quiet)
-                    continue
+                if not quiet:
+                    messages.append(f"No leaf nodes passed polling.\n\n")
+                continue
 
-                ## update output dict sith polling results
-                self.tree_meta_out.update(self._update_tree_meta(filt_leaves = poll.filt_leaves, simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = poll.parent_selected))
+            ## update output dict sith polling results
+            tree_meta_chunk.update(self._update_tree_meta(filt_leaves = filt_leaves, simple_source_tree = simple_tree, data_dict = data_dict, parent_selected = parent_selected, meta_cache = meta_cache))
 
-                ## logging
-                logging.debug(f"Filtered leaves = {poll.filt_leaves}\n")
-                self._log_to_stderr(f"{poll.filt_leaves = }\n\n", quiet)
+            ## logging
+            if debug:
+                logging.debug(f"Filtered leaves = {filt_leaves}\n")
+            if not quiet:
+                messages.append(f"poll.filt_leaves = {filt_leaves}\n\n")
 
-        return self.tree_meta_out
+        self._log_to_stderr("".join(messages), quiet)
+
+        return tree_meta_chunk
 
-    def _update_tree_meta(self, filt_leaves: list, simple_source_tree: TaxonomyTree, data_dict: dict, parent_selected: bool):
+    def _update_tree_meta(self, filt_leaves: list, simple_source_tree: TaxonomyTree, data_dict: dict, parent_selected: bool, meta_cache: dict = None):
         """Function to encapsulate output dict updates 
             Produces dictionary slices that are added to the main `tree_meta_out` dictionary every time it is called by the `analyse_report` method 
 
         Args:
             filt_leaves (list): List of leaf nodes that passed the polling
             simple_source_tree (TaxonomyTree): Tree for which updates are being written
-            data_dict (dict): data_dict as described above
+            data_dict (dict/ReportStore): data_dict as described above
             parent_selected (bool): Whether the filt_leaf provided is a parent (non-terminal) node
+            meta_cache (dict, optional): Entries already produced for trees that are still alive, reused instead of being rebuilt
+                                            (e.g. when the same trees are polled with several thresholds). Defaults to None (no caching).
 
         Returns:
             tree_meta_chunk: The chunk of the output dict generated for the input leaf nodes
         """
         tree_meta_chunk = {}
+        if meta_cache is not None:
+            cache_keys = [(id(simple_source_tree), filt_leaf, parent_selected) for filt_leaf in filt_leaves]
+            if all(cache_key in meta_cache for cache_key in cache_keys):
+                tree_meta_chunk.update(meta_cache[cache_key] for cache_key in cache_keys)
+                return tree_meta_chunk
+        simple_tree_root = simple_source_tree.root ## root node
+        simple_tree_root_taxid = data_dict[simple_tree_root][2] ## root taxID
+        simple_tree_idx = simple_tree_root[0] ## tree_idx
+        all_taxa_in_simple_tree = simple_source_tree.get_taxids(data_dict) ## all taxIDs in this simple (sub)tree
         for filt_leaf in filt_leaves:
-            simple_tree_root = simple_source_tree.root ## root node
-            simple_tree_root_taxid = data_dict[simple_tree_root][2] ## root taxID
             meta_key = data_dict[filt_leaf][2] ## taxID
-            simple_tree_idx = simple_tree_root[0] ## tree_idx
-            all_taxa_in_simple_tree = [data_dict[node][2] for node in simple_source_tree.nodes] ## all taxIDs in this simple (sub)tree
-            path_to_filt_leaf = simple_source_tree.find_all_paths(graph = simple_source_tree.graph, source = simple_tree_root, target = filt_leaf)[0] ## path as nodes
-            path_as_taxids = [data_dict[i][2] for i in path_to_filt_leaf] ## path as taxIDs
+            path_to_filt_leaf = simple_source_tree.find_path(filt_leaf) ## path as nodes
+            path_as_taxids = gather(data_dict, 2, path_to_filt_leaf) ## path as taxIDs
             tree_meta_chunk[meta_key] = {
                                                 "graph_idx": simple_tree_idx,
                                                 "source": simple_tree_root,
@@ -295,6 +702,8 @@ class KrakenProcessor:
                                                 "path": path_to_filt_leaf,
                                                 "path_as_taxids": path_as_taxids,
                                             }
+            if meta_cache is not None:
+                meta_cache[(id(simple_source_tree), filt_leaf, parent_selected)] = (meta_key, tree_meta_chunk[meta_key])
 
         return tree_meta_chunk
 
@@ -318,8 +727,14 @@ class KrakenProcessor:
         outfile_path = os.path.join(prefix, outfile_name)
 
         ## collect and organise data to be output
-        selected_refs = list(self.tree_meta_out.keys())
-        if len(selected_refs) == 0:
+        ## (for a threshold sweep or method comparison, selected references are listed for each threshold/method)
+        if self.keyed_outputs:
+            selected_refs = {threshold: list(tree_meta.keys()) for threshold, tree_meta in self.tree_meta_out.items()}
+            num_selected = sum(len(refs) for refs in selected_refs.values())
+        else:
+            selected_refs = list(self.tree_meta_out.keys())
+            num_selected = len(selected_refs)
+        if num_selected == 0:
             logging.warning(f"No suitable references found in sample: {self.sample_id}.")
             sys.exit(0)
 
@@ -328,6 +743,8 @@ class KrakenProcessor:
                     "metadata": self.metadata,
                     "outputs": self.tree_meta_out
                     }
+        if self.poll_summaries is not None:
+            to_file["polls"] = self.poll_summaries
 
         with open(outfile_path, "w") as outfile:
             json.dump(to_file, outfile, indent=4)
@@ -344,3 +761,44 @@ class KrakenProcessor:
             return
         sys.stderr.write(message)
 
+def _init_worker(sample_id: str, topology_cache: TopologyCache = None):
+    """Set up a worker process for `KrakenProcessor.analyse_blocks_in_parallel`
+
+    Args:
+        sample_id (str): Sample ID
+        topology_cache (TopologyCache, optional): Cache of species block structures (a copy of the main process's). Defaults to None.
+    """
+    global _worker_processor
+    ## only structures found in this worker are passed back
+    if topology_cache is not None:
+        topology_cache.take_new()
+    _worker_processor = KrakenProcessor(sample_id, topology_cache = topology_cache)
+
+def _analyse_blocks(node_lists: list, data_dict: ReportStore, input_threshold: int, input_method: str, quiet: bool):
+    """Analyse consecutive species blocks in a worker process (see `KrakenProcessor.analyse_blocks_in_parallel`)
+
+    Args:
+        node_lists (list(list(tuple))): Nodes of each species block
+        data_dict (ReportStore): Data for the nodes of these blocks
+        input_threshold (int): Minimum number of reads required to pass a leaf node as valid
+        input_method (str): Polling method to apply ["kmeans", "tiles", "skew"]
+        quiet (bool): Whether to suppress progress messages
+
+    Returns:
+        tree_meta_chunk: The chunk of the output dict for references selected from these blocks
+        messages (str): Progress messages, to be written to stderr by the main process
+        new_topologies (dict): Structures of blocks added to the worker's topology cache, to be added to the main process's
+        cache_hits (int): Number of blocks found in the topology cache
+        cache_misses (int): Number of blocks not found in the topology cache
+    """
+    topology_cache = _worker_processor.topology_cache
+    if topology_cache is not None:
+        topology_cache.hits = topology_cache.misses = 0
+    messages = io.StringIO()
+    with contextlib.redirect_stderr(messages):
+        simple_trees = [simple_tree for node_list in node_lists for simple_tree in _worker_processor.find_simple_trees(node_list = node_list, quiet = quiet, data_dict = data_dict)]
+        tree_meta_chunk = _worker_processor.poll_simple_trees(simple_trees = simple_trees, data_dict = data_dict, input_threshold = input_threshold, input_method = input_method, quiet = quiet)
+    if topology_cache is None:
+        return tree_meta_chunk, messages.getvalue(), {}, 0, 0
+    return tree_meta_chunk, messages.getvalue(), topology_cache.take_new(), topology_cache.hits, topology_cache.misses
+
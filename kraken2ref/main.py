@@ -4,9 +4,10 @@ import logging
 import argparse
 
 ## import driver module
-from kraken2ref.kraken2reference import KrakenProcessor
+from kraken2ref.kraken2reference import KrakenProcessor, parse_thresholds, parse_methods
+from kraken2ref.topologycache import TopologyCache, database_fingerprint
 from kraken2ref.sort_reads import sort_reads_by_tax
-from kraken2ref.dump_fastqs import dump_fastqs
+from kraken2ref.dump_fastqs import dump_fastqs, merge_fastqs
 import io
 
 ## collect version
@@ -73,6 +74,51 @@ def collect_args():
         help = """Which polling method to use. [str] [Default = 'max']
                     Valid choices: ['max', 'skew', 'kmeans', 'tiles']""")
 
+    report_parser.add_argument(
+        '--threads',
+        type = int,
+        required = False,
+        default = 1,
+        help = """Number of worker processes to analyse species blocks with; the output is the same as with one process.
+                    Not used with --thresholds or --compare_methods. [int] [Default = 1]""")
+
+    report_parser.add_argument(
+        '--topology_cache',
+        type = str,
+        required = False,
+        default = None,
+        help = """Cache file for the tree structure of species blocks, reused across samples classified with the same database.
+                    Created if it does not exist, and updated with new blocks after each run. [str/pathlike]""")
+
+    report_parser.add_argument(
+        '--kraken_db',
+        type = str,
+        required = False,
+        default = None,
+        help = """kraken2 database directory the report was made with; its fingerprint ties the --topology_cache file to it,
+                    so that a cache made for another database is replaced. [str/pathlike]""")
+
+    report_modes = report_parser.add_mutually_exclusive_group()
+    report_modes.add_argument(
+        '--thresholds',
+        type = str,
+        required = False,
+        default = None,
+        help = """Threshold sweep: analyse the report with each of these thresholds in one pass, instead of --min_read_threshold.
+                    Comma-separated values and/or ranges 'start:stop:step' (stop excluded), eg. '10,50,0:1000:100'.
+                    Selections for every threshold are written to one output JSON, keyed by threshold. [str]""")
+
+    report_modes.add_argument(
+        '--compare_methods',
+        type = str,
+        nargs = "?",
+        const = "all",
+        required = False,
+        default = None,
+        help = """Method comparison: poll the report with each of these methods in one pass, instead of --poll_method.
+                    'all' (the default if no value is given) or comma-separated methods, eg. 'max,kmeans'.
+                    Selections for every method, and each method's class_method and entropies for every polled tree, are written to one output JSON. [str]""")
+
     report_parser.add_argument(
         "-q", "--quiet",
         action = "store_true",
@@ -144,8 +190,8 @@ def collect_args():
     dump_fqs_parser.add_argument(
         "-fq2", "--fastq2",
         type = str,
-        required = True,
-        help = "Second FASTQ file of paired end reads. [str/pathlike]")
+        required = False,
+        help = "Second FASTQ file of paired end reads. If not given, -fq1 is treated as single-end (eg. ONT) reads. [str/pathlike]")
 
     dump_fqs_parser.add_argument(
         '-o', '--outdir',
@@ -181,6 +227,97 @@ def collect_args():
         default=1,
         help = "number of threads to provide to index [int] (default=1)")
 
+    dump_fqs_parser.add_argument(
+        '--shard',
+        type = str,
+        required = False,
+        help = """Only write reads whose read ID hashes into partition i of N, eg. '2/8' [str].
+                    Outputs are written as <sample_id>_<taxid>_R1.shard<i>-of-<N>.fq; combine them with `merge_fastqs`.""")
+
+    dump_fqs_parser.add_argument(
+        '--stdout_taxid',
+        type = str,
+        required = False,
+        help = """Write read pairs for only this taxid to stdout as interleaved FASTQ, instead of writing files. [str]
+                    (To stream every taxon, create FIFOs named <sample_id>_<taxid>_R1.fq/_R2.fq in outdir before running.)""")
+
+    dump_fqs_parser.add_argument(
+        '--max_reads_per_file',
+        type = int,
+        required = False,
+        help = """Split each taxon's output into numbered file pairs (<sample_id>_<taxid>_part<n>_R1.fq) of at most this many read pairs,
+                    and list them in <sample_id>_dump_manifest.json. Cannot be combined with --shard or --stdout_taxid. [int]""")
+
+    dump_fqs_parser.add_argument(
+        "--write_unassigned",
+        action = "store_true",
+        required = False,
+        help = "Also write read pairs not assigned to any taxon in the JSON (including unclassified reads) to <sample_id>_unassigned_R1.fq/_R2.fq. [switch]")
+
+    dump_fqs_parser.add_argument(
+        "--compress_unassigned",
+        action = "store_true",
+        required = False,
+        help = "Gzip the unassigned read output (implies --write_unassigned). [switch]")
+
+    dump_fqs_parser.add_argument(
+        "--stats",
+        action = "store_true",
+        required = False,
+        help = "Collect per-taxon read statistics (counts, bases, length distribution, mean quality, GC) while writing, into <sample_id>_dump_stats.json. [switch]")
+
+    dump_fqs_parser.add_argument(
+        '--checkpoint_every',
+        type = int,
+        required = False,
+        help = "Write a checkpoint (<sample_id>_dump_checkpoint.json) every this many read pairs, so an interrupted run can be resumed. [int]")
+
+    dump_fqs_parser.add_argument(
+        "--resume",
+        action = "store_true",
+        required = False,
+        help = "Resume from the checkpoint left by an interrupted run with the same inputs and options, if there is one. [switch]")
+
+    dump_fqs_parser.add_argument(
+        '--piece_size',
+        type = int,
+        required = False,
+        default = 64 * 1024,
+        help = "Single-end mode: maximum number of bytes of a read held in memory at once; longer reads are copied in pieces [int] (default = 65536)")
+
+    dump_fqs_parser.add_argument(
+        '--mmap',
+        action = "store_true",
+        required = False,
+        help = "Memory-map the (uncompressed) input FASTQs and write matching records straight from the mapping [switch]")
+
+    dump_fqs_parser.add_argument(
+        '--interleaved',
+        action = "store_true",
+        required = False,
+        help = "-fq1 is interleaved paired-end FASTQ (R2 follows its R1); write one interleaved file per taxon [switch]")
+
+    merge_fqs_parser = subparsers.add_parser("merge_fastqs")
+
+    merge_fqs_parser.add_argument(
+        '-i', '--indir',
+        type = str,
+        required = False,
+        help = "Directory containing sharded `dump_fastqs` outputs. [str/pathlike] (default = outdir)")
+
+    merge_fqs_parser.add_argument(
+        '-o', '--outdir',
+        type = str,
+        default=os.getcwd(),
+        required = False,
+        help = "Full path to output directory. [str/pathlike] (default = current working dir)")
+
+    merge_fqs_parser.add_argument(
+        "--keep_shards",
+        action = "store_true",
+        required = False,
+        help = "Keep the per-shard files after merging. [switch]")
+
     args = parser.parse_args()
     return args
 
@@ -203,9 +340,22 @@ def main():
 
     if args.run_mode == "parse_report":
 
+        ## load the topology cache for the database
+        topology_cache = None
+        if args.topology_cache:
+            fingerprint = database_fingerprint(args.kraken_db) if args.kraken_db else None
+            topology_cache = TopologyCache(cache_file = args.topology_cache, fingerprint = fingerprint)
+
         ## initialise driver module and analyse report
-        my_processor = KrakenProcessor(args.sample_id)
-        my_processor.analyse_report(input_kraken_report_file = args.in_file, input_threshold = args.min_read_threshold, input_method = args.poll_method, quiet=args.quiet)
+        my_processor = KrakenProcessor(args.sample_id, topology_cache = topology_cache)
+        if args.compare_methods:
+            my_processor.compare_methods(input_kraken_report_file = args.in_file, input_threshold = args.min_read_threshold, input_methods = parse_methods(args.compare_methods), quiet=args.quiet)
+        elif args.thresholds:
+            my_processor.sweep_thresholds(input_kraken_report_file = args.in_file, input_thresholds = parse_thresholds(args.thresholds), input_method = args.poll_method, quiet=args.quiet)
+        else:
+            my_processor.analyse_report(input_kraken_report_file = args.in_file, input_threshold = args.min_read_threshold, input_method = args.poll_method, quiet=args.quiet, threads = args.threads)
+        if topology_cache is not None:
+            topology_cache.save()
         my_processor.write_output(prefix = fixed_outdir, suffix = args.suffix)
 
     if args.run_mode == "sort_reads":
@@ -214,5 +364,8 @@ def main():
     if args.run_mode == "dump_fastqs":
         dump_fastqs(args)
 
+    if args.run_mode == "merge_fastqs":
+        merge_fastqs(args)
+
 if __name__ == "main":
     main()
\ No newline at end of file
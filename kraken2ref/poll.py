@@ -1,9 +1,80 @@
-import logging, sys
+import logging, sys, copy
 import numpy as np
 import scipy.stats as sts
-from sklearn.cluster import KMeans
+import scipy.special as sps
 
 from kraken2ref.taxonomytree import TaxonomyTree
+from kraken2ref.reportstore import gather
+
+def step_thru(dist: list):
+    """Function that steps forward through a frequency distribution and finds the first inflection:
+        the first step (between consecutive sorted frequencies) that is non-zero and smaller than the largest step before it.
+
+    Args:
+        dist (list(int)/np.ndarray): Frequency distribution
+
+    Returns:
+        idxs_to_return: Index locations of retained frequencies (from the inflection onward, in ascending order of frequency)
+                        to map back to X-axis values and retrieve them
+    """
+    dist = np.asarray(dist)
+    ## equal frequencies are ordered last-first, so that if the inflection splits them the first ones are kept
+    order = np.lexsort((-np.arange(len(dist)), dist))
+    steps = np.diff(dist[order])
+    ## largest step before each step (0 before the first)
+    max_steps = np.maximum.accumulate(np.concatenate(([0], steps[:-1])))
+    break_points = np.flatnonzero((steps != 0) & (steps < max_steps))
+    break_point = break_points[0] if len(break_points) > 0 else 0
+    return order[break_point:].tolist()
+
+def step_thru_back(dist: list):
+    """Function that steps backward through reverse-sorted frequencies and finds the last inflection:
+        the first step that is larger than all non-zero steps before it (and than 65,535).
+
+    Args:
+        dist (list(int)/np.ndarray): Frequency distribution
+
+    Returns:
+        idxs_to_return: Index locations of retained frequencies (up to the inflection, in descending order of frequency)
+                        to map back to X-axis values and retrieve them
+    """
+    dist = np.asarray(dist)
+    ## equal frequencies are ordered first-first, so that if the inflection splits them the first ones are kept
+    order = np.argsort(-dist, kind = "stable")
+    steps = -np.diff(dist[order])
+    ## smallest non-zero step before each step (65,535 before the first)
+    min_steps = np.minimum.accumulate(np.concatenate(([65_535], np.where(steps == 0, 65_535, steps)[:-1])))
+    break_points = np.flatnonzero(steps > min_steps)
+    break_point = break_points[0] + 1 if len(break_points) > 0 else len(dist)
+    return order[:break_point].tolist()
+
+def kmeans_centroid(freqs: np.ndarray):
+    """Centroid of a frequency distribution fitted with a single k-means cluster, i.e. its mean.
+        Computed as sklearn's `KMeans(n_clusters = 1)` does: the mean of the frequencies centred on their mean, summed in order.
+
+    Args:
+        freqs (np.ndarray): Frequency distribution, as floats
+
+    Returns:
+        (float): Centroid
+    """
+    mean = freqs.mean()
+    return np.cumsum(freqs - mean)[-1] / len(freqs) + mean
+
+def kmeans_distances(freqs: np.ndarray, centroids):
+    """Distances of frequencies from their centroid(s), computed as sklearn's `KMeans.transform` does
+
+    Args:
+        freqs (np.ndarray): Frequencies, as floats
+        centroids (float/np.ndarray): Centroid, or the centroid for each frequency
+
+    Returns:
+        (np.ndarray): Distance of each frequency from its centroid
+    """
+    distances = -2 * (freqs * centroids)
+    distances += freqs * freqs
+    distances += centroids * centroids
+    return np.sqrt(np.maximum(distances, 0))
 
 class Poll:
     """Class to encapsulate polling functions
@@ -14,7 +85,7 @@ class Poll:
 
         Args:
             taxonomy_tree (TaxonomyTree): Input TaxonomyTree to analyse
-            data_dict (dict): data_dict containing data for the input tree
+            data_dict (dict/ReportStore): data_dict containing data for the input tree
             threshold (int): Minimum read threshold to use as cutoff for leaf node validity
         """
         ## set up attributes
@@ -29,12 +100,15 @@ class Poll:
         self.singleton = False
 
         ## find the number of valid leaf nodes
-        self.valid_leaves = [i for i in self.leaves if data_dict[i][1] > threshold]
+        ## (data is gathered for the tree's own nodes only, never scanning the whole data_dict)
+        leaf_freqs = gather(data_dict, 1, self.leaves)
+        self.valid_leaves = [leaf for leaf, freq in zip(self.leaves, leaf_freqs) if freq > threshold]
 
         ## if no valid leaf nodes, jump up one level
         if len(self.valid_leaves) == 0:
             self.parent_selected = True
-            self.valid_subterminals = [i for i in taxonomy_tree.subterminal_nodes if data_dict[i][0] > threshold]
+            subterminal_freqs = gather(data_dict, 0, taxonomy_tree.subterminal_nodes)
+            self.valid_subterminals = [node for node, freq in zip(taxonomy_tree.subterminal_nodes, subterminal_freqs) if freq > threshold]
             ## if subterminal node is valid, return this info
             if len(self.valid_subterminals) > 0 and len(self.leaves) > 1:
                 self.valid_parent = True
@@ -47,9 +121,10 @@ class Poll:
             self.singleton = True
 
         ## if >1 valid leaf node, set up polling
+        ## nodes are polled in report order
         if len(self.valid_leaves) > 1:
-            filt_data_dict = {k: data_dict[k] for k in data_dict.keys() if k in self.valid_leaves}
-            nodes, freq_dist = [[k for k in filt_data_dict.keys()], [filt_data_dict[k][1] for k in filt_data_dict.keys()]]
+            polled = sorted(zip(self.leaves, leaf_freqs), key = lambda leaf_freq: leaf_freq[0][0])
+            nodes, freq_dist = [[leaf for leaf, freq in polled if freq > threshold], [freq for leaf, freq in polled if freq > threshold]]
 
             self.nodes_to_poll = nodes
             self.dist = freq_dist
@@ -68,67 +143,22 @@ class Poll:
         return [max_node]
 
     def step_thru(self):
-        """Function that steps forward through a frequency distribution and finds the first inflection
+        """Function that steps forward through this tree's frequency distribution (see `step_thru`)
 
         Returns:
             idxs_to_return: Index locations of retained frequencies
                             to map back to X-axis values and retrieve them
         """
-        steps = sorted(self.dist)
-        max_step = 0
-        for i in range(len(steps) - 1):
-            j = i+1
-            step = steps[j] - steps[i]
-            # print(steps[i], steps[j], step)
-            if step > max_step:
-                max_step = step
-                i += 1
-            elif step == 0 or step == max_step:
-                pass
-            else:
-                break_point = i
-                break
-
-        try:
-            assert break_point
-        except UnboundLocalError as ule:
-            break_point = None
-
-        filt_freqs = steps[break_point:]
-        idxs_to_return = [self.dist.index(freq) for freq in filt_freqs]
-        return idxs_to_return
+        return step_thru(self.dist)
 
     def step_thru_back(self):
-        """Function that steps backward through reverse-sorted
-        list of frequencies and finds the last inflection point.
+        """Function that steps backward through this tree's frequency distribution (see `step_thru_back`)
 
         Returns:
             idxs_to_return: Index locations of retained frequencies
                             to map back to X-axis values and retrieve them
         """
-        steps = sorted(self.dist, reverse=True)
-        # max_step = 100000000000000000
-        max_step = 65_535
-        for i in range(len(steps) - 1):
-            j = i+1
-            step = steps[i] - steps[j]
-            if step > max_step:
-                break_point = j
-                break
-            elif step == 0:
-                pass
-            else:
-                max_step = step
-                i += 1
-
-        try:
-            assert break_point
-        except UnboundLocalError as ule:
-            break_point = None
-
-        filt_freqs = steps[:break_point]
-        idxs_to_return = [self.dist.index(freq) for freq in filt_freqs]
-        return idxs_to_return
+        return step_thru_back(self.dist)
 
     def poll_with_skew(self):
         """Apply polling functions to end nodes, treating data as a
@@ -144,45 +174,37 @@ class Poll:
         logging.debug(f"Frequency Distribution: {freq_dist}")
         logging.debug(f"Probability Distribution: {prob_dist}")
 
+        ## pad (a copy of) the distribution to the minimum size for the skew test
         if len(prob_dist) < 8:
-            padding = [0]*(8-len(prob_dist))
-            prob_dist.extend(padding)
+            prob_dist = prob_dist + [0]*(8-len(prob_dist))
 
         skew_test = sts.skewtest(prob_dist)
-        if skew_test.pvalue < 0.005:
+        ## p-values on a boundary take the mode below it
+        if skew_test.pvalue <= 0.005:
             logging.info("Mode = MAX")
             mode = "max"
-        if 0.005 < skew_test.pvalue < 0.05:
+        elif skew_test.pvalue <= 0.05:
             logging.info("Mode = STEP")
             mode = "step"
-        if 0.05 < skew_test.pvalue:
+        else:
             logging.info("Mode = CONSERVATIVE")
             mode = "conservative"
         self.class_method.append(mode)
-        filt_leaves = []
         if mode == "conservative":
             ## using step_thru to step forward in ascending sorted dist
             idxs_to_keep = self.step_thru()
-            for idx in idxs_to_keep:
-                filt_leaves.append(self.nodes_to_poll[idx])
 
         if mode == "step":
             ## using step_thru_back to step forward in **descending** sorted dist
             idxs_to_keep = self.step_thru_back()
-            for idx in idxs_to_keep:
-                filt_leaves.append(self.nodes_to_poll[idx])
 
         ## caveman method
         if mode == "max":
-            max_freq = max(freq_dist)
-            max_node = self.nodes_to_poll[freq_dist.index(max_freq)]
-            filt_leaves.append(max_node)
+            idxs_to_keep = [freq_dist.index(max(freq_dist))]
 
+        filt_leaves = [self.nodes_to_poll[idx] for idx in idxs_to_keep]
         logging.debug(f"Selected nodes: {filt_leaves}")
-        filt_prob_dist = []
-        for filt_leaf in filt_leaves:
-            idx = self.nodes_to_poll.index(filt_leaf)
-            filt_prob_dist.append(self.prob_dist[idx])
+        filt_prob_dist = [self.prob_dist[idx] for idx in idxs_to_keep]
 
         surprise_postfilter = sts.entropy(filt_prob_dist)
         logging.debug(f"Post-filter Entropy: {surprise_postfilter}")
@@ -229,11 +251,9 @@ class Poll:
 
         """
 
-        freq_arr = np.array(self.dist).reshape(-1, 1)
-        kmeans = KMeans(n_clusters = 1)
-        kmeans.fit(freq_arr)
-        distances = kmeans.transform(freq_arr)
-        sorted_idx = np.argsort(distances.ravel())[::-1][:5]
+        freq_arr = np.array(self.dist, dtype = np.float64)
+        distances = kmeans_distances(freq_arr, kmeans_centroid(freq_arr))
+        sorted_idx = np.argsort(distances)[::-1][:5]
         med = np.median(freq_arr)
         filt_leaves = []
         filt_prob_dist = []
@@ -304,3 +324,295 @@ class Poll:
         if method == "kmeans":
             self.filt_leaves, self.postfilter_surprise = self.poll_with_kmeans()
 
+
+class BatchPoll:
+    """Class to poll many simple trees at once.
+        The leaves of all trees are held as one segmented array (one segment per tree, delimited by `offsets`),
+        so that thresholds, maxima, quartiles and entropies are computed for all trees together
+        instead of one `Poll` at a time. Selected nodes are the same as those of a `Poll` on each tree.
+    """
+    def __init__(self, taxonomy_trees: list, data_dict: dict, threshold: int):
+        """Initialiser
+
+        Args:
+            taxonomy_trees (list(TaxonomyTree)): Input simple trees to analyse
+            data_dict (dict/ReportStore): data_dict containing data for all input trees
+            threshold (int): Minimum read threshold to use as cutoff for leaf node validity
+        """
+        self.trees = taxonomy_trees
+        self.data_dict = data_dict
+        num_trees = len(taxonomy_trees)
+
+        ## segmented leaves: leaves of tree i are self.leaves[self.offsets[i]:self.offsets[i+1]]
+        self.leaves = [leaf for tree in taxonomy_trees for leaf in tree.leaf_nodes]
+        self.num_leaves = np.fromiter((len(tree.leaf_nodes) for tree in taxonomy_trees), dtype = np.int64, count = num_trees)
+        self.offsets = np.concatenate(([0], np.cumsum(self.num_leaves)))
+        self.segments = np.repeat(np.arange(num_trees), self.num_leaves)
+        self.freqs = np.array(gather(data_dict, 1, self.leaves), dtype = np.int64)
+        self.rows = np.fromiter((leaf[0] for leaf in self.leaves), dtype = np.int64, count = len(self.leaves))
+
+        self._apply_threshold(threshold)
+
+    def at_threshold(self, threshold: int):
+        """The same trees, polled with another threshold. Leaf data gathered for this batch is shared, not gathered again.
+
+        Args:
+            threshold (int): Minimum read threshold to use as cutoff for leaf node validity
+
+        Returns:
+            (BatchPoll): Batch set up for polling with `threshold`
+        """
+        batch = copy.copy(self)
+        batch._apply_threshold(threshold)
+        return batch
+
+    def _apply_threshold(self, threshold: int):
+        """Find valid leaves and set up (per-tree) polling attributes for a threshold
+
+        Args:
+            threshold (int): Minimum read threshold to use as cutoff for leaf node validity
+        """
+        self.threshold = threshold
+        num_trees = len(self.trees)
+
+        ## find the number of valid leaf nodes in each tree
+        valid = self.freqs > threshold
+        num_valid = np.bincount(self.segments[valid], minlength = num_trees)
+        valid_nodes = [self.leaves[i] for i in np.flatnonzero(valid).tolist()]
+        valid_offsets = np.concatenate(([0], np.cumsum(num_valid))).tolist()
+        self.valid_leaves = [valid_nodes[valid_offsets[i]:valid_offsets[i+1]] for i in range(num_trees)]
+
+        ## if only one valid leaf node, no polling needed; if none, jump up one level
+        self.singleton = num_valid == 1
+        self.parent_selected = num_valid == 0
+        self.valid_parent = np.zeros(num_trees, dtype = bool)
+        self.valid_subterminals = [None] * num_trees
+        self.max_leaves = [None] * num_trees
+        if self.parent_selected.any():
+            self._select_parents()
+
+        ## if >1 valid leaf node, set up polling: valid leaves of each polled tree, in report order
+        self.polled = np.flatnonzero(num_valid > 1)
+        to_poll = np.flatnonzero(valid & (num_valid > 1)[self.segments])
+        self.poll_idx = to_poll[np.lexsort((self.rows[to_poll], self.segments[to_poll]))]
+        self.poll_segments = np.repeat(np.arange(len(self.polled)), num_valid[self.polled])
+        self.poll_offsets = np.concatenate(([0], np.cumsum(num_valid[self.polled])))
+        self.dist = self.freqs[self.poll_idx]
+        self.prob_dist = self.dist / self._segment_sum(self.dist, self.poll_segments)[self.poll_segments]
+
+        self._reset_results()
+
+    def copy(self):
+        """A copy of this batch, without polling results, to poll again (e.g. with another method) without changing this batch's results
+
+        Returns:
+            (BatchPoll): Batch set up for polling, with the same trees and threshold
+        """
+        batch = copy.copy(self)
+        batch._reset_results()
+        return batch
+
+    def _reset_results(self):
+        """Initialise (per-tree) polling results
+        """
+        num_trees = len(self.trees)
+        polled = np.zeros(num_trees, dtype = bool)
+        polled[self.polled] = True
+        self.class_method = [[] if is_polled else ["singleton"] for is_polled in polled.tolist()]
+        self.filt_leaves = [None] * num_trees
+        self.surprise_prefilter = np.zeros(num_trees)
+        self.postfilter_surprise = np.zeros(num_trees)
+
+    def _segment_sum(self, values: np.ndarray, segments: np.ndarray):
+        """Sum of values in each polled tree
+
+        Args:
+            values (np.ndarray): Values to sum
+            segments (np.ndarray): Polled tree (position in `self.polled`) of each value
+
+        Returns:
+            (np.ndarray): Sum of values for each polled tree
+        """
+        return np.bincount(segments, weights = values, minlength = len(self.polled))
+
+    def _entropy(self, probs: np.ndarray, segments: np.ndarray):
+        """Entropy of the (normalised) probability distribution of each polled tree, as by `scipy.stats.entropy`
+
+        Args:
+            probs (np.ndarray): Probabilities
+            segments (np.ndarray): Polled tree (position in `self.polled`) of each probability
+
+        Returns:
+            (np.ndarray): Entropy for each polled tree
+        """
+        norm_probs = probs / self._segment_sum(probs, segments)[segments]
+        return self._segment_sum(sps.entr(norm_probs), segments)
+
+    def _select_parents(self):
+        """For trees with no valid leaves: find valid subterminal nodes and, if the parent is valid,
+            the leaves with maximal data (compared as data_dict tuples, like `Poll`)
+        """
+        parent_trees = np.flatnonzero(self.parent_selected)
+        subterminals = [node for i in parent_trees.tolist() for node in self.trees[i].subterminal_nodes]
+        num_subterminals = np.fromiter((len(self.trees[i].subterminal_nodes) for i in parent_trees.tolist()), dtype = np.int64, count = len(parent_trees))
+        valid = np.array(gather(self.data_dict, 0, subterminals), dtype = np.int64) > self.threshold
+        start = 0
+        for i, num in zip(parent_trees.tolist(), num_subterminals.tolist()):
+            self.valid_subterminals[i] = [node for node, is_valid in zip(subterminals[start:start+num], valid[start:start+num].tolist()) if is_valid]
+            start += num
+        num_valid = np.bincount(np.repeat(parent_trees, num_subterminals)[valid], minlength = len(self.trees))
+        self.valid_parent = self.parent_selected & (num_valid > 0) & (self.num_leaves > 1)
+        if not self.valid_parent.any():
+            return
+
+        ## order leaves of each tree by their data tuple (ties broken by leaf order), and take the last one as the maximum
+        idx = np.flatnonzero(self.valid_parent[self.segments])
+        leaves = [self.leaves[i] for i in idx.tolist()]
+        num_columns = len(self.data_dict[leaves[0]])
+        columns = [np.array(gather(self.data_dict, col, leaves), dtype = np.int64) for col in range(num_columns)]
+        segments = self.segments[idx]
+        order = np.lexsort([-idx] + columns[::-1] + [segments])
+        last = np.flatnonzero(np.append(segments[order][1:] != segments[order][:-1], True))
+        max_pos = np.empty(len(self.trees), dtype = np.int64)
+        max_pos[segments[order][last]] = order[last]
+        is_max = np.logical_and.reduce([column == column[max_pos[segments]] for column in columns])
+        for i, leaf in zip(segments[is_max].tolist(), idx[is_max].tolist()):
+            if self.max_leaves[i] is None:
+                self.max_leaves[i] = []
+            self.max_leaves[i].append(self.leaves[leaf])
+
+    def _first_max(self, idxs: np.ndarray):
+        """Position of the first maximal frequency in each given polled tree (as `list.index(max(...))`)
+
+        Args:
+            idxs (np.ndarray): Polled trees (positions in `self.polled`)
+
+        Returns:
+            (np.ndarray): Position in `self.dist` of the first maximum of each tree
+        """
+        max_freqs = np.maximum.reduceat(self.dist, self.poll_offsets[:-1])
+        pos = np.flatnonzero(np.isin(self.poll_segments, idxs) & (self.dist == max_freqs[self.poll_segments]))
+        return pos[np.diff(self.poll_segments[pos], prepend = -1) != 0]
+
+    def _quantile(self, sorted_dist: np.ndarray, q: float):
+        """Quantile of each polled tree's frequency distribution, interpolated as by `np.quantile` (method = "linear")
+
+        Args:
+            sorted_dist (np.ndarray): Frequencies, sorted within each polled tree
+            q (float): Quantile to compute
+
+        Returns:
+            (np.ndarray): Quantile for each polled tree
+        """
+        sizes = np.diff(self.poll_offsets)
+        virtual_idx = (sizes - 1) * q
+        prev_idx = np.floor(virtual_idx)
+        gamma = virtual_idx - prev_idx
+        prev_idx = prev_idx.astype(np.int64)
+        next_idx = np.where(virtual_idx >= sizes - 1, prev_idx, prev_idx + 1)
+        prev = sorted_dist[self.poll_offsets[:-1] + prev_idx]
+        diff = sorted_dist[self.poll_offsets[:-1] + next_idx] - prev
+        quantile = prev + diff * gamma
+        np.subtract(prev + diff, diff * (1 - gamma), out = quantile, where = gamma >= 0.5)
+        return quantile
+
+    def _skew_pvalues(self):
+        """p-value of the skew test on each polled tree's probability distribution, padded with zeros to at least 8 values
+
+        Returns:
+            (np.ndarray): p-value for each polled tree
+        """
+        sizes = np.diff(self.poll_offsets)
+        pvalues = np.empty(len(self.polled))
+        padded_sizes = np.maximum(sizes, 8)
+        cols = np.arange(len(self.dist)) - self.poll_offsets[self.poll_segments]
+        ## trees with the same padded size are tested together, one row each
+        for size in np.unique(padded_sizes).tolist():
+            idxs = np.flatnonzero(padded_sizes == size)
+            probs = np.zeros((len(idxs), size))
+            in_group = np.isin(self.poll_segments, idxs)
+            probs[np.searchsorted(idxs, self.poll_segments[in_group]), cols[in_group]] = self.prob_dist[in_group]
+            pvalues[idxs] = sts.skewtest(probs, axis = 1).pvalue
+        return pvalues
+
+    def _kmeans_outliers(self):
+        """Frequencies furthest (top 5) from the single k-means centroid of each polled tree, kept if above the tree's median
+
+        Returns:
+            (np.ndarray): Positions in `self.dist` of retained frequencies, in order of decreasing distance within each tree
+        """
+        freqs = self.dist.astype(np.float64)
+        bounds = list(zip(self.poll_offsets[:-1].tolist(), self.poll_offsets[1:].tolist()))
+        centroids = np.array([kmeans_centroid(freqs[start:end]) for start, end in bounds])
+        distances = kmeans_distances(freqs, centroids[self.poll_segments])
+        ## distances are ranked with np.argsort on each tree, so that ties are ordered as in `Poll`
+        furthest = np.concatenate([start + np.argsort(distances[start:end])[::-1][:5] for start, end in bounds])
+
+        sizes = np.diff(self.poll_offsets)
+        sorted_dist = self.dist[np.lexsort((self.dist, self.poll_segments))]
+        medians = (sorted_dist[self.poll_offsets[:-1] + (sizes - 1) // 2] + sorted_dist[self.poll_offsets[:-1] + sizes // 2]) / 2
+        return furthest[self.dist[furthest] > medians[self.poll_segments[furthest]]]
+
+    def poll_leaves(self, method: str = "kmeans"):
+        """Driver function to run polling on all trees with more than one valid leaf node.
+            Results for tree i are in self.filt_leaves[i] (None for trees that were not polled).
+
+        Args:
+            method (str): Polling method to use. Defaults to "kmeans"
+        """
+        ## ensure method is valid
+        method = method.lower()
+        for i in self.polled.tolist():
+            self.class_method[i] = [method]
+        if method not in ["max", "skew", "tiles", "kmeans"]:
+            logging.warning(f"Invalid polling method specified. Defaulting to 'kmeans'")
+            method = "kmeans"
+        if len(self.polled) == 0:
+            return
+
+        self.surprise_prefilter[self.polled] = self._entropy(self.prob_dist, self.poll_segments)
+        postfilter_surprise = np.zeros(len(self.polled))
+        all_polled = np.arange(len(self.polled))
+        ## positions (in self.dist) of selected nodes, in selection order within each polled tree
+        selected = []
+
+        if method == "max":
+            selected.append(self._first_max(all_polled))
+
+        if method == "tiles":
+            sorted_dist = self.dist[np.lexsort((self.dist, self.poll_segments))]
+            q1 = self._quantile(sorted_dist, 0.25)
+            q3 = self._quantile(sorted_dist, 0.75)
+            iqr = q3 - q1
+            right_fence = q3 + (1.5 * iqr)
+            selected.append(np.flatnonzero(self.dist > right_fence[self.poll_segments]))
+
+        if method == "skew":
+            pvalues = self._skew_pvalues()
+            ## same modes as `Poll.poll_with_skew`, with p-values on a boundary taking the mode below it
+            modes = np.select([pvalues <= 0.005, pvalues <= 0.05], ["max", "step"], default = "conservative")
+            for i, mode in zip(self.polled.tolist(), modes.tolist()):
+                self.class_method[i].append(mode)
+            selected.append(self._first_max(np.flatnonzero(modes == "max")))
+            for mode, step_fn in [("conservative", step_thru), ("step", step_thru_back)]:
+                for i in np.flatnonzero(modes == mode).tolist():
+                    start, end = self.poll_offsets[i:i+2].tolist()
+                    selected.append(start + np.array(step_fn(self.dist[start:end]), dtype = np.int64))
+
+        if method == "kmeans":
+            selected.append(self._kmeans_outliers())
+
+        selected = np.concatenate(selected) if selected else np.zeros(0, dtype = np.int64)
+        selected = selected[np.argsort(self.poll_segments[selected], kind = "stable")]
+        if method != "max":
+            postfilter_surprise = self._entropy(self.prob_dist[selected], self.poll_segments[selected])
+
+        ## split selected nodes by tree
+        selected_nodes = [self.leaves[i] for i in self.poll_idx[selected].tolist()]
+        counts = np.bincount(self.poll_segments[selected], minlength = len(self.polled))
+        bounds = np.concatenate(([0], np.cumsum(counts))).tolist()
+        for j, i in enumerate(self.polled.tolist()):
+            if method == "skew" and self.class_method[i][-1] not in ["max", "step", "conservative"]:
+                continue
+            self.filt_leaves[i] = selected_nodes[bounds[j]:bounds[j+1]]
+            self.postfilter_surprise[i] = postfilter_surprise[j]
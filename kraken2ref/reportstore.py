@@ -0,0 +1,112 @@
+import numpy as np
+from collections.abc import Mapping
+
+class ReportStore(Mapping):
+    """Columnar store of kraken2 report rows: one NumPy array per column, indexed by report row.
+        Behaves as a read-only data_dict (node -> (cumulative reads, unique reads, taxID[, cumulative minimizers, unique minimizers])),
+        and can gather a whole column for a list of nodes at once (see `gather`).
+    """
+    def __init__(self, nodes: list, columns: list):
+        """Initialiser
+
+        Args:
+            nodes (list(tuple)): Nodes stored, in report order. Each node is (index in the report, taxon level).
+            columns (list(list)): Values of each node for each data_dict column, in data_dict order:
+                                    cumulative reads, unique reads, taxID (and, with minimizer data, cumulative minimizers, unique minimizers)
+        """
+        self.nodes = nodes
+        self.has_minimizer_info = len(columns) == 5
+        self.first_row = nodes[0][0] if nodes else 0
+        num_rows = nodes[-1][0] - self.first_row + 1 if nodes else 0
+
+        ## level of the node stored at each row (None for rows not stored, e.g. above species level)
+        self.levels = [None] * num_rows
+        for node in nodes:
+            self.levels[node[0] - self.first_row] = node[1]
+
+        self.columns = []
+        for values in columns:
+            column = np.array(values, dtype = np.int64)
+            if len(nodes) != num_rows:
+                column = np.zeros(num_rows, dtype = np.int64)
+                column[self.rows_of(nodes)] = values
+            self.columns.append(column)
+
+        self.cumulative_reads, self.unique_reads, self.taxids = self.columns[:3]
+        self.cumulative_minimizers, self.unique_minimizers = self.columns[3:] if self.has_minimizer_info else (None, None)
+
+    @classmethod
+    def concat(cls, stores: list):
+        """Combine stores for consecutive parts of a report (e.g. species blocks) into one
+
+        Args:
+            stores (list(ReportStore)): Stores to combine, in report order
+
+        Returns:
+            (ReportStore): Store holding the nodes of all `stores`
+        """
+        nodes = [node for store in stores for node in store.nodes]
+        num_columns = len(stores[0].columns) if stores else 3
+        columns = [[] for i in range(num_columns)]
+        for store in stores:
+            for i, column in enumerate(columns):
+                column.extend(store.column(i, store.nodes))
+        return cls(nodes, columns)
+
+    def rows_of(self, nodes: list):
+        """Positions of nodes in the column arrays
+
+        Args:
+            nodes (list(tuple)): Nodes stored in this store
+
+        Returns:
+            (np.ndarray): Position of each node
+        """
+        return np.fromiter((node[0] for node in nodes), dtype = np.int64, count = len(nodes)) - self.first_row
+
+    def column(self, col: int, nodes: list):
+        """Values of one column for a list of nodes, gathered in one go
+
+        Args:
+            col (int): Column, by position in the data_dict tuple (0 = cumulative reads, 1 = unique reads, 2 = taxID, ...)
+            nodes (list(tuple)): Nodes stored in this store
+
+        Returns:
+            (list(int)): Value of each node
+        """
+        ## all nodes of a store without gaps (e.g. one species block) are the whole column
+        if nodes is self.nodes and len(nodes) == len(self.levels):
+            return self.columns[col].tolist()
+        return self.columns[col][self.rows_of(nodes)].tolist()
+
+    def __getitem__(self, node):
+        pos = node[0] - self.first_row
+        if not 0 <= pos < len(self.levels) or self.levels[pos] != node[1]:
+            raise KeyError(node)
+        return tuple(column.item(pos) for column in self.columns)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        pos = node[0] - self.first_row
+        return 0 <= pos < len(self.levels) and self.levels[pos] == node[1]
+
+def gather(data_dict, col: int, nodes: list):
+    """Values of one data_dict column for a list of nodes.
+        Gathered from the column arrays if `data_dict` is a ReportStore, otherwise looked up node by node.
+
+    Args:
+        data_dict (dict/ReportStore): data_dict for the report the nodes are from
+        col (int): Column, by position in the data_dict tuple (0 = cumulative reads, 1 = unique reads, 2 = taxID, ...)
+        nodes (list(tuple)): Nodes to get values for
+
+    Returns:
+        (list(int)): Value of each node
+    """
+    if isinstance(data_dict, ReportStore):
+        return data_dict.column(col, nodes)
+    return [data_dict[node][col] for node in nodes]
@@ -1,6 +1,5 @@
 import os, sys
 import json
-import pandas as pd
 from Bio import SeqIO
 import datetime
 import logging
@@ -237,9 +236,12 @@ def sort_reads(sample_id: str, kraken_output: str, mode: str,
     logging.info(f"Wrote {len(numreads_per_taxon.keys())} file-pairs at path {outdir}.\n\n")
 
     ## get a list of unwritten reads and dump to file as tsv
-    full_kraken_out = pd.read_csv(kraken_output, sep = "\t", header = None)
-    unwritten = full_kraken_out[~full_kraken_out[1].isin(reads_written)]
-    unwritten.to_csv(os.path.join(outdir, f"{sample_id}_unwritten_reads.txt"), sep = "\t", header = False, index = False)
+    ## (kraken output lines are copied as they are; column 2 is the read ID)
+    reads_written = set(reads_written)
+    with open(kraken_output, "r") as kraken_out, open(os.path.join(outdir, f"{sample_id}_unwritten_reads.txt"), "w") as unwritten:
+        for line in kraken_out:
+            if line.strip() and line.split("\t", 2)[1] not in reads_written:
+                unwritten.write(line if line.endswith("\n") else line + "\n")
 
 
 # instantiating the decorator
@@ -15,15 +15,30 @@ class TaxonLevel:
         S3 - 10 = S (This is an exception handled in this class)
         S2.to(S6) = [S3, S4, S5, S6]
         S6.to(S2) = None (Unhandled exception)
+
+        TaxonLevels are immutable and interned: there is one instance per level string,
+        so creating one again (including as the result of arithmetic) is a dictionary lookup.
     """
+    __slots__ = ("lvl", "val")
+
+    ## one instance per level string
+    _interned = {}
+
     ## make the class behave
-    def __init__(self, tax_lvl):
+    def __new__(cls, tax_lvl):
+        level = cls._interned.get(tax_lvl)
+        if level is None:
+            level = super().__new__(cls)
+            object.__setattr__(level, "lvl", tax_lvl)
+            object.__setattr__(level, "val", level_value(tax_lvl))
+            cls._interned[tax_lvl] = level
+        return level
 
-        self.lvl = tax_lvl
-        if len(tax_lvl[1:]) > 0:
-            self.val = int(tax_lvl[1:])
-        else:
-            self.val = 0
+    def __setattr__(self, name, value):
+        raise AttributeError("TaxonLevel is immutable.")
+
+    def __hash__(self):
+        return hash(self.val)
 
     ## dress up the class properly
     def __repr__(self):
@@ -42,7 +57,7 @@ class TaxonLevel:
             raise TypeError(f"{other} not of type TaxonLevel.")
         return self.val > other.val
 
-    def __ls__(self, other):
+    def __lt__(self, other):
         if not isinstance(other, TaxonLevel):
             raise TypeError(f"{other} not of type TaxonLevel.")
         return self.val < other.val
@@ -90,6 +105,19 @@ class TaxonLevel:
 
         return ["S"+str(i) for i in range(self.val+1, other.val)]
 
+## integer value of a taxon level string, e.g. "S" -> 0, "S3" -> 3
+## parsed once per level string, then looked up
+_level_values = {}
+def level_value(tax_lvl):
+    val = _level_values.get(tax_lvl)
+    if val is None:
+        val = _level_values[tax_lvl] = int(tax_lvl[1:]) if len(tax_lvl) > 1 else 0
+    return val
+
+## taxon level string for an integer value, e.g. 0 -> "S", 3 -> "S3"
+def level_name(val):
+    return "S" + str(val) if val > 0 else "S"
+
 ## find indices of a target element in code
 def find_locs(target, input_list):
     return [i for i, n in enumerate(input_list) if n == target]
@@ -1,5 +1,59 @@
 import logging
-from kraken2ref.taxonlevel import TaxonLevel, find_parent
+from collections.abc import Mapping
+from kraken2ref.taxonlevel import level_value, level_name
+from kraken2ref.reportstore import gather
+
+class SubtreeView(Mapping):
+    """Read-only view of a graph restricted to a subset of its nodes.
+        Behaves like the graph dict that would be built for those nodes, without building it:
+        the children of each node are filtered from the full graph when looked up
+        (or, for nodes with more children than the view has nodes, found from parent pointers).
+    """
+    __slots__ = ("graph", "nodes", "node_set", "parents")
+
+    def __init__(self, graph: dict, nodes: list, parents: dict = None):
+        """Initialiser
+
+        Args:
+            graph (dict): Full graph the view is over
+            nodes (list): Nodes in the view, sorted
+            parents (dict, optional): Parent of each node in the full graph. Defaults to None.
+        """
+        self.graph = graph
+        self.nodes = nodes
+        self.node_set = set(nodes)
+        self.parents = parents
+
+    def __getitem__(self, node):
+        if node not in self.node_set:
+            raise KeyError(node)
+        children = self.graph[node]
+        if self.parents is not None and len(children) > len(self.nodes):
+            return [child for child in self.nodes if self.parents[child] == node]
+        return [child for child in children if child in self.node_set]
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def items(self):
+        ## all children at once, in one pass over the view's nodes
+        if self.parents is None:
+            return super().items()
+        children = {node: [] for node in self.nodes}
+        for node in self.nodes:
+            parent = self.parents[node]
+            if parent in children:
+                children[parent].append(node)
+        return children.items()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.node_set
+
+    def __repr__(self):
+        return f"SubtreeView({dict(self.items())})"
 
 class TaxonomyTree:
     """Class to encapsulate taxonomy tree and handle related exceptions/standard behaviours
@@ -21,29 +75,111 @@ class TaxonomyTree:
 
         if nodes:
             self.nodes = sorted(nodes)
-            self.graph = self.build_from(self.nodes)
+            self.parents = self.find_parents(self.nodes)
+            self.graph = self.build_from(self.nodes, self.parents)
 
         if tree:
             self.nodes = sorted(list(tree.keys()))
             self.graph = tree
+            self.parents = self.parents_from(tree)
 
         self.root = self.nodes[0]
         self.root_idx = self.root[0]
+        ## filled by get_taxids
+        self.taxids = None
+
+        ## single pass over nodes (already sorted) to find the deepest level, leaves and internal nodes
+        max_val = -1
+        leaf_nodes, internal_nodes = [], []
+        for node in self.nodes:
+            val = level_value(node[1])
+            if val > max_val:
+                max_val, self.max_lvl = val, node[1]
+            if len(self.graph[node]) == 0:
+                leaf_nodes.append(node)
+            else:
+                internal_nodes.append(node)
 
-        self.max_lvl = max([TaxonLevel(t) for (i, t) in self.nodes]).lvl
-
-        self.leaf_lvls = sorted(set([t for (i, t) in self.graph.keys() if len(self.graph[(i, t)]) == 0]))
-        self.subterminal_lvls = [(TaxonLevel(t) - 1).lvl for t in self.leaf_lvls]
+        self.leaf_lvls = sorted(set([t for (i, t) in leaf_nodes]))
+        self.subterminal_lvls = [level_name(max(level_value(t) - 1, 0)) for t in self.leaf_lvls]
         self.complexity = self.get_tree_complexity(self.graph)
 
-        self.subterminal_nodes = sorted([node for node in self.nodes if node[1] in self.subterminal_lvls and len(self.graph[node]) > 0])
-        self.leaf_nodes = sorted([node for node in self.nodes if node[1] in self.leaf_lvls and len(self.graph[node]) == 0])
+        subterminal_lvls = set(self.subterminal_lvls)
+        self.subterminal_nodes = [node for node in internal_nodes if node[1] in subterminal_lvls]
+        self.leaf_nodes = leaf_nodes
         if self.complexity > 0:
-            self.subgraphs = self.decompose_tree(self.graph, [])
+            self.subgraphs = self.decompose_tree(self.graph)
         else:
             self.subgraphs = None
 
-    def build_from(self, node_list: list):
+    @classmethod
+    def from_parts(cls, nodes: list, parents: dict, leaf_nodes: list, subterminal_nodes: list, max_lvl: str, taxids: list = None):
+        """Set up a simple tree from a structure worked out before (see `TopologyCache`), without finding parents,
+            leaves or complexity again. Gives the same tree as building it from `nodes` when that has complexity 0.
+
+        Args:
+            nodes (list(tuple)): Nodes of the tree, sorted
+            parents (dict): Parent of each node (None for the root)
+            leaf_nodes (list(tuple)): Nodes without children, in node order
+            subterminal_nodes (list(tuple)): Internal nodes one level above a leaf level, in node order
+            max_lvl (str): Deepest taxon level in the tree
+            taxids (list, optional): Taxonomy ID of each node, if already known (see `get_taxids`). Defaults to None.
+
+        Returns:
+            (TaxonomyTree): The simple tree
+        """
+        tree = cls.__new__(cls)
+        tree.nodes = nodes
+        tree.parents = parents
+        tree.graph = tree.build_from(nodes, parents)
+        tree.root = nodes[0]
+        tree.root_idx = tree.root[0]
+        tree.taxids = taxids
+        tree.max_lvl = max_lvl
+        tree.leaf_lvls = sorted(set([t for (i, t) in leaf_nodes]))
+        tree.subterminal_lvls = [level_name(max(level_value(t) - 1, 0)) for t in tree.leaf_lvls]
+        tree.complexity = 0
+        tree.subterminal_nodes = subterminal_nodes
+        tree.leaf_nodes = leaf_nodes
+        tree.subgraphs = None
+        return tree
+
+    def find_parents(self, node_list: list):
+        """Find the parent of every node in a list of indexed nodes, in one pass.
+            A node is the child of the node before it if that is at a higher taxon level (e.g. S1 -> S2);
+            otherwise, of the closest preceding node one level above it.
+
+        Args:
+            node_list (list(tuples)): List of nodes; each node is represented as a tuple,
+                    where:
+                        node[0] = index of that node in the original data
+                        node[1] = taxon level of that node ("S"/"S1"/etc)
+
+        Returns:
+            parents (dict): Parent node of each node (None for the first node)
+        """
+        parents = {}
+
+        ## last node seen at each level, to backtrack to
+        last_at_level = {}
+        prev_val = None
+        for indexed_node in node_list:
+            val = level_value(indexed_node[1])
+            if prev_val is None:
+                parents[indexed_node] = None
+            elif prev_val < val:
+                parents[indexed_node] = last_at_level[prev_val]
+            else:
+                parent_val = max(val - 1, 0)
+                if parent_val not in last_at_level:
+                    raise ValueError(f"No parent found for node {indexed_node}: no preceding node at level {'S' + str(parent_val) if parent_val else 'S'}.")
+                parents[indexed_node] = last_at_level[parent_val]
+            last_at_level[val] = indexed_node
+            prev_val = val
+
+        return parents
+
+    def build_from(self, node_list: list, parents: dict = None):
         """Function to build a graph representation from a list of indexed nodes.
 
         Args:
@@ -51,6 +187,7 @@ class TaxonomyTree:
                     where:
                         node[0] = index of that node in the original data
                         node[1] = taxon level of that node ("S"/"S1"/etc)
+            parents (dict, optional): Parent of each node, as returned by `find_parents`. Defaults to None (found from node_list).
 
         Returns:
             graph (dict): A dictionary representation of the graph, where:
@@ -58,48 +195,68 @@ class TaxonomyTree:
                         value = Target node
                         (Nodes are represented as described above)
         """
+        if parents is None:
+            parents = self.find_parents(node_list)
 
-        ## initialise required data structures for graph building
-        graph = {}
+        graph = {indexed_node: [] for indexed_node in node_list}
+        for indexed_node in node_list:
+            parent = parents[indexed_node]
+            if parent is not None:
+                graph[parent].append(indexed_node)
 
-        plain_levels = []  ## e.g. ["S", "S1", "S2", "S3", "S3"]
+        return graph
 
-        ## levels_as_taxa is used to backtrack
-        ## good to have it computed once as will probably be needed often
-        levels_as_taxa = []  ## same as above except as list of TaxonLevel objects
+    def parents_from(self, graph: dict):
+        """Find the parent of every node in a graph
 
-        ## iterate over node_list list
-        ## (looks like: [(11,"S"), (12,"S1)", (13,"S2"), (14,"S3"), (15,"S3")] )
-        ## to populate data structures
-        for indexed_node in node_list:
-            graph[indexed_node] = []
-            plain_levels.append(indexed_node[1])
-            levels_as_taxa.append(TaxonLevel(indexed_node[1]))
-
-        ## set up counters for list trawling
-        start = 0
-
-        ## trawl over list to find edges in graph
-        while start < len(plain_levels)-1:
-            end = start + 1
-            left_node = TaxonLevel(plain_levels[start])
-            right_node = TaxonLevel(plain_levels[end])
-
-            ## if left node less than right node: that's an edge
-            if left_node < right_node:
-                ## generalise this, do not depend on offset
-                graph[node_list[start]].append(node_list[end])
-
-            ## if left node equals right node: oops! find the closest parent
-            if left_node >= right_node:
-                sublist = levels_as_taxa[:end]
-                parent = right_node - 1
-                parent_idx = find_parent(sublist, parent)
-                ## generalise this, do not depend on offset
-                graph[node_list[parent_idx]].append(node_list[end])
-            start += 1
+        Args:
+            graph (dict): A dictionary representation of the graph, where:
+                        key = Source node
+                        value = Target node
+                        (Nodes are represented as described elsewhere)
 
-        return graph
+        Returns:
+            parents (dict): Parent node of each node (None for nodes without one, i.e. the root)
+        """
+        parents = {node: None for node in graph}
+        for node, children in graph.items():
+            for child in children:
+                parents[child] = node
+        return parents
+
+    def find_path(self, target: tuple, parents: dict = None):
+        """Find the path from the root to a node, following parent pointers back up from it.
+            Takes O(depth) steps, as a tree has exactly one path from its root to each node.
+
+        Args:
+            target (tuple): Node to find the path to
+            parents (dict, optional): Parent of each node, for a graph other than this tree's. Defaults to None (this tree's parents).
+
+        Returns:
+            path (list): Nodes from the root to `target`, inclusive
+        """
+        if parents is None:
+            parents = self.parents
+        path = []
+        node = target
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return path
+
+    def get_taxids(self, data_dict: dict):
+        """Taxonomy IDs of all nodes in this tree, in node order. Computed once, then cached.
+
+        Args:
+            data_dict (dict/ReportStore): data_dict for the report this tree is from (node -> (..., taxID, ...))
+
+        Returns:
+            taxids (list): Taxonomy ID of each node
+        """
+        if self.taxids is None:
+            self.taxids = gather(data_dict, 2, self.nodes)
+        return self.taxids
 
     def get_tree_complexity(self, graph: dict):
         """Get a measure of graph "complexity" based on multiplicity of nodes at each level.
@@ -127,7 +284,7 @@ class TaxonomyTree:
         if len(terminal_levels) > 1:
             complexity = 2
         else:
-            breadth_indicator_level = (TaxonLevel(list(terminal_levels)[0]) - 1).lvl
+            breadth_indicator_level = level_name(max(level_value(list(terminal_levels)[0]) - 1, 0))
             indicator_nodes = [node for node in graph.keys() if node[1] == breadth_indicator_level]
             if len(indicator_nodes) > 1:
                 complexity = 1
@@ -203,15 +360,15 @@ class TaxonomyTree:
             subgraphs (list): List of subgraphs found after splitting intput graph at given level
         """
         subgraphs = []
-        root = sorted(list(graph.keys()))[0]
 
         split_points = [k for k in graph.keys() if k[1] == split_at]
         if len(split_points) <= 1:
             logging.debug(msg=f"Can't split at {split_at}")
             return graph
 
+        parents = self.parents if graph is self.graph else self.parents_from(graph)
         for split_pt in split_points:
-            path_to_split_pt = self.find_all_paths(graph, root, split_pt)[0]
+            path_to_split_pt = self.find_path(split_pt, parents)
             if len(graph[split_pt]) != 0:
                 post_split_leaves = graph[split_pt]
                 path_to_split_pt.extend(post_split_leaves)
@@ -224,42 +381,67 @@ class TaxonomyTree:
 
         return subgraphs
 
-    def decompose_tree(self, graph: dict, known_trees: list = []):
+    def decompose_tree(self, graph: dict, known_trees: list = None):
         """Split a complex graph into simple graphs.
             Here, a simple graph is defined as one where there is only one node at all levels except the lowest one.
+            The graph is split at the highest level with more than one node, into one subgraph per node at that level
+            (holding its path from the root, its children and their children), and subgraphs that are still complex are split again.
+            Splitting is done with an explicit stack rather than recursion, and subgraphs are SubtreeViews over the input graph rather than rebuilt graphs.
 
         Args:
             graph (dict): A dictionary representation of the graph, where:
                         key = Source node
                         value = Target node
                         (Nodes are represented as described elsewhere)
-            known_subgraphs (list, optional): List of known subgraphs to output. Defaults to [].
+            known_trees (list, optional): List of known subgraphs to add to. Defaults to None.
 
         Returns:
-            subgraphs (list(dicts)): List of simple subgraphs decomposed from input graph
+            subgraphs (list(SubtreeView)): List of simple subgraphs decomposed from input graph (after any `known_trees`)
         """
         ## collect known subgraphs
-        subgraphs = known_trees
-
-        ## get a list of taxon levels and find the highest level with count > 1
-        levels_list = [k[1] for k in graph.keys()]
-        for i in sorted(levels_list):
-            if levels_list.count(i) > 1:
-                multiplicity_level = i
-                break
-
-        ## dump graphs split at level identified above into temporary list
-        ## for each subgraph check if it is simple, if not, call this function on it again
-        tmp_subgraphs = self.split_tree(graph, multiplicity_level)
-
-        for g in tmp_subgraphs:
-            if self.get_tree_complexity(g) == 0:
-                subgraphs.append(g)
+        subgraphs = known_trees if known_trees is not None else []
+
+        ## views are always over the full graph, following its parent pointers
+        full_graph = graph.graph if isinstance(graph, SubtreeView) else graph
+        parents = self.parents if full_graph is self.graph else self.parents_from(full_graph)
+
+        def split(view):
+            ## find the highest level with count > 1
+            level_counts = {}
+            for node in view.nodes:
+                level_counts[node[1]] = level_counts.get(node[1], 0) + 1
+            multiplicity_levels = [lvl for lvl in sorted(level_counts) if level_counts[lvl] > 1]
+            if not multiplicity_levels:
+                return None
+
+            split_views = []
+            for split_pt in view.nodes:
+                if split_pt[1] != multiplicity_levels[0]:
+                    continue
+                split_nodes = self.find_path(split_pt, parents)
+                post_split_leaves = view[split_pt]
+                split_nodes.extend(post_split_leaves)
+                for child in post_split_leaves:
+                    split_nodes.extend(view[child])
+                split_views.append(SubtreeView(full_graph, sorted(split_nodes), parents))
+            return split_views
+
+        ## split depth-first, keeping subgraphs in the order splitting them recursively would give
+        to_check = [iter(split(SubtreeView(full_graph, sorted(graph.keys()), parents)) or [])]
+        while to_check:
+            subgraph = next(to_check[-1], None)
+            if subgraph is None:
+                to_check.pop()
+                continue
+            if self.get_tree_complexity(subgraph) == 0:
+                subgraphs.append(subgraph)
+                continue
+            logging.debug(f"Decomposing {subgraph.nodes} further")
+            split_views = split(subgraph)
+            if split_views is None:
+                ## no level left to split at
+                subgraphs.append(subgraph)
             else:
-                logging.debug(f"Decomposing {g.keys()} further")
-                ## recursion is cool!
-                ## (but only when it works)
-                cmp_subgraphs = self.decompose_tree(g, subgraphs)
+                to_check.append(iter(split_views))
 
         return subgraphs
-
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import hashlib
+import logging
+import numpy as np
+from kraken2ref.reportstore import gather
+from kraken2ref.taxonomytree import TaxonomyTree
+
+## files of a kraken2 database that its taxonomy (and so the structure of reports made with it) depends on
+DATABASE_FILES = ("taxo.k2d", "opts.k2d")
+
+## layout of cache files; caches with another layout are discarded
+CACHE_FORMAT = 2
+
+def database_fingerprint(database_dir: str):
+    """Fingerprint of a kraken2 database, hashed from the files its taxonomy is stored in
+
+    Args:
+        database_dir (str/path): Path to kraken2 database directory
+
+    Returns:
+        fingerprint (str): Hex digest identifying the database
+    """
+    digest = hashlib.sha256()
+    for file_name in DATABASE_FILES:
+        db_path = os.path.join(database_dir, file_name)
+        if not os.path.isfile(db_path):
+            logging.critical(f"Provided kraken2 database at {database_dir} has no {file_name}. Quitting...\n")
+            sys.stderr.write(f"Provided kraken2 database at {database_dir} has no {file_name}. Quitting...\n")
+            sys.exit(1)
+        with open(db_path, "rb") as db_file:
+            for chunk in iter(lambda: db_file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+class BlockTopology:
+    """Structure of one species block: what building its tree and decomposing it into simple trees found,
+        with nodes given by their position in the block. It only depends on the taxIDs and taxon levels of the block,
+        so it holds for the same block in any report made with the same database, wherever the block is in the report.
+    """
+    __slots__ = ("complexity", "parents", "trees")
+
+    def __init__(self, complexity: int, parents: tuple, trees: tuple):
+        """Initialiser
+
+        Args:
+            complexity (int): Complexity of the block's tree (see `TaxonomyTree.get_tree_complexity`)
+            parents (tuple(int)): Position of the parent of each node in the block (-1 for the species node)
+            trees (tuple(tuple)): For each simple tree, the positions of its nodes, of its leaf nodes and of its subterminal nodes, and its deepest level
+        """
+        self.complexity = complexity
+        self.parents = parents
+        self.trees = trees
+
+    @classmethod
+    def from_trees(cls, node_list: list, tree: TaxonomyTree, simple_trees: list):
+        """Record the structure of a block from its tree and simple trees
+
+        Args:
+            node_list (list(tuple)): Nodes of the species block, in report order
+            tree (TaxonomyTree): Tree built from `node_list`
+            simple_trees (list(TaxonomyTree)): Simple trees found in `tree` (see `KrakenProcessor.find_simple_trees`)
+
+        Returns:
+            (BlockTopology): Structure of the block, or None if a simple tree could not be decomposed (complexity > 0)
+        """
+        if any(simple_tree.complexity > 0 for simple_tree in simple_trees):
+            return None
+        position = {node: pos for pos, node in enumerate(node_list)}
+        parents = tuple(-1 if tree.parents[node] is None else position[tree.parents[node]] for node in node_list)
+        trees = tuple((
+                        tuple(position[node] for node in simple_tree.nodes),
+                        tuple(position[node] for node in simple_tree.leaf_nodes),
+                        tuple(position[node] for node in simple_tree.subterminal_nodes),
+                        simple_tree.max_lvl,
+                    ) for simple_tree in simple_trees)
+        return cls(tree.complexity, parents, trees)
+
+    def to_json(self):
+        """Structure as plain lists, to be stored in a JSON cache file
+
+        Returns:
+            (list): [complexity, parents, trees]
+        """
+        return [self.complexity, list(self.parents), [list(map(list, tree[:3])) + [tree[3]] for tree in self.trees]]
+
+    @classmethod
+    def from_json(cls, stored: list):
+        """Structure read back from a JSON cache file, checked to be one `from_trees` could have recorded
+
+        Args:
+            stored (list): Structure, as returned by `to_json`
+
+        Raises:
+            ValueError: If `stored` is not a valid block structure
+
+        Returns:
+            (BlockTopology): The structure
+        """
+        def is_int(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        complexity, parents, trees = stored
+        num_nodes = len(parents)
+        ## each node's parent comes before it in the block
+        if not is_int(complexity) or not all(is_int(parent) and -1 <= parent < pos for pos, parent in enumerate(parents)):
+            raise ValueError("invalid block structure")
+        checked_trees = []
+        for positions, leaf_positions, subterminal_positions, max_lvl in trees:
+            ## a simple tree's nodes are sorted, and hold the parents of all but its root, and its leaves and subterminal nodes
+            if not all(is_int(pos) and 0 <= pos < num_nodes for pos in positions) or not all(a < b for a, b in zip(positions, positions[1:])):
+                raise ValueError("invalid simple tree positions")
+            node_set = set(positions)
+            if len(positions) == 0 or parents[positions[0]] in node_set or not all(parents[pos] in node_set for pos in positions[1:]):
+                raise ValueError("invalid simple tree parents")
+            if not all(pos in node_set for pos in [*leaf_positions, *subterminal_positions]) or not isinstance(max_lvl, str):
+                raise ValueError("invalid simple tree")
+            checked_trees.append((tuple(positions), tuple(leaf_positions), tuple(subterminal_positions), max_lvl))
+        return cls(complexity, tuple(parents), tuple(checked_trees))
+
+    def simple_trees(self, node_list: list, taxids: list):
+        """Set up the simple trees of a block with this structure
+
+        Args:
+            node_list (list(tuple)): Nodes of the species block, in report order
+            taxids (list(int)): Taxonomy ID of each node in the block
+
+        Returns:
+            simple_trees (list(TaxonomyTree)): The same simple trees as building and decomposing the block's tree gives
+        """
+        parents = self.parents
+        simple_trees = []
+        for positions, leaf_positions, subterminal_positions, max_lvl in self.trees:
+            simple_trees.append(TaxonomyTree.from_parts(
+                nodes = [node_list[pos] for pos in positions],
+                parents = {node_list[pos]: node_list[parents[pos]] if parents[pos] >= 0 else None for pos in positions},
+                leaf_nodes = [node_list[pos] for pos in leaf_positions],
+                subterminal_nodes = [node_list[pos] for pos in subterminal_positions],
+                max_lvl = max_lvl,
+                taxids = [taxids[pos] for pos in positions],
+            ))
+        return simple_trees
+
+class TopologyCache:
+    """Cache of species block structures (`BlockTopology`), kept on disk so that it can be reused across samples.
+        Blocks are keyed by their sequence of taxIDs and taxon levels, and a cache file belongs to one database (by fingerprint):
+        a cache file for another database, or in another layout, is discarded and replaced when saved.
+    """
+    def __init__(self, cache_file: str = None, fingerprint: str = None):
+        """Initialiser. Loads the cache from `cache_file` if it exists.
+
+        Args:
+            cache_file (str/path, optional): Path to cache file. Defaults to None (in-memory cache only).
+            fingerprint (str, optional): Fingerprint of the database reports are made with (see `database_fingerprint`). Defaults to None.
+        """
+        self.cache_file = cache_file
+        self.fingerprint = fingerprint
+        self.topologies = {}
+        ## topologies found since the cache was loaded (or since `take_new`)
+        self.new_topologies = {}
+        self.hits = 0
+        self.misses = 0
+
+        if cache_file is not None and os.path.exists(cache_file):
+            self.load()
+
+    def load(self):
+        """Load block structures from the (JSON) cache file, unless it was made for another database or in another layout.
+            A cache file that cannot be read or holds anything but valid block structures is ignored, as if empty.
+        """
+        try:
+            with open(self.cache_file, "r") as cache:
+                stored = json.load(cache)
+            if not isinstance(stored, dict) or stored.get("format") != CACHE_FORMAT:
+                logging.warning(f"Topology cache {self.cache_file} has an unknown layout; starting a new cache.")
+                return
+            if stored.get("fingerprint") != self.fingerprint:
+                logging.warning(f"Topology cache {self.cache_file} was made for another database; starting a new cache.")
+                return
+            topologies = {str(key): BlockTopology.from_json(topology) for key, topology in stored["topologies"].items()}
+        except Exception as error:
+            logging.warning(f"Could not read topology cache {self.cache_file} ({type(error).__name__}: {error}); starting a new cache.")
+            return
+
+        self.topologies = topologies
+        logging.info(f"Loaded {len(self.topologies)} block topologies from {self.cache_file}.")
+
+    def save(self):
+        """Write the cache file, if any block structures were added. The file is replaced in one step, so it is never left half-written.
+        """
+        if self.cache_file is None or len(self.new_topologies) == 0:
+            return
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        stored = {
+                    "format": CACHE_FORMAT,
+                    "fingerprint": self.fingerprint,
+                    "topologies": {key: topology.to_json() for key, topology in self.topologies.items()}
+                }
+        with open(tmp_file, "w") as cache:
+            json.dump(stored, cache, separators = (",", ":"))
+        os.replace(tmp_file, self.cache_file)
+        logging.info(f"Saved {len(self.topologies)} block topologies ({len(self.new_topologies)} new) to {self.cache_file}.")
+        self.new_topologies = {}
+
+    def block_key(self, node_list: list, data_dict: dict):
+        """Key of a species block: a digest of its taxIDs and taxon levels, in report order
+
+        Args:
+            node_list (list(tuple)): Nodes of the species block, in report order
+            data_dict (dict/ReportStore): Data for (at least) the nodes in this block
+
+        Returns:
+            key (str): Key of the block (hex digest)
+            taxids (list(int)): Taxonomy ID of each node in the block
+        """
+        taxids = gather(data_dict, 2, node_list)
+        digest = hashlib.blake2b(np.array(taxids, dtype = np.int64).tobytes(), digest_size = 16)
+        digest.update("\t".join([node[1] for node in node_list]).encode())
+        return digest.hexdigest(), taxids
+
+    def get(self, key: str, num_nodes: int):
+        """Structure of a block, counting hits and misses
+
+        Args:
+            key (str): Key of the block (see `block_key`)
+            num_nodes (int): Number of nodes in the block; a cached structure for another number of nodes is not used
+
+        Returns:
+            (BlockTopology): Structure of the block, or None if it is not cached
+        """
+        topology = self.topologies.get(key)
+        if topology is not None and len(topology.parents) != num_nodes:
+            topology = None
+        if topology is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return topology
+
+    def add(self, key: str, topology: BlockTopology):
+        """Add the structure of a block
+
+        Args:
+            key (str): Key of the block (see `block_key`)
+            topology (BlockTopology): Structure of the block
+        """
+        self.topologies[key] = topology
+        self.new_topologies[key] = topology
+
+    def update(self, topologies: dict):
+        """Add the structures of several blocks, e.g. found by a worker process (see `take_new`)
+
+        Args:
+            topologies (dict): Structure of each block, by key
+        """
+        self.topologies.update(topologies)
+        self.new_topologies.update(topologies)
+
+    def take_new(self):
+        """Block structures added since the cache was loaded or this was last called, to be passed on to another cache
+
+        Returns:
+            new_topologies (dict): Structure of each new block, by key
+        """
+        new_topologies = self.new_topologies
+        self.new_topologies = {}
+        return new_topologies
@@ -1,7 +1,7 @@
-import json
+import io, os, gc, gzip, json, pytest, shutil, threading
 from Bio import SeqIO
-from kraken2ref import sort_reads
-from kraken2ref.dump_fastqs import dump_to_files
+from kraken2ref import sort_reads, dump_fastqs
+from kraken2ref.dump_fastqs import dump_to_files, merge_shards
 from kraken2ref.kraken2reference import KrakenProcessor
 
 def test_dump_basic(tmp_path):
@@ -29,3 +29,307 @@ def test_dump_basic(tmp_path):
         recs = list(SeqIO.parse(filepath, "fastq"))
         assert len(recs) == num_reads_expected, f"File {filepath} does not contain the expected number of reads {num_reads_expected}"
 
+
+FQ1 = "tests/test_set/with_fluseg_db/testset_50x.unclass_seqs_1.fq"
+FQ2 = "tests/test_set/with_fluseg_db/testset_50x.unclass_seqs_2.fq"
+
+def make_tax_to_read_ids():
+    ## group test reads by the accession in their read ID, eg. KJ817798.1-1234/1
+    tax_to_read_ids = {}
+    for rec in SeqIO.parse(FQ1, "fastq"):
+        rid = rec.id[:-2]
+        tax_to_read_ids.setdefault(rid.split("-")[0], []).append(rid)
+    return tax_to_read_ids
+
+def read_ids_in(filepath):
+    return [rec.id for rec in SeqIO.parse(filepath, "fastq")]
+
+def test_dump_sharded(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    dump_to_files(sample_id="full", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path)
+    for shard_idx in range(1, 4):
+        dump_to_files(sample_id="sharded", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, shard=(shard_idx, 3))
+
+    ## every read lands in exactly one shard
+    shard_1 = read_ids_in(f"{tmp_path}/sharded_KJ817798.1_R1.shard1-of-3.fq")
+    shard_2 = read_ids_in(f"{tmp_path}/sharded_KJ817798.1_R1.shard2-of-3.fq")
+    assert len(shard_1) > 0 and len(shard_2) > 0
+    assert not set(shard_1) & set(shard_2)
+
+    merged = merge_shards("sharded", tmp_path, tmp_path)
+    assert len(merged) == 6
+    for taxid in tax_to_read_ids_here:
+        for read in ["R1", "R2"]:
+            full_ids = read_ids_in(f"{tmp_path}/full_{taxid}_{read}.fq")
+            merged_ids = read_ids_in(f"{tmp_path}/sharded_{taxid}_{read}.fq")
+            assert sorted(full_ids) == sorted(merged_ids)
+        r1_ids = read_ids_in(f"{tmp_path}/sharded_{taxid}_R1.fq")
+        r2_ids = read_ids_in(f"{tmp_path}/sharded_{taxid}_R2.fq")
+        assert [i[:-2] for i in r1_ids] == [i[:-2] for i in r2_ids], "R1 and R2 out of sync after merge"
+
+    ## shard files are cleaned up after merging
+    assert not list(tmp_path.glob("*.shard*"))
+
+def test_merge_incomplete_shards(tmp_path):
+    dump_to_files(sample_id="partial", tax_to_readids_dict=make_tax_to_read_ids(), fq1=FQ1, fq2=FQ2, outdir=tmp_path, shard=(1, 2))
+    with pytest.raises(FileNotFoundError):
+        merge_shards("partial", tmp_path, tmp_path)
+
+def test_dump_to_stdout(tmp_path, capsys):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    dump_to_files(sample_id="streamed", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, stream_taxid="KJ817798.1")
+
+    ## interleaved: R1, R2, R1, R2...
+    interleaved = list(SeqIO.parse(io.StringIO(capsys.readouterr().out), "fastq"))
+    assert len(interleaved) == 2 * len(tax_to_read_ids_here["KJ817798.1"])
+    assert [rec.id[-2:] for rec in interleaved[:4]] == ["/1", "/2", "/1", "/2"]
+    assert not list(tmp_path.glob("*.fq"))
+
+def test_dump_to_fifos(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    for taxid in tax_to_read_ids_here:
+        for read in ["R1", "R2"]:
+            os.mkfifo(f"{tmp_path}/piped_{taxid}_{read}.fq")
+
+    ## one consumer per pipe, as an aligner would
+    received = {}
+    def consume(path):
+        with open(path, "r") as fifo:
+            received[path] = len(list(SeqIO.parse(fifo, "fastq")))
+    consumers = [threading.Thread(target=consume, args=(str(path),)) for path in tmp_path.glob("*.fq")]
+    for consumer in consumers:
+        consumer.start()
+
+    dump_to_files(sample_id="piped", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path)
+    for consumer in consumers:
+        consumer.join()
+
+    for taxid, read_ids in tax_to_read_ids_here.items():
+        assert received[f"{tmp_path}/piped_{taxid}_R1.fq"] == len(read_ids)
+        assert received[f"{tmp_path}/piped_{taxid}_R2.fq"] == len(read_ids)
+
+def test_dump_max_reads_per_file(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    dump_to_files(sample_id="split", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, max_reads_per_file=100)
+
+    manifest = json.load(open(f"{tmp_path}/split_dump_manifest.json", "r"))
+    assert sorted(manifest["taxa"].keys()) == sorted(tax_to_read_ids_here.keys())
+    assert [part["num_reads"] for part in manifest["taxa"]["KJ817798.1"]] == [100, 100, 98]
+    assert [part["num_reads"] for part in manifest["taxa"]["AY353550.1"]] == [3]
+
+    for taxid, parts in manifest["taxa"].items():
+        r1_ids, r2_ids = [], []
+        for part in parts:
+            part_r1_ids = read_ids_in(f"{tmp_path}/{part['R1']}")
+            part_r2_ids = read_ids_in(f"{tmp_path}/{part['R2']}")
+            assert len(part_r1_ids) == len(part_r2_ids) == part["num_reads"]
+            r1_ids.extend(part_r1_ids)
+            r2_ids.extend(part_r2_ids)
+        assert [i[:-2] for i in r1_ids] == [i[:-2] for i in r2_ids], "R1 and R2 out of sync across parts"
+        assert sorted(i[:-2] for i in r1_ids) == sorted(tax_to_read_ids_here[taxid])
+
+def test_dump_unassigned(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    unassigned_read_ids = tax_to_read_ids_here.pop("KJ817799.1")
+    dump_to_files(sample_id="leftover", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, write_unassigned=True, compress_unassigned=True)
+
+    with gzip.open(f"{tmp_path}/leftover_unassigned_R1.fq.gz", "rt") as unassigned_r1:
+        r1_ids = [rec.id[:-2] for rec in SeqIO.parse(unassigned_r1, "fastq")]
+    with gzip.open(f"{tmp_path}/leftover_unassigned_R2.fq.gz", "rt") as unassigned_r2:
+        r2_ids = [rec.id[:-2] for rec in SeqIO.parse(unassigned_r2, "fastq")]
+    assert r1_ids == r2_ids
+    assert sorted(r1_ids) == sorted(unassigned_read_ids)
+
+def test_dump_stats(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    dump_to_files(sample_id="stats", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, collect_stats=True)
+    stats = json.load(open(f"{tmp_path}/stats_dump_stats.json", "r"))
+
+    ## check against a separate pass over the written file
+    recs = list(SeqIO.parse(f"{tmp_path}/stats_KJ817798.1_R1.fq", "fastq"))
+    r1_stats = stats["KJ817798.1"]["R1"]
+    total_bases = sum(len(rec) for rec in recs)
+    assert r1_stats["num_reads"] == len(recs)
+    assert r1_stats["total_bases"] == total_bases
+    assert r1_stats["gc_bases"] == sum(rec.seq.count("G") + rec.seq.count("C") for rec in recs)
+    assert r1_stats["quality_sum"] == sum(sum(rec.letter_annotations["phred_quality"]) for rec in recs)
+    assert sum(r1_stats["length_distribution"].values()) == len(recs)
+
+    ## sharded stats combine to the same totals
+    for shard_idx in range(1, 3):
+        dump_to_files(sample_id="stats_sharded", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, shard=(shard_idx, 2), collect_stats=True)
+    merge_shards("stats_sharded", tmp_path, tmp_path)
+    assert json.load(open(f"{tmp_path}/stats_sharded_dump_stats.json", "r")) == stats
+
+def test_dump_resume(tmp_path, monkeypatch):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    tax_to_read_ids_here.pop("KJ817799.1")
+    options = dict(tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, write_unassigned=True, compress_unassigned=True, collect_stats=True)
+    (tmp_path / "full").mkdir()
+    (tmp_path / "resumed").mkdir()
+    dump_to_files(sample_id="run", outdir=f"{tmp_path}/full", **options)
+
+    ## interrupt the run 50 read pairs after its third checkpoint
+    read_id_of = dump_fastqs.fastq_read_id
+    calls = []
+    def preempted(record):
+        calls.append(record)
+        if len(calls) > 350:
+            raise KeyboardInterrupt
+        return read_id_of(record)
+    monkeypatch.setattr(dump_fastqs, "fastq_read_id", preempted)
+    try:
+        dump_to_files(sample_id="run", outdir=f"{tmp_path}/resumed", checkpoint_every=100, **options)
+    except KeyboardInterrupt:
+        pass
+    ## make sure abandoned handles have flushed, as they would have when the process died
+    gc.collect()
+    assert os.path.exists(f"{tmp_path}/resumed/run_dump_checkpoint.json")
+    assert json.load(open(f"{tmp_path}/resumed/run_dump_checkpoint.json", "r"))["pairs_processed"] == 300
+
+    monkeypatch.setattr(dump_fastqs, "fastq_read_id", read_id_of)
+    dump_to_files(sample_id="run", outdir=f"{tmp_path}/resumed", checkpoint_every=100, resume=True, **options)
+
+    assert not os.path.exists(f"{tmp_path}/resumed/run_dump_checkpoint.json")
+    for name in ["run_KJ817798.1_R1.fq", "run_KJ817798.1_R2.fq", "run_AY353550.1_R1.fq", "run_dump_stats.json"]:
+        assert open(f"{tmp_path}/resumed/{name}", "rb").read() == open(f"{tmp_path}/full/{name}", "rb").read(), f"{name} differs after resume"
+    for name in ["run_unassigned_R1.fq.gz", "run_unassigned_R2.fq.gz"]:
+        assert gzip.open(f"{tmp_path}/resumed/{name}").read() == gzip.open(f"{tmp_path}/full/{name}").read(), f"{name} differs after resume"
+
+def test_dump_single_end(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    dump_to_files(sample_id="paired", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, write_unassigned=True, collect_stats=True)
+    ## small pieces, so every line is copied in several parts
+    dump_to_files(sample_id="single", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=None, outdir=tmp_path, write_unassigned=True, collect_stats=True, piece_size=16)
+
+    for taxid in ["KJ817798.1", "KJ817799.1", "AY353550.1", "unassigned"]:
+        assert not os.path.exists(f"{tmp_path}/single_{taxid}_R1.fq")
+        assert open(f"{tmp_path}/single_{taxid}.fq", "rb").read() == open(f"{tmp_path}/paired_{taxid}_R1.fq", "rb").read()
+
+    paired_stats = json.load(open(f"{tmp_path}/paired_dump_stats.json", "r"))
+    single_stats = json.load(open(f"{tmp_path}/single_dump_stats.json", "r"))
+    assert single_stats == {taxid: {"SE": stats["R1"]} for taxid, stats in paired_stats.items()}
+
+def test_dump_mmap(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    ## last record without its trailing newline
+    fq2_no_newline = f"{tmp_path}/no_newline_2.fq"
+    open(fq2_no_newline, "wb").write(open(FQ2, "rb").read().rstrip(b"\n"))
+    options = dict(tax_to_readids_dict=tax_to_read_ids_here, outdir=tmp_path, write_unassigned=True, collect_stats=True)
+
+    dump_to_files(sample_id="read", fq1=FQ1, fq2=fq2_no_newline, **options)
+    dump_to_files(sample_id="mapped", fq1=FQ1, fq2=fq2_no_newline, use_mmap=True, **options)
+    dump_to_files(sample_id="read_se", fq1=FQ1, fq2=None, **options)
+    dump_to_files(sample_id="mapped_se", fq1=FQ1, fq2=None, use_mmap=True, **options)
+
+    for taxid in ["KJ817798.1", "KJ817799.1", "AY353550.1", "unassigned"]:
+        for suffix in ["_R1.fq", "_R2.fq"]:
+            assert open(f"{tmp_path}/mapped_{taxid}{suffix}", "rb").read() == open(f"{tmp_path}/read_{taxid}{suffix}", "rb").read()
+        assert open(f"{tmp_path}/mapped_se_{taxid}.fq", "rb").read() == open(f"{tmp_path}/read_se_{taxid}.fq", "rb").read()
+    for sample in ["", "_se"]:
+        assert json.load(open(f"{tmp_path}/mapped{sample}_dump_stats.json", "r")) == json.load(open(f"{tmp_path}/read{sample}_dump_stats.json", "r"))
+
+def test_dump_interleaved(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    interleaved_fq = f"{tmp_path}/interleaved.fq"
+    with open(FQ1, "rb") as fq1, open(FQ2, "rb") as fq2, open(interleaved_fq, "wb") as out:
+        for rec1, rec2 in zip(dump_fastqs.read_fastq(fq1), dump_fastqs.read_fastq(fq2)):
+            out.write(rec1 + rec2)
+    options = dict(tax_to_readids_dict=tax_to_read_ids_here, outdir=tmp_path, write_unassigned=True, collect_stats=True)
+
+    dump_to_files(sample_id="paired", fq1=FQ1, fq2=FQ2, **options)
+    dump_to_files(sample_id="il", fq1=interleaved_fq, fq2=None, interleaved=True, **options)
+    dump_to_files(sample_id="il_mapped", fq1=interleaved_fq, fq2=None, interleaved=True, use_mmap=True, **options)
+
+    for taxid in ["KJ817798.1", "KJ817799.1", "AY353550.1", "unassigned"]:
+        assert not os.path.exists(f"{tmp_path}/il_{taxid}_R1.fq")
+        with open(f"{tmp_path}/paired_{taxid}_R1.fq", "rb") as fq1, open(f"{tmp_path}/paired_{taxid}_R2.fq", "rb") as fq2:
+            expected = b"".join(rec1 + rec2 for rec1, rec2 in zip(dump_fastqs.read_fastq(fq1), dump_fastqs.read_fastq(fq2)))
+        assert open(f"{tmp_path}/il_{taxid}.fq", "rb").read() == expected
+        assert open(f"{tmp_path}/il_mapped_{taxid}.fq", "rb").read() == expected
+    for sample in ["il", "il_mapped"]:
+        assert json.load(open(f"{tmp_path}/{sample}_dump_stats.json", "r")) == json.load(open(f"{tmp_path}/paired_dump_stats.json", "r"))
+
+    ## a read without its mate is an error
+    open(f"{tmp_path}/odd.fq", "wb").write(open(interleaved_fq, "rb").read() + b"\n".join(open(FQ1, "rb").read().split(b"\n", 4)[:4]) + b"\n")
+    with pytest.raises(ValueError, match="no mate"):
+        dump_to_files(sample_id="odd", fq1=f"{tmp_path}/odd.fq", fq2=None, interleaved=True, **options)
+
+def test_dump_mmap_runs(tmp_path, monkeypatch):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    tax_to_read_ids_here.pop("AY353550.1")
+    copied = []
+    def copy_range(source, handle, start, end):
+        copied.append(end - start)
+        copy_range_of(source, handle, start, end)
+    copy_range_of = dump_fastqs.copy_range
+    monkeypatch.setattr(dump_fastqs, "copy_range", copy_range)
+
+    for options in [dict(), dict(max_reads_per_file=100), dict(checkpoint_every=50)]:
+        options = dict(tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, write_unassigned=True, **options)
+        (tmp_path / "read").mkdir()
+        (tmp_path / "mapped").mkdir()
+        dump_to_files(sample_id="run", outdir=f"{tmp_path}/read", **options)
+        dump_to_files(sample_id="run", outdir=f"{tmp_path}/mapped", use_mmap=True, **options)
+        assert sorted(os.listdir(f"{tmp_path}/mapped")) == sorted(os.listdir(f"{tmp_path}/read"))
+        for name in os.listdir(f"{tmp_path}/read"):
+            assert open(f"{tmp_path}/mapped/{name}", "rb").read() == open(f"{tmp_path}/read/{name}", "rb").read(), f"{name} differs"
+        shutil.rmtree(tmp_path / "read")
+        shutil.rmtree(tmp_path / "mapped")
+
+    ## the dominant taxa are sorted together in the input, so most of their reads were copied as runs
+    assert len(copied) > 0
+
+def test_dump_to_closed_fifo(tmp_path, capsys):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    fifo = f"{tmp_path}/closed_KJ817798.1_R1.fq"
+    os.mkfifo(fifo)
+
+    ## a consumer that exits without reading: with a large buffer, reads only reach the pipe when outputs are closed
+    consumer = threading.Thread(target=lambda: open(fifo, "rb").close())
+    consumer.start()
+    with pytest.raises(BrokenPipeError):
+        dump_to_files(sample_id="closed", tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2, outdir=tmp_path, buffer_size=1 << 24)
+    consumer.join()
+    assert "Output pipe closed by reader" in capsys.readouterr().err
+
+def test_dump_checkpoint_to_fifo(tmp_path):
+    os.mkfifo(f"{tmp_path}/piped_KJ817798.1_R1.fq")
+
+    ## rejected before any pipe is opened (which would block without a reader)
+    for options in [dict(checkpoint_every=100), dict(resume=True)]:
+        with pytest.raises(ValueError, match="named pipe"):
+            dump_to_files(sample_id="piped", tax_to_readids_dict=make_tax_to_read_ids(), fq1=FQ1, fq2=FQ2, outdir=tmp_path, **options)
+    with pytest.raises(ValueError, match="stream_taxid"):
+        dump_to_files(sample_id="streamed", tax_to_readids_dict=make_tax_to_read_ids(), fq1=FQ1, fq2=FQ2, outdir=tmp_path, stream_taxid="KJ817798.1", checkpoint_every=100)
+
+def test_dump_mmap_crlf(tmp_path):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    crlf_fqs = []
+    for fq in [FQ1, FQ2]:
+        crlf_fqs.append(f"{tmp_path}/crlf_{os.path.basename(fq)}")
+        open(crlf_fqs[-1], "wb").write(open(fq, "rb").read().replace(b"\n", b"\r\n"))
+    options = dict(tax_to_readids_dict=tax_to_read_ids_here, fq1=crlf_fqs[0], fq2=crlf_fqs[1], outdir=tmp_path)
+
+    dump_to_files(sample_id="read", **options)
+    dump_to_files(sample_id="mapped", use_mmap=True, **options)
+
+    for taxid in tax_to_read_ids_here:
+        for suffix in ["_R1.fq", "_R2.fq"]:
+            expected = open(f"{tmp_path}/read_{taxid}{suffix}", "rb").read()
+            assert len(expected) > 0
+            assert open(f"{tmp_path}/mapped_{taxid}{suffix}", "rb").read() == expected
+
+def test_dump_mmap_runs_without_copy_file_range(tmp_path, monkeypatch):
+    tax_to_read_ids_here = make_tax_to_read_ids()
+    options = dict(tax_to_readids_dict=tax_to_read_ids_here, fq1=FQ1, fq2=FQ2)
+    dump_to_files(sample_id="read", outdir=tmp_path, **options)
+
+    ## as on platforms without copy_file_range (eg. macOS): runs are written from the mapping
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.setattr(os, "sendfile", None, raising=False)
+    dump_to_files(sample_id="mapped", outdir=tmp_path, use_mmap=True, **options)
+
+    for taxid in tax_to_read_ids_here:
+        for suffix in ["_R1.fq", "_R2.fq"]:
+            assert open(f"{tmp_path}/mapped_{taxid}{suffix}", "rb").read() == open(f"{tmp_path}/read_{taxid}{suffix}", "rb").read()
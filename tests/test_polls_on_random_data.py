@@ -1,6 +1,8 @@
 import numpy as np
+from types import SimpleNamespace
 from kraken2ref.taxonomytree import TaxonomyTree
-from kraken2ref.poll import Poll
+from kraken2ref.poll import Poll, BatchPoll, step_thru, step_thru_back
+from kraken2ref.reportstore import ReportStore
 
 def generate_random_data():
     bulk = np.random.randint(100, 1000, 90)
@@ -70,3 +72,70 @@ def test_polling_with_kmeans():
     assert result_t900 == [(111, 'S3'), (112, 'S3'), (113, 'S3')]
 
 # test_polling_with_kmeans()
+
+def test_polling_with_report_store():
+    tree1, data_dict1 = create_nodes_and_data_dict(random_freqs1)
+    nodes = list(data_dict1.keys())
+    store = ReportStore(nodes, [[data_dict1[node][col] for node in nodes] for col in range(3)])
+    assert store == data_dict1
+    assert (13, "S2") in store and (13, "S3") not in store
+
+    for threshold in [0, 100, 900, 10_000]:
+        for method in ["skew", "tiles", "kmeans"]:
+            from_dict = Poll(taxonomy_tree=tree1, data_dict=data_dict1, threshold=threshold)
+            from_store = Poll(taxonomy_tree=tree1, data_dict=store, threshold=threshold)
+            assert from_store.valid_leaves == from_dict.valid_leaves
+            assert from_store.nodes_to_poll == from_dict.nodes_to_poll
+            assert from_store.dist == from_dict.dist
+            if from_dict.nodes_to_poll is not None:
+                from_dict.poll_leaves(method=method)
+                from_store.poll_leaves(method=method)
+                assert from_store.filt_leaves == from_dict.filt_leaves
+
+def test_batch_polling():
+    trees_and_data = [create_nodes_and_data_dict(freqs) for freqs in [random_freqs1, random_freqs2, random_freqs3]]
+    trees = [tree for tree, _ in trees_and_data]
+    data_dict = {}
+    for i, (_, tree_data_dict) in enumerate(trees_and_data):
+        ## place each tree's data in its own block of rows, as in a report
+        data_dict.update({(node[0] + 200*i, node[1]): data for node, data in tree_data_dict.items()})
+    trees = [TaxonomyTree(nodes=[(node[0] + 200*i, node[1]) for node in tree.nodes]) for i, tree in enumerate(trees)]
+
+    for threshold in [0, 100, 900, 10_000]:
+        for method in ["max", "skew", "tiles", "kmeans"]:
+            batch = BatchPoll(taxonomy_trees=trees, data_dict=data_dict, threshold=threshold)
+            batch.poll_leaves(method=method)
+            for i, tree in enumerate(trees):
+                poll = Poll(taxonomy_tree=tree, data_dict=data_dict, threshold=threshold)
+                assert batch.valid_leaves[i] == poll.valid_leaves
+                assert batch.singleton[i] == poll.singleton
+                assert batch.parent_selected[i] == poll.parent_selected
+                if poll.parent_selected:
+                    assert batch.valid_subterminals[i] == poll.valid_subterminals
+                    assert batch.valid_parent[i] == poll.valid_parent
+                    assert batch.max_leaves[i] == getattr(poll, "max_leaves", None)
+                elif not poll.singleton:
+                    poll.poll_leaves(method=method)
+                    assert batch.filt_leaves[i] == poll.filt_leaves
+                    assert np.isclose(batch.surprise_prefilter[i], poll.surprise_prefilter)
+                    assert np.isclose(batch.postfilter_surprise[i], poll.postfilter_surprise)
+
+def test_skew_pvalue_on_mode_boundary(monkeypatch):
+    tree, data_dict = create_nodes_and_data_dict(random_freqs1)
+    ## p-values on a boundary take the mode below it, in both `Poll` and `BatchPoll`
+    for pvalue, mode in [(0.005, "max"), (0.05, "step")]:
+        monkeypatch.setattr("kraken2ref.poll.sts.skewtest", lambda a, axis = 0: SimpleNamespace(pvalue = np.full(np.shape(a)[:-1], pvalue)))
+        poll = Poll(taxonomy_tree=tree, data_dict=data_dict, threshold=100)
+        poll.poll_leaves(method="skew")
+        batch = BatchPoll(taxonomy_trees=[tree], data_dict=data_dict, threshold=100)
+        batch.poll_leaves(method="skew")
+        assert poll.class_method == batch.class_method[0] == ["skew", mode]
+        assert batch.filt_leaves[0] == poll.filt_leaves
+
+def test_step_thru_with_repeated_frequencies():
+    ## each retained frequency maps back to its own index, including repeated frequencies
+    assert step_thru([375, 375, 350, 275, 250, 225, 150, 125]) == [5, 4, 3, 2, 1, 0]
+    ## if the inflection splits repeated frequencies, the first of them are kept
+    assert step_thru([66, 56, 51, 45, 43, 43, 20, 16, 16]) == [4, 3, 2, 1, 0]
+    assert step_thru_back([9000, 100, 100, 90, 5, 5]) == [0, 1, 2, 3]
+    assert step_thru_back([200_000, 100_000, 100_000, 90]) == [0]
@@ -1,5 +1,5 @@
 import pytest
-from kraken2ref.kraken2reference import KrakenProcessor
+from kraken2ref.kraken2reference import KrakenProcessor, parse_thresholds, parse_methods
 
 def test_exit():
 
@@ -48,3 +48,116 @@ def test_l1_tree_report():
     l1_tree_report_skew_proc.analyse_report(input_kraken_report_file="tests/artificial_reports/adenovirus_clean.report.txt", input_threshold=100, input_method="skew", quiet=True)
 
     assert sorted(l1_tree_report_skew_proc.tree_meta_out.keys()) == [10519, 10533, 28285], "Wrong taxIDs appear to be selected in mode MAX, should be [10519, 28285, 28285]"
+
+def test_report_without_minimizers(tmp_path):
+    ## drop the minimizer columns, as in reports made without --report-minimizer-data
+    with open("tests/artificial_reports/adenovirus_clean.report.txt", "r") as report, open(f"{tmp_path}/no_minimizers.report.txt", "w") as out:
+        for line in report:
+            fields = line.split("\t")
+            out.write("\t".join(fields[:3] + fields[5:]))
+
+    minimizer_proc = KrakenProcessor("minimizers")
+    minimizer_node_lists, minimizer_data_dict, has_minimizer_info = minimizer_proc.read_report("tests/artificial_reports/adenovirus_clean.report.txt")
+    assert has_minimizer_info
+    no_minimizer_proc = KrakenProcessor("no_minimizers")
+    node_lists, data_dict, has_minimizer_info = no_minimizer_proc.read_report(f"{tmp_path}/no_minimizers.report.txt")
+    assert not has_minimizer_info
+
+    assert node_lists == minimizer_node_lists
+    assert data_dict == {node: values[:3] for node, values in minimizer_data_dict.items()}
+    assert no_minimizer_proc.analyse_report(f"{tmp_path}/no_minimizers.report.txt", input_threshold=100, input_method="max", quiet=True) == \
+        minimizer_proc.analyse_report("tests/artificial_reports/adenovirus_clean.report.txt", input_threshold=100, input_method="max", quiet=True)
+
+def test_report_with_blank_lines(tmp_path):
+    report = open("tests/artificial_reports/adenovirus_clean.report.txt", "r").read()
+    open(f"{tmp_path}/trailing_blanks.report.txt", "w").write(report + "\n\n")
+
+    blank_line_proc = KrakenProcessor("trailing_blanks")
+    blank_line_proc.analyse_report(f"{tmp_path}/trailing_blanks.report.txt", input_threshold=100, input_method="max", quiet=True)
+    assert sorted(blank_line_proc.tree_meta_out.keys()) == [10519, 28285]
+
+    ## any other line with the wrong number of columns is an error
+    lines = report.splitlines(keepends = True)
+    lines[3] = "\t".join(lines[3].split("\t")[:4]) + "\n"
+    open(f"{tmp_path}/bad_line.report.txt", "w").write("".join(lines))
+    with pytest.raises(SystemExit) as e:
+        KrakenProcessor("bad_line").analyse_report(f"{tmp_path}/bad_line.report.txt", input_threshold=100, input_method="max", quiet=True)
+    assert e.value.code == 1
+
+def test_species_blocks():
+    report = "tests/test_set/with_refseq_db/testset_50x.report.txt"
+    node_lists, data_dict, _ = KrakenProcessor("whole").read_report(report)
+
+    block_proc = KrakenProcessor("blocks")
+    blocks = list(block_proc.iter_species_blocks(report))
+    assert [node_list for node_list, _ in blocks] == node_lists
+    ## each block only carries the data for its own nodes
+    for node_list, block_data_dict in blocks:
+        assert block_data_dict == {node: data_dict[node] for node in node_list}
+
+    tree_meta_out = {}
+    for node_list, block_data_dict in block_proc.iter_species_blocks(report):
+        tree_meta_out.update(block_proc.analyse_species_block(node_list, block_data_dict, input_threshold=100, input_method="max", quiet=True))
+    assert tree_meta_out == KrakenProcessor("whole").analyse_report(report, input_threshold=100, input_method="max", quiet=True)
+
+def test_skipped_species_blocks():
+    report = "tests/artificial_reports/adenovirus_clean.report.txt"
+    for threshold in [100, 5900, 10_000, 20_000]:
+        ## skipping blocks below threshold does not change the output
+        block_proc = KrakenProcessor("blocks")
+        tree_meta_out = {}
+        for node_list, block_data_dict in block_proc.iter_species_blocks(report):
+            tree_meta_out.update(block_proc.analyse_species_block(node_list, block_data_dict, input_threshold=threshold, input_method="max", quiet=True))
+
+        skipping_proc = KrakenProcessor("skipping")
+        assert skipping_proc.analyse_report(report, input_threshold=threshold, input_method="max", quiet=True) == tree_meta_out
+        assert skipping_proc.metadata["skipped_blocks"] == {100: 0, 5900: 1, 10_000: 1, 20_000: 2}[threshold]
+
+def test_threshold_sweep():
+    assert parse_thresholds("0:300:100,1000,100") == [0, 100, 200, 1000]
+    with pytest.raises(ValueError):
+        parse_thresholds("10,a")
+
+    report = "tests/test_set/with_refseq_db/testset_50x.report.txt"
+    thresholds = [0, 10, 100, 1000, 100_000]
+    for method in ["max", "skew", "tiles", "kmeans"]:
+        sweep_proc = KrakenProcessor("sweep")
+        sweep_out = sweep_proc.sweep_thresholds(report, input_thresholds=thresholds, input_method=method, quiet=True)
+        for threshold in thresholds:
+            single_proc = KrakenProcessor("single")
+            assert sweep_out[threshold] == single_proc.analyse_report(report, input_threshold=threshold, input_method=method, quiet=True)
+            assert sweep_proc.metadata["skipped_blocks"][threshold] == single_proc.metadata["skipped_blocks"]
+
+def test_compare_methods():
+    assert parse_methods("all") == ["max", "skew", "kmeans", "tiles"]
+    assert parse_methods("kmeans,MAX,kmeans") == ["kmeans", "max"]
+    with pytest.raises(ValueError):
+        parse_methods("max,mean")
+
+    report = "tests/artificial_reports/fluA_clean.report.txt"
+    methods = parse_methods("all")
+    compare_proc = KrakenProcessor("compare")
+    compare_out = compare_proc.compare_methods(report, input_threshold=100, input_methods=methods, quiet=True)
+    for method in methods:
+        assert compare_out[method] == KrakenProcessor("single").analyse_report(report, input_threshold=100, input_method=method, quiet=True)
+
+    ## each polled tree lists every method's results side by side
+    assert len(compare_proc.poll_summaries) > 0
+    for poll_summary in compare_proc.poll_summaries:
+        assert list(poll_summary["methods"]) == methods
+        assert poll_summary["methods"]["max"]["class_method"] == ["max"]
+        assert poll_summary["methods"]["skew"]["class_method"][0] == "skew"
+        for method in methods:
+            assert set(poll_summary["methods"][method]["selected"]) <= set(compare_out[method])
+
+def test_parallel_report(monkeypatch):
+    import kraken2ref.kraken2reference as k2r
+    ## small tasks, so that blocks are spread over several tasks
+    monkeypatch.setattr(k2r, "PARALLEL_TASK_ROWS", 5)
+
+    report = "tests/artificial_reports/fluA_clean.report.txt"
+    for method in ["max", "kmeans"]:
+        serial_out = KrakenProcessor("serial").analyse_report(report, input_threshold=100, input_method=method, quiet=True)
+        parallel_out = KrakenProcessor("parallel").analyse_report(report, input_threshold=100, input_method=method, quiet=True, threads=2)
+        assert parallel_out == serial_out
+        assert list(parallel_out) == list(serial_out)
@@ -27,3 +27,21 @@ def test_sort_basic(tmp_path):
 
 
 
+def test_sort_unwritten_reads(tmp_path):
+    kraken_lines = [
+        "C\tread1\t10519\t151|151\t10519:5 |:| 0:120\n",
+        "U\tread2\t0\t151|151\t0:117 |:| 0:117\n",
+        "C\tread3\t123\t151|151\t123:5 |:| 0:120\n",
+        "C\tread4\t28285\t151|151\t28285:5 |:| 0:120",
+    ]
+    kraken_output = f"{tmp_path}/sample.kraken.output"
+    open(kraken_output, "w").writelines(kraken_lines)
+    ref_json = {"metadata": {"selected": [10519]}, "outputs": {"10519": {"source_taxid": 10519, "all_taxa": [10519, 123]}}}
+    json.dump(ref_json, open(f"{tmp_path}/sample_decomposed.json", "w"))
+
+    sort_reads.sort_reads(sample_id="sample", kraken_output=kraken_output, mode="tree", ref_json_file=f"{tmp_path}/sample_decomposed.json",
+                          outdir=tmp_path, update_output=False, condense=False)
+
+    assert json.load(open(f"{tmp_path}/sample_tax_to_reads.json", "r")) == {"10519": ["read1", "read3"]}
+    ## unwritten kraken output lines are copied unchanged
+    assert open(f"{tmp_path}/sample_unwritten_reads.txt", "r").read() == kraken_lines[1] + kraken_lines[3] + "\n"
@@ -1,3 +1,4 @@
+import pytest
 from kraken2ref.taxonlevel import TaxonLevel
 
 def test_taxonlevel():
@@ -9,4 +10,15 @@ def test_taxonlevel():
     assert one != two
     assert one - two == 7
     assert one + two == TaxonLevel("S13")
-    assert two.to(one) == ["S4", "S5", "S6", "S7", "S8", "S9"]
\ No newline at end of file
+    assert two.to(one) == ["S4", "S5", "S6", "S7", "S8", "S9"]
+
+def test_taxonlevel_interned():
+    three = TaxonLevel("S3")
+
+    assert three is TaxonLevel("S3")
+    assert three - 1 is TaxonLevel("S2")
+    assert TaxonLevel("S1") < three
+    assert sorted([three, TaxonLevel("S"), TaxonLevel("S1")]) == [TaxonLevel("S"), TaxonLevel("S1"), three]
+    assert len({three, TaxonLevel("S3"), TaxonLevel("S2")}) == 2
+    with pytest.raises(AttributeError):
+        three.val = 4
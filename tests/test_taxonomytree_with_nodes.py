@@ -72,3 +72,32 @@ def test_taxonomy_tree_with_nodes():
     ## check get_tree_complexity
     assert test_tree_from_nodes.complexity == 2
 
+
+def test_taxonomy_tree_parents():
+    test_input, test_output, _, _ = __init__()
+
+    test_tree_from_nodes = TaxonomyTree(nodes = test_input)
+    assert test_tree_from_nodes.parents == {(11, 'S'): None, (12, 'S1'): (11, 'S'), (13, 'S2'): (12, 'S1'), (14, 'S3'): (13, 'S2'),
+                                            (15, 'S4'): (14, 'S3'), (16, 'S3'): (13, 'S2'), (17, 'S2'): (12, 'S1'), (18, 'S3'): (17, 'S2')}
+    ## same parents when initialised from the graph
+    assert TaxonomyTree(tree = test_output).parents == test_tree_from_nodes.parents
+
+    ## wide trees (e.g. many strains of one species) build in one pass
+    wide_input = [(0, "S")] + [(i, "S1") for i in range(1, 20001)]
+    wide_tree = TaxonomyTree(nodes = wide_input)
+    assert wide_tree.graph[(0, "S")] == wide_input[1:]
+    assert wide_tree.leaf_nodes == wide_input[1:]
+    assert wide_tree.subterminal_nodes == [(0, "S")]
+
+def test_taxonomy_tree_paths():
+    test_input, _, _, _ = __init__()
+
+    test_tree_from_nodes = TaxonomyTree(nodes = test_input)
+    for node in test_input:
+        assert test_tree_from_nodes.find_path(node) == test_tree_from_nodes.find_all_paths(test_tree_from_nodes.graph, test_tree_from_nodes.root, node)[0]
+    assert test_tree_from_nodes.find_path((16, 'S3')) == [(11, 'S'), (12, 'S1'), (13, 'S2'), (16, 'S3')]
+
+    data_dict = {node: (0, 0, 100 + node[0]) for node in test_input}
+    taxids = test_tree_from_nodes.get_taxids(data_dict)
+    assert taxids == [111, 112, 113, 114, 115, 116, 117, 118]
+    assert test_tree_from_nodes.get_taxids(data_dict) is taxids
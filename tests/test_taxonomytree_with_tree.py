@@ -72,3 +72,16 @@ def test_taxonomy_tree_with_tree():
     assert test_tree_from_tree.subgraphs == test_decomposed_output
     ## check get_tree_complexity
     assert test_tree_from_tree.complexity == 2
+
+def test_decompose_tree_repeatable():
+    test_input, test_output, _, test_decomposed_output = __init__()
+    test_tree_from_tree = TaxonomyTree(tree = test_output)
+
+    ## subgraphs do not accumulate across calls
+    assert test_tree_from_tree.decompose_tree(test_tree_from_tree.graph) == test_decomposed_output
+    assert test_tree_from_tree.decompose_tree(test_tree_from_tree.graph) == test_decomposed_output
+
+    ## subgraphs are views over the input graph, and can be used to build trees
+    subtrees = [TaxonomyTree(tree = subgraph) for subgraph in test_tree_from_tree.subgraphs]
+    assert [subtree.complexity for subtree in subtrees] == [0] * len(test_decomposed_output)
+    assert [subtree.graph for subtree in subtrees] == test_decomposed_output
@@ -0,0 +1,73 @@
+import json
+from kraken2ref.kraken2reference import KrakenProcessor
+from kraken2ref.topologycache import TopologyCache
+
+REPORT = "tests/artificial_reports/fluA_clean.report.txt"
+
+def test_cached_simple_trees():
+    processor = KrakenProcessor("trees")
+    cached_processor = KrakenProcessor("cached_trees", topology_cache = TopologyCache())
+    for node_list, data_dict in processor.iter_species_blocks(REPORT):
+        built = processor.find_simple_trees(node_list = node_list, quiet = True)
+        ## first lookup builds and caches the trees, the second sets them up from the cache
+        cached_processor.find_simple_trees(node_list = node_list, quiet = True, data_dict = data_dict)
+        cached = cached_processor.find_simple_trees(node_list = node_list, quiet = True, data_dict = data_dict)
+
+        assert len(cached) == len(built) > 1
+        for cached_tree, built_tree in zip(cached, built):
+            assert cached_tree.nodes == built_tree.nodes
+            assert cached_tree.graph == dict(built_tree.graph.items())
+            assert cached_tree.parents == built_tree.parents
+            assert cached_tree.leaf_nodes == built_tree.leaf_nodes
+            assert cached_tree.subterminal_nodes == built_tree.subterminal_nodes
+            assert cached_tree.max_lvl == built_tree.max_lvl
+            assert cached_tree.get_taxids(data_dict) == built_tree.get_taxids(data_dict)
+
+    assert cached_processor.topology_cache.hits == cached_processor.topology_cache.misses == 1
+
+def test_topology_cache_across_samples(tmp_path):
+    cache_file = str(tmp_path / "topologies.json")
+    expected = KrakenProcessor("uncached").analyse_report(REPORT, input_threshold = 100, input_method = "kmeans", quiet = True)
+
+    first_cache = TopologyCache(cache_file = cache_file, fingerprint = "db1")
+    first_out = KrakenProcessor("first", topology_cache = first_cache).analyse_report(REPORT, input_threshold = 100, input_method = "kmeans", quiet = True)
+    first_cache.save()
+    assert first_out == expected
+    assert first_cache.misses == 1
+
+    ## the next sample reuses the saved structure
+    second_cache = TopologyCache(cache_file = cache_file, fingerprint = "db1")
+    second_out = KrakenProcessor("second", topology_cache = second_cache).analyse_report(REPORT, input_threshold = 100, input_method = "kmeans", quiet = True)
+    assert second_out == expected
+    assert list(second_out) == list(expected)
+    assert (second_cache.hits, second_cache.misses) == (1, 0)
+
+    ## a cache made for another database is not used
+    other_cache = TopologyCache(cache_file = cache_file, fingerprint = "db2")
+    assert len(other_cache.topologies) == 0
+
+def test_topology_cache_bad_files(tmp_path):
+    cache_file = str(tmp_path / "topologies.json")
+    cache = TopologyCache(cache_file = cache_file, fingerprint = "db1")
+    expected = KrakenProcessor("uncached").analyse_report(REPORT, input_threshold = 100, input_method = "max", quiet = True)
+    KrakenProcessor("first", topology_cache = cache).analyse_report(REPORT, input_threshold = 100, input_method = "max", quiet = True)
+    cache.save()
+    saved = open(cache_file, "r").read()
+    stored = json.loads(saved)
+    key = next(iter(stored["topologies"]))
+
+    ## the cache is plain JSON, and bad files are ignored as if empty
+    bad_files = [
+        saved[:len(saved) // 2],
+        b"\x80\x04\x95 not json",
+        json.dumps({**stored, "format": 1}),
+        json.dumps({**stored, "topologies": []}),
+        json.dumps({**stored, "topologies": {key: [0, [-1, 5], []]}}),
+        json.dumps({**stored, "topologies": {key: [0, stored["topologies"][key][1], [[[1, 0], [1], [0], "S1"]]]}}),
+        json.dumps({**stored, "topologies": {key: "S"}}),
+    ]
+    for bad_file in bad_files:
+        open(cache_file, "wb" if isinstance(bad_file, bytes) else "w").write(bad_file)
+        bad_cache = TopologyCache(cache_file = cache_file, fingerprint = "db1")
+        assert len(bad_cache.topologies) == 0
+        assert KrakenProcessor("bad", topology_cache = bad_cache).analyse_report(REPORT, input_threshold = 100, input_method = "max", quiet = True) == expected